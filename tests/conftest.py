@@ -0,0 +1,15 @@
+# The modules of warbot/lib import each other by name (e.g. `from vars import
+# log`), as the bots add that folder to the path
+import os, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname( \
+    os.path.abspath(__file__))), 'warbot', 'lib'))
+
+import pytest
+
+from vars import log
+
+
+@pytest.fixture(autouse=True)
+def quiet_log():
+    log.SEND_LOG = False
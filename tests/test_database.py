@@ -0,0 +1,168 @@
+import json, sqlite3
+
+import pytest
+
+from database import WarBotDB
+
+
+FILENAME = 'warbot_db.sqlite3'
+
+# tables of the databases created before schema versioning (version 0)
+SCHEMA_0 = WarBotDB.SCHEMA[:4] + [
+    """CREATE TABLE queues (
+        name        TEXT PRIMARY KEY,
+        items       TEXT NOT NULL
+    )"""
+]
+
+
+def create(tmp_path, statements, version, settings=None):
+    """Creates a database file out of statements, as an older version did"""
+
+    conn = sqlite3.connect(str(tmp_path / FILENAME))
+    for statement in statements:
+        conn.execute(statement)
+    if settings is not None:
+        conn.execute("INSERT INTO settings (id, document) VALUES (1, ?)", \
+            (json.dumps(settings),))
+    conn.execute("PRAGMA user_version = {:d}".format(version))
+    conn.commit()
+    return conn
+
+
+def open_db(tmp_path):
+    return WarBotDB(str(tmp_path), FILENAME)
+
+
+def user_version(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / FILENAME))
+    try:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def tables(db):
+    return {row['name'] for row in db.storage.read("SELECT name FROM " \
+        + "sqlite_master WHERE type = 'table'")}
+
+
+def test_new_database_is_created_at_the_last_version(tmp_path):
+    db = open_db(tmp_path)
+
+    assert user_version(tmp_path) == WarBotDB.SCHEMA_VERSION
+    assert {'candidates', 'fighters', 'kills', 'settings', 'queue_items', \
+        'avatars', 'outbox'} <= tables(db)
+    settings = db.get_settings()
+    assert settings['optin_interval'] == 0
+    assert settings['schedules'] == []
+
+
+def test_migrates_from_version_0(tmp_path):
+    conn = create(tmp_path, SCHEMA_0, 0, settings={'optin_running': True})
+    conn.execute("INSERT INTO fighters (username, alive) VALUES ('ana', 1)")
+    conn.execute("INSERT INTO queues (name, items) VALUES (?, ?)", \
+        ('battle_queue', json.dumps([{'killer': 'ana'}, {'killer': 'bob'}])))
+    conn.execute("INSERT INTO queues (name, items) VALUES (?, ?)", \
+        ('retry_queue', json.dumps([{'text': "hi", 'media': ['a.png']}])))
+    conn.commit()
+    conn.close()
+
+    db = open_db(tmp_path)
+
+    assert user_version(tmp_path) == WarBotDB.SCHEMA_VERSION
+    assert 'queues' not in tables(db)
+    assert [item for _, item in db.read_queue('battle_queue')] == \
+        [{'killer': 'ana'}, {'killer': 'bob'}]
+    # version 3 moves the tweets to retry into the outbox
+    assert db.read_queue('retry_queue') == []
+    [tweet] = db.get_outbox()
+    assert tweet['kind'] == 'tweet'
+    assert tweet['step'] == 'rendered'
+    assert tweet['data']['text'] == "hi"
+    assert tweet['progress'] == {'images': ['a.png']}
+    # data and settings are kept, missing settings set to their defaults
+    assert [fighter['username'] for fighter in db.get_fighters()] == ['ana']
+    settings = db.get_settings()
+    assert settings['optin_running'] is True
+    assert settings['battle_frequency_hours'] == \
+        WarBotDB.SETTINGS_DEFAULTS['battle_frequency_hours']
+
+
+def test_migrates_from_version_1(tmp_path):
+    settings = dict(WarBotDB.SETTINGS_DEFAULTS)
+    del settings['optin_interval']
+    conn = create(tmp_path, WarBotDB.SCHEMA, 1, settings=settings)
+    conn.execute("INSERT INTO queue_items (queue, item) VALUES (?, ?)", \
+        ('announce_queue', json.dumps({'username': 'ana'})))
+    item_id = conn.execute("INSERT INTO queue_items (queue, item) VALUES " \
+        + "(?, ?)", ('retry_queue', json.dumps({'text': "hi", 'media': None}))) \
+        .lastrowid
+    conn.commit()
+    conn.close()
+
+    db = open_db(tmp_path)
+
+    assert user_version(tmp_path) == WarBotDB.SCHEMA_VERSION
+    assert {'avatars', 'outbox'} <= tables(db)
+    assert db.read_queue('retry_queue') == []
+    assert [item for _, item in db.read_queue('announce_queue')] == \
+        [{'username': 'ana'}]
+    [tweet] = db.get_outbox()
+    assert tweet['key'] == 'tweet-' + str(item_id)
+    assert tweet['step'] == 'rendered'
+    assert tweet['progress'] == {'images': []}
+    assert db.get_settings()['optin_interval'] == 0
+
+
+def test_warm_start_writes_nothing(tmp_path):
+    open_db(tmp_path)
+    path = str(tmp_path / FILENAME)
+    conn = sqlite3.connect(path)
+    changes = conn.execute("PRAGMA data_version").fetchone()[0]
+
+    open_db(tmp_path)
+
+    # data_version changes when another connection commits
+    assert conn.execute("PRAGMA data_version").fetchone()[0] == changes
+    conn.close()
+
+
+def write_json(tmp_path):
+    json_route = tmp_path / 'warbot_db.json'
+    json_route.write_text(json.dumps({
+        'fighters': {'1': {'username': 'ana', 'alive': True, 'killed': []}},
+        'candidates': {'1': {'username': 'bob'}},
+        'vars': {'1': {'varname': 'battle_queue', 'value': [{'killer': 'ana'}]}}
+    }))
+    return json_route
+
+
+def test_json_is_imported_into_a_new_database_once(tmp_path):
+    write_json(tmp_path)
+
+    db = open_db(tmp_path)
+    open_db(tmp_path)
+
+    assert [fighter['username'] for fighter in db.get_fighters()] == ['ana']
+    assert [candidate['username'] for candidate in db.get_candidates()] == \
+        ['bob']
+    assert len(db.read_queue('battle_queue')) == 1
+
+
+def test_failed_json_import_is_rolled_back(tmp_path, monkeypatch):
+    write_json(tmp_path)
+
+    def fail(self, queue, items):
+        raise RuntimeError("import failed")
+    with monkeypatch.context() as patch:
+        patch.setattr(WarBotDB, 'push_queue_many', fail)
+        with pytest.raises(RuntimeError):
+            open_db(tmp_path)
+    assert user_version(tmp_path) == 0
+
+    db = open_db(tmp_path)
+
+    assert user_version(tmp_path) == WarBotDB.SCHEMA_VERSION
+    assert [fighter['username'] for fighter in db.get_fighters()] == ['ana']
+    assert len(db.read_queue('battle_queue')) == 1
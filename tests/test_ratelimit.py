@@ -0,0 +1,178 @@
+import time
+
+import pytest
+import requests
+import tweepy
+
+from ratelimit import WarBotRateLimited, WarBotRateLimiter, WarBotTokenBucket
+
+
+class Response:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def limit_headers(limit, remaining, reset):
+    return {'x-rate-limit-limit': str(limit), \
+        'x-rate-limit-remaining': str(remaining), \
+        'x-rate-limit-reset': str(reset)}
+
+
+class API:
+    """Stands for a tweepy interface: records calls, raises the errors
+    given, and answers with the given headers"""
+
+    def __init__(self, headers=None, errors=()):
+        self.headers = headers
+        self.errors = list(errors)
+        self.calls = 0
+        self.last_response = None
+
+    def method(self, value):
+        self.calls += 1
+        if len(self.errors) > 0:
+            raise self.errors.pop(0)
+        self.last_response = Response(200, self.headers)
+        return value
+
+
+def connection_error():
+    # as tweepy wraps the errors of requests
+    try:
+        try:
+            raise requests.ConnectionError("reset")
+        except requests.ConnectionError as e:
+            raise tweepy.TweepError("Failed to send request: " + str(e))
+    except tweepy.TweepError as e:
+        return e
+
+
+# WarBotTokenBucket
+
+def test_bucket_unknown_limit_does_not_wait():
+    bucket = WarBotTokenBucket()
+
+    assert bucket.delay() == 0
+    bucket.take()
+    assert bucket.remaining is None
+
+
+def test_bucket_parses_headers():
+    bucket = WarBotTokenBucket()
+    bucket.update(limit_headers(75, 10, 1000.0))
+
+    assert (bucket.limit, bucket.remaining, bucket.reset) == (75, 10, 1000.0)
+    # responses without limits are ignored
+    bucket.update({'content-type': 'application/json'})
+    bucket.update(None)
+    assert (bucket.limit, bucket.remaining, bucket.reset) == (75, 10, 1000.0)
+
+
+def test_bucket_missing_reset_starts_a_window():
+    bucket = WarBotTokenBucket()
+    before = time.time()
+    bucket.update({'x-rate-limit-limit': '15', 'x-rate-limit-remaining': '3'})
+
+    assert bucket.reset >= before + WarBotTokenBucket.WINDOW
+
+
+def test_bucket_takes_and_refills():
+    bucket = WarBotTokenBucket()
+    bucket.update(limit_headers(2, 2, 1000.0))
+
+    bucket.take()
+    assert bucket.delay(now=900.0) == 0
+    bucket.take()
+    assert bucket.delay(now=900.0) == 100.0
+    # the window resets
+    assert bucket.delay(now=1000.0) == 0
+    assert bucket.remaining == 2
+
+
+def test_bucket_exhaust():
+    bucket = WarBotTokenBucket()
+    bucket.exhaust()
+
+    assert bucket.remaining == 0
+    assert bucket.delay() == pytest.approx(WarBotTokenBucket.WINDOW, abs=1)
+
+
+# WarBotRateLimiter
+
+def test_limiter_reads_the_limits_of_each_endpoint():
+    limiter = WarBotRateLimiter()
+    reset = time.time() + 600
+    api = API(limit_headers(15, 14, reset))
+
+    assert limiter.call(api, 'statuses/update', 'method', 'ok') == 'ok'
+    assert limiter.budget('statuses/update') == (14, pytest.approx(600, abs=1))
+    assert limiter.budget('users/show') is None
+
+
+def test_limiter_defers_empty_endpoints():
+    limiter = WarBotRateLimiter()
+    reset = time.time() + 600
+    api = API(limit_headers(15, 0, reset))
+
+    limiter.call(api, 'statuses/update', 'method', 'ok')
+    with pytest.raises(WarBotRateLimited) as e:
+        limiter.call(api, 'statuses/update', 'method', 'ok')
+    assert e.value.retry_at == reset
+    assert api.calls == 1
+    # other endpoints are not affected
+    limiter.call(api, 'users/show', 'method', 'ok')
+
+
+def test_limiter_defers_after_429():
+    limiter = WarBotRateLimiter()
+    api = API(errors=[tweepy.RateLimitError("limited", Response(429))])
+
+    with pytest.raises(WarBotRateLimited):
+        limiter.call(api, 'statuses/update', 'method', 'ok')
+    assert api.calls == 1
+    assert limiter.delay('statuses/update') > 0
+
+
+def test_limiter_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    limiter = WarBotRateLimiter()
+    api = API(errors=[connection_error(), tweepy.TweepError("x", Response(503))])
+
+    assert limiter.call(api, 'statuses/update', 'method', 'ok') == 'ok'
+    assert api.calls == 3
+
+
+def test_limiter_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(time, 'sleep', lambda seconds: None)
+    limiter = WarBotRateLimiter()
+    api = API(errors=[connection_error()] * (WarBotRateLimiter.MAX_RETRIES + 1))
+
+    with pytest.raises(tweepy.TweepError):
+        limiter.call(api, 'statuses/update', 'method', 'ok')
+    assert api.calls == WarBotRateLimiter.MAX_RETRIES + 1
+
+
+def test_limiter_raises_other_errors_right_away():
+    limiter = WarBotRateLimiter()
+    api = API(errors=[tweepy.TweepError("duplicate", Response(403))])
+
+    with pytest.raises(tweepy.TweepError):
+        limiter.call(api, 'statuses/update', 'method', 'ok')
+    assert api.calls == 1
+
+
+@pytest.mark.parametrize("error, transient", [
+    (WarBotRateLimited('statuses/update', 0), True),
+    (tweepy.RateLimitError("limited", Response(429)), True),
+    (tweepy.TweepError("x", Response(429)), True),
+    (tweepy.TweepError("x", Response(500)), True),
+    (tweepy.TweepError("x", Response(403)), False),
+    (connection_error(), True),
+    (tweepy.TweepError("bad argument"), False),
+    (requests.ConnectionError(), True),
+    (requests.Timeout(), True),
+    (requests.exceptions.InvalidURL(), False),
+])
+def test_is_transient(error, transient):
+    assert WarBotRateLimiter().is_transient(error) == transient
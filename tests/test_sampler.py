@@ -0,0 +1,108 @@
+import random
+
+import pytest
+
+from sampler import WarBotSampler
+
+
+def prefix_sums(weights):
+    sums, total = [], 0.0
+    for weight in weights:
+        total += weight
+        sums.append(total)
+    return sums
+
+
+def test_total_and_find_match_prefix_sums():
+    weights = [3.0, 0.0, 1.0, 2.5, 0.0, 4.0, 1.0]
+    sampler = WarBotSampler(weights)
+
+    assert sampler.total() == pytest.approx(sum(weights))
+    sums = prefix_sums(weights)
+    for x in [0.0, 2.9, 3.0, 3.5, 4.0, 6.4, 6.5, 10.4, 10.5, 11.49]:
+        expected = next(i for i, s in enumerate(sums) if s > x)
+        assert sampler.find(x) == expected
+
+
+def test_updates_keep_the_tree_in_step():
+    rng = random.Random(1)
+    weights = [rng.uniform(0, 5) for _ in range(37)]
+    sampler = WarBotSampler(weights)
+
+    for _ in range(200):
+        i = rng.randrange(len(weights))
+        weights[i] = rng.choice([0.0, rng.uniform(0, 5)])
+        sampler.update(i, weights[i])
+
+    assert sampler.weights == weights
+    assert sampler.total() == pytest.approx(sum(weights))
+    sums = prefix_sums(weights)
+    for _ in range(100):
+        x = rng.uniform(0, sum(weights))
+        assert sampler.find(x) == next(i for i, s in enumerate(sums) if s > x)
+
+
+def test_sample_never_draws_zero_weights():
+    random.seed(2)
+    sampler = WarBotSampler([0.0, 1.0, 0.0, 2.0, 0.0])
+
+    assert {sampler.sample() for _ in range(500)} == {1, 3}
+
+
+def test_sample_follows_the_weights():
+    random.seed(3)
+    sampler = WarBotSampler([1.0, 3.0])
+
+    draws = [sampler.sample() for _ in range(4000)]
+    assert draws.count(1) / len(draws) == pytest.approx(0.75, abs=0.03)
+
+
+def test_sample_with_no_weight():
+    assert WarBotSampler([0.0, 0.0]).sample() is None
+    assert WarBotSampler([]).sample() is None
+
+
+def test_sample_pair_draws_two_different_indexes():
+    random.seed(4)
+    sampler = WarBotSampler([1.0, 0.0, 2.0, 1.0])
+
+    for _ in range(300):
+        first, second = sampler.sample_pair()
+        assert first != second
+        assert 1 not in (first, second)
+    # the weight of the first index is restored
+    assert sampler.weights == [1.0, 0.0, 2.0, 1.0]
+    assert sampler.total() == pytest.approx(4.0)
+
+
+def test_sample_pair_follows_the_weights():
+    # P(first = 0, second = 1) = 2/4 * 1/2
+    random.seed(5)
+    sampler = WarBotSampler([2.0, 1.0, 1.0])
+
+    pairs = [sampler.sample_pair() for _ in range(6000)]
+    assert pairs.count((0, 1)) / len(pairs) == pytest.approx(0.25, abs=0.03)
+
+
+def test_sample_pair_needs_two_indexes_with_weight():
+    assert WarBotSampler([0.0, 5.0, 0.0]).sample_pair() == (None, None)
+
+
+def test_roster_keeps_its_sampler_updated():
+    import numpy as np
+    from roster import WarBotRoster
+
+    roster = WarBotRoster()
+    for username in ('a', 'b', 'c'):
+        roster.add(username)
+    sampler = roster.sampler(0.5)
+
+    roster.add_kill('a', 'b')
+    roster.set_alive('b', False)
+    assert sampler.weights[:3] == [1.5, 0.0, 1.0]
+
+    # new fighters past the capacity rebuild the sampler
+    for i in range(20):
+        roster.add('x' + str(i))
+    assert roster.sampler(0.5).total() == pytest.approx(1.5 + 1.0 + 20)
+    assert np.count_nonzero(roster.sampler(0.5).weights) == 22
@@ -0,0 +1,202 @@
+from datetime import datetime, time, timedelta
+
+import pytest
+
+from scheduler import WarBotScheduler, WarBotRule
+
+
+# 2024-01-01 is a Monday
+MONDAY = datetime(2024, 1, 1)
+
+
+def at(day, hour, minute=0):
+    return MONDAY + timedelta(days=day, hours=hour, minutes=minute)
+
+
+class Recorder:
+    def __init__(self, result=None):
+        self.calls = []
+        self.result = result
+
+    def __call__(self, when):
+        self.calls.append(when)
+        return self.result
+
+
+# WarBotRule
+
+def test_parse_rule():
+    rule = WarBotRule.parse("45 10:00-23:00 mon-fri", id=3)
+
+    assert rule.id == 3
+    assert rule.every == 45
+    assert (rule.start, rule.end) == (time(10, 0), time(23, 0))
+    assert rule.days == [0, 1, 2, 3, 4]
+    assert str(rule) == "45 10:00-23:00 mon,tue,wed,thu,fri"
+
+
+def test_parse_days():
+    assert WarBotRule.parse("30 10:00-12:00").days == list(range(7))
+    assert WarBotRule.parse("30 10:00-12:00 all").days == list(range(7))
+    assert WarBotRule.parse("30 10:00-12:00 mon,wed,sun").days == [0, 2, 6]
+    # ranges wrap around the end of the week
+    assert WarBotRule.parse("30 10:00-12:00 sat-mon").days == [0, 5, 6]
+    assert WarBotRule.parse("30 10:00-12:00 fri-tue").days == [0, 1, 4, 5, 6]
+
+
+@pytest.mark.parametrize("text", ["45", "45 10:00", "0 10:00-12:00", \
+    "45 12:00-10:00", "45 10:00-23:00 monday", "45 25:00-26:00", \
+    "x 10:00-12:00", "45 10:00-12:00 mon extra"])
+def test_parse_invalid_rules(text):
+    with pytest.raises(ValueError):
+        WarBotRule.parse(text)
+
+
+def test_rule_dict_round_trip():
+    rule = WarBotRule.parse("20 08:30-09:30 sat-mon", id=1)
+
+    assert WarBotRule.from_dict(rule.to_dict()).to_dict() == rule.to_dict()
+
+
+def test_next_after_within_a_day():
+    rule = WarBotRule.parse("45 10:00-23:00 mon-fri")
+
+    assert rule.next_after(at(0, 8)) == at(0, 10)
+    assert rule.next_after(at(0, 10)) == at(0, 10, 45)
+    assert rule.next_after(at(0, 10, 44)) == at(0, 10, 45)
+    assert rule.next_after(at(0, 11, 30)) == at(0, 12, 15)
+    # the last battle of the day is at 22:45
+    assert rule.next_after(at(0, 22, 0)) == at(0, 22, 45)
+    assert rule.next_after(at(0, 22, 45)) == at(1, 10)
+
+
+def test_next_after_end_included():
+    rule = WarBotRule.parse("30 10:00-11:00")
+
+    assert rule.next_after(at(0, 10, 30)) == at(0, 11)
+    assert rule.next_after(at(0, 11)) == at(1, 10)
+
+
+def test_next_after_skips_days():
+    rule = WarBotRule.parse("45 10:00-23:00 mon-fri")
+
+    # friday night -> monday
+    assert rule.next_after(at(4, 23)) == at(7, 10)
+
+
+def test_next_after_wrap_around_days():
+    rule = WarBotRule.parse("60 10:00-12:00 sat-mon")
+
+    assert rule.next_after(at(0, 12)) == at(5, 10)      # mon -> sat
+    assert rule.next_after(at(5, 12)) == at(6, 10)      # sat -> sun
+    assert rule.next_after(at(6, 12)) == at(7, 10)      # sun -> mon
+    assert rule.next_after(at(2, 9)) == at(5, 10)       # wed -> sat
+
+
+# WarBotScheduler
+
+def test_runs_due_events_in_order():
+    scheduler = WarBotScheduler()
+    order = []
+    scheduler.schedule('b', at(0, 10), lambda when: order.append('b'))
+    scheduler.schedule('a', at(0, 9), lambda when: order.append('a'))
+    scheduler.schedule('c', at(0, 11), lambda when: order.append('c'))
+
+    assert scheduler.run_pending(at(0, 10)) == ['a', 'b']
+    assert order == ['a', 'b']
+    assert scheduler.next_time() == at(0, 11)
+
+
+def test_reschedule_and_cancel():
+    scheduler = WarBotScheduler()
+    recorder = Recorder()
+    scheduler.schedule('battle', at(0, 9), recorder)
+    scheduler.schedule('battle', at(0, 12), recorder)
+    scheduler.schedule('other', at(0, 8), recorder)
+    scheduler.cancel('other')
+
+    assert scheduler.next_time() == at(0, 12)
+    assert scheduler.run_pending(at(0, 11)) == []
+    assert scheduler.run_pending(at(0, 12)) == ['battle']
+    assert recorder.calls == [at(0, 12)]
+    assert scheduler.get('battle') is None
+
+
+def test_timeout():
+    scheduler = WarBotScheduler()
+    assert scheduler.timeout(60, at(0, 9)) == 60
+
+    scheduler.schedule('battle', at(0, 9, 0) + timedelta(seconds=20), \
+        Recorder())
+    assert scheduler.timeout(60, at(0, 9)) == 20
+    assert scheduler.timeout(10, at(0, 9)) == 10
+    assert scheduler.timeout(60, at(0, 10)) == 0
+
+
+def test_invalid_catch_up_policy():
+    with pytest.raises(ValueError):
+        WarBotScheduler(catch_up='never')
+
+
+@pytest.mark.parametrize("catch_up, calls, next_time", [
+    # three occurrences missed (9:00, 9:30, 10:00), found at 10:10
+    ('all', [at(0, 9), at(0, 9, 30), at(0, 10)], at(0, 10, 30)),
+    ('once', [at(0, 9)], at(0, 10, 30)),
+    ('skip', [], at(0, 10, 30)),
+])
+def test_catch_up_with_interval(catch_up, calls, next_time):
+    scheduler = WarBotScheduler(catch_up=catch_up)
+    recorder = Recorder()
+    scheduler.schedule('battle', at(0, 9), recorder, timedelta(minutes=30))
+
+    scheduler.run_pending(at(0, 10, 10))
+
+    assert recorder.calls == calls
+    assert scheduler.get('battle') == next_time
+
+
+@pytest.mark.parametrize("catch_up, calls, next_time", [
+    ('all', [at(0, 10), at(0, 11), at(0, 12)], at(1, 10)),
+    ('once', [at(0, 10)], at(1, 10)),
+    ('skip', [], at(1, 10)),
+])
+def test_catch_up_with_rule(catch_up, calls, next_time):
+    scheduler = WarBotScheduler(catch_up=catch_up)
+    recorder = Recorder()
+    scheduler.schedule('rule', at(0, 10), recorder, \
+        WarBotRule.parse("60 10:00-12:00"))
+
+    scheduler.run_pending(at(0, 13))
+
+    assert recorder.calls == calls
+    assert scheduler.get('rule') == next_time
+
+
+def test_skip_runs_events_within_grace():
+    scheduler = WarBotScheduler(catch_up='skip', grace=timedelta(minutes=5))
+    recorder = Recorder()
+    scheduler.schedule('battle', at(0, 9), recorder, timedelta(minutes=30))
+
+    assert scheduler.run_pending(at(0, 9, 4)) == ['battle']
+    assert recorder.calls == [at(0, 9)]
+    assert scheduler.get('battle') == at(0, 9, 30)
+
+
+def test_callback_returning_false_stops_a_recurring_event():
+    scheduler = WarBotScheduler()
+    scheduler.schedule('battle', at(0, 9), Recorder(False), \
+        timedelta(minutes=30))
+
+    scheduler.run_pending(at(0, 9))
+    assert scheduler.get('battle') is None
+
+
+def test_callback_may_reschedule_its_event():
+    scheduler = WarBotScheduler()
+
+    def callback(when):
+        scheduler.schedule('battle', at(1, 9), callback)
+
+    scheduler.schedule('battle', at(0, 9), callback, timedelta(minutes=30))
+    scheduler.run_pending(at(0, 9))
+    assert scheduler.get('battle') == at(1, 9)
@@ -36,7 +36,8 @@ a = WarBotAdmin(
     database_filename   = FILENAMES['DATABASE'],
     phrases_route       = ROUTES['PHRASES'],
     phrases_filename    = FILENAMES['PHRASES'],
-    auth_id             = TELEGRAM_VARS['AUTH_ID']
+    auth_id             = TELEGRAM_VARS['AUTH_ID'],
+    notify_filename     = FILENAMES['NOTIFY']
 )
 
 if __name__ == '__main__':
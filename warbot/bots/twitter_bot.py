@@ -41,7 +41,10 @@ t = WarBotTwitter(
     phrases_filename    = FILENAMES['PHRASES'],
     ih_images_route     = ROUTES['IMAGES'],
     ih_resources_route  = ROUTES['RESOURCES'],
-    ih_store_route      = ROUTES['IMAGES']
+    ih_store_route      = ROUTES['IMAGES'],
+    catch_up            = TWITTER_VARS['CATCH_UP'],
+    notify_filename     = FILENAMES['NOTIFY'],
+    preupload           = TWITTER_VARS['PREUPLOAD']
 )
 
 if __name__ == "__main__":
@@ -23,7 +23,8 @@ __status__      = "Production"
 # WarBotAdmin inherits TelegramInterface
 from telegram import TelegramInterface
 from warbot import WarBot
-from vars import log
+from notify import WarBotNotifier
+from vars import log, route, TWITTER_VARS
 
 from datetime import datetime   # store dates
 
@@ -36,6 +37,8 @@ class WarBotAdmin(TelegramInterface):
 
     Attributes
     ----------
+    BATTLES_LISTED : int
+        Maximum number of battles listed by /forcebattle [n]
     bot : WarBot
         WarBot controller instance
     __ask_status : str
@@ -43,6 +46,8 @@ class WarBotAdmin(TelegramInterface):
         (Used for Telegram buttons)
     _auth_id : int
         Telegram user authorized to interact with the bot
+    notifier : WarBotNotifier
+        Wakes up the Twitter bot after every command, None if disabled
     
     Methods
     -------
@@ -70,6 +75,12 @@ class WarBotAdmin(TelegramInterface):
         Handles command /setbattlefrequency
     handle_stopfrequency(chat)
         Handles command /stopfrequency
+    handle_addschedule(chat, attr)
+        Handles command /addschedule
+    handle_getschedules(chat)
+        Handles command /getschedules
+    handle_deleteschedule(chat, attr)
+        Handles command /deleteschedule
     handle_forcebattle(chat, attr)
         Handles command /forcebattle
     handle_getfighters(chat)
@@ -99,10 +110,11 @@ class WarBotAdmin(TelegramInterface):
 
     """
 
+    BATTLES_LISTED = 20
 
     def __init__(self, telegram_token, telegram_sleep_time, \
         database_route, database_filename, \
-        phrases_route, phrases_filename, auth_id):
+        phrases_route, phrases_filename, auth_id, notify_filename=None):
         """
         Parameters
         ----------
@@ -119,6 +131,9 @@ class WarBotAdmin(TelegramInterface):
             Filename of txt file containing battle phrases
         auth_id : int
             Telegram ID of authorized user
+        notify_filename : str
+            Filename of the socket, in the database folder, to wake up the
+            Twitter bot through. If None, the Twitter bot is not woken up
         """
 
         super(WarBotAdmin, self).__init__(telegram_token, telegram_sleep_time)
@@ -126,6 +141,10 @@ class WarBotAdmin(TelegramInterface):
             phrases_route, phrases_filename)
         self.ask_status = "NONE"
         self.auth_id = auth_id
+        self.notifier = None
+        if notify_filename is not None:
+            self.notifier = WarBotNotifier(route.paste(database_route, \
+                notify_filename))
 
 
     def update_message_queue(self):
@@ -133,12 +152,15 @@ class WarBotAdmin(TelegramInterface):
 
         The rest of the classes interact with the database (WarBotDB) to send
         and delete message requests. Messages in the message queue are sent to
-        the authorized user as soon as the bot updates.
+        the authorized user as soon as the bot updates. Only the messages read
+        are removed from the queue, so messages pushed meanwhile by the Twitter
+        bot are not lost.
         """
 
-        messages = self.bot.get_message_queue()
-        self.bot.wipe_message_queue()
-        self.m_queue = messages
+        messages = self.bot.read_queue('message_queue')
+        if len(messages) > 0:
+            self.m_queue.extend(message for _, message in messages)
+            self.bot.consume_queue('message_queue', messages[-1][0])
     
 
     def handle_updates(self, updates):
@@ -179,6 +201,12 @@ class WarBotAdmin(TelegramInterface):
                         self.handle_setbattlefrequency(chat, text.split()[1:])
                     elif text.startswith('/stopfrequency'):
                         self.handle_stopfrequency(chat)
+                    elif text.startswith('/addschedule'):
+                        self.handle_addschedule(chat, text.split()[1:])
+                    elif text.startswith('/getschedules'):
+                        self.handle_getschedules(chat)
+                    elif text.startswith('/deleteschedule'):
+                        self.handle_deleteschedule(chat, text.split()[1:])
                     elif text.startswith('/forcebattle'):
                         self.handle_forcebattle(chat, text.split()[1:])
                     elif text.startswith('/getfighters'):
@@ -222,6 +250,12 @@ class WarBotAdmin(TelegramInterface):
                 log.send_message("[TELEGRAM] WARNING at WarBotAdmin." \
                     + "handle_updates: request not authorized")
                 self.handle_unauthorized(chat)
+
+        # the commands may have left work for the Twitter bot (battles,
+        # announces, schedules...)
+        if self.notifier is not None and any(update['user_id'] == self.auth_id \
+            for update in updates_list):
+            self.notifier.notify()
     
 
     def handle_help(self, chat):
@@ -257,10 +291,15 @@ class WarBotAdmin(TelegramInterface):
             + "/battlefrequency · Returns frequency in which battles will be programmed ⏳\n" \
             + "/setbattlefrequency `[hours] [minutes]` · Configures frequency in which battles will be programmed ➡️⏳\n" \
             + "/stopfrequency · Stop automatic battles 🛑⏳\n" \
+            + "/addschedule `[minutes] [hh:mm-hh:mm] (days)` · Add a recurring schedule: a battle every `minutes` between both hours ➡️📅\n" \
+            + "— `days` · Days of the week, e.g. `mon-fri` or `sat,sun` (every day if blank)\n" \
+            + "/getschedules · Returns the recurring schedules 📅\n" \
+            + "/deleteschedule `[id]` · Delete a recurring schedule 🛑📅\n" \
             + "/forcebattle `(winner) (defeated)` · Force a battle ➡️⚔️\n" \
             + "— `winner` · Fighter that will win the battle\n" \
             + "— `defeated` · Fighter that will lose the battle\n" \
             + "— leave blank to inquire a random battle\n" \
+            + "/forcebattle `[n]` · Force n random battles at once ➡️⚔️\n" \
             + "**Important notice:** _when adding usernames, do not include @_\n" \
             + "\nℹ️ Information and status:\n" \
             + "/getfighters · Returns a complete list of fighters, including their state in the game 👥\n" \
@@ -520,6 +559,95 @@ class WarBotAdmin(TelegramInterface):
         log.send_message("[TELEGRAM] sent WarBotAdmin.handle_stopfrequency")
 
 
+    def handle_addschedule(self, chat, attr):
+        """Handles command /addschedule
+
+        Adds a recurring battle schedule
+
+        Command call
+        ------------
+        This function is called whenever the authorized user sends a message
+        to the Telegram bot of the form:
+
+            /addschedule*
+        
+        Where * is any string. The use of this command is:
+
+            /addschedule [minutes] [hh:mm-hh:mm] (days)
+                - minutes · minutes between battles
+                - hh:mm-hh:mm · first and last hour of the battles
+                - days · days of the week (mon, tue...), comma-separated or
+                  as ranges (mon-fri). Every day if blank
+        """
+
+        rule = self.bot.add_schedule(' '.join(attr))
+        if rule is not None:
+            text = "Schedule added: `{}` · `{}`. ".format(rule.id, rule) \
+                + "Next battle of this schedule: " \
+                + "{:%d/%m/%Y %H:%M}".format(rule.next_after(datetime.now()))
+        else:
+            text = "Not added, wrong format. You must insert the schedule " \
+                + "in the format `minutes hh:mm-hh:mm (days)`, " \
+                + "e.g. `45 10:00-23:00 mon-fri`."
+        self.send_message(text, chat)
+        log.send_message("[TELEGRAM] sent WarBotAdmin.handle_addschedule")
+
+
+    def handle_getschedules(self, chat):
+        """Handles command /getschedules
+
+        Returns the recurring battle schedules, and when each one will fire
+
+        Command call
+        ------------
+        This function is called whenever the authorized user sends a message
+        to the Telegram bot of the form:
+
+            /getschedules*
+        
+        Where * is any string
+        """
+
+        schedules = self.bot.get_schedules()
+        if len(schedules) > 0:
+            text = "Schedules (`id` · `schedule` · next battle):\n"
+            now = datetime.now()
+            for rule in schedules:
+                text += "- `{}` · `{}` · {:%d/%m/%Y %H:%M}\n".format(rule.id, \
+                    rule, rule.next_after(now))
+        else:
+            text = "There are no schedules. Use /addschedule to add one."
+        self.send_message(text, chat)
+        log.send_message("[TELEGRAM] sent WarBotAdmin.handle_getschedules")
+
+
+    def handle_deleteschedule(self, chat, attr):
+        """Handles command /deleteschedule
+
+        Deletes a recurring battle schedule
+
+        Command call
+        ------------
+        This function is called whenever the authorized user sends a message
+        to the Telegram bot of the form:
+
+            /deleteschedule*
+        
+        Where * is any string. The use of this command is:
+
+            /deleteschedule [id]
+                - id · id of the schedule, as in /getschedules
+        """
+
+        if len(attr) > 0 and attr[0].isdigit() \
+            and self.bot.delete_schedule(int(attr[0])):
+            text = "Schedule `{}` has successfully been deleted.".format(attr[0])
+        else:
+            text = "Schedule could not be deleted. Use /getschedules to see the schedules."
+        self.send_message(text, chat)
+        log.send_message("[TELEGRAM] sent WarBotAdmin.handle_deleteschedule")
+
+
     def handle_forcebattle(self, chat, attr):
         """Handles command /forcebattle
         
@@ -537,9 +665,21 @@ class WarBotAdmin(TelegramInterface):
             /forcebattle (winner) (defeated)
                 - if there are not 2 args, it forces a random battle
                 - if both winner and defeated, winner defeats defeated
+            /forcebattle [n]
+                - if n is a number, it forces n random battles at once
         """
 
-        if len(attr) >= 2:
+        if len(attr) == 1 and attr[0].isdigit():
+            battles = self.bot.battle_many(int(attr[0]))
+            if len(battles) > 0:
+                text = str(len(battles)) + " battles executed:\n"
+                for winner, defeated in battles[:self.BATTLES_LISTED]:
+                    text += '- *' + winner + '* has killed *' + defeated + '*\n'
+                if len(battles) > self.BATTLES_LISTED:
+                    text += '- ...'
+            else:
+                text = 'Battles could not be executed.'
+        elif len(attr) >= 2:
             winner = attr[0]
             defeated = attr[1]
             result = self.bot.force_battle(winner, defeated)
@@ -615,21 +755,20 @@ class WarBotAdmin(TelegramInterface):
         """
 
         items = []
-        for fighter in self.bot.get_fighters_extended():
-            items.append(fighter["username"])
 
-        if len(attr) > 0:            
-            if attr[0] in items:
+        if len(attr) > 0:
+            fighter = self.bot.get_fighter(attr[0])
+            if fighter is not None:
                 text = "👤 Fighter: *" + attr[0] + "*\n" \
                     + "\Status: "
-                fighter = next(item for item in self.bot.get_fighters_extended() if item["username"] == attr[0])
                 if fighter["alive"]:
                     text += " alive"
                 else:
                     text += " dead 💀"
                 text += "\nHas killed: "
                 if len(fighter["killed"]) > 0:
-                    text += ', '.join("`" + fighter["killed"] + "`")
+                    text += ', '.join("`" + killed + "`" \
+                        for killed in fighter["killed"])
                 else:
                     text += "no other fighters"
                 text += "\nShow in list: "
@@ -642,6 +781,7 @@ class WarBotAdmin(TelegramInterface):
             self.ask_status = "NONE"
             items = []
         else:
+            items = self.bot.get_fighters()
             text = "Insert the name of the fighter, or use the buttons prompted."
             self.ask_status = "BUTTONS_GETFIGHTER"
 
@@ -709,27 +849,29 @@ class WarBotAdmin(TelegramInterface):
         text = ""
 
         if len(attr) > 0:
-            for username in attr:
-                announce = False
-                if "!" in username:
-                    announce = True
-
-                username = username.replace("!", "")
-
-                result = self.bot.add_fighter(username)
-                if result:
-                    text += "Fighter *" + username + "* has been added. "
-                    if self.bot.get_fighter_announce():
-                        self.bot.add_announce_queue(username)
-                        text += "Will be announced (by default, to deactivate use /stopannouncefighters).\n"
-                    else:
-                        if announce:
+            fighter_announce = self.bot.get_fighter_announce()
+            with self.bot.transaction():
+                for username in attr:
+                    announce = False
+                    if "!" in username:
+                        announce = True
+
+                    username = username.replace("!", "")
+
+                    result = self.bot.add_fighter(username)
+                    if result:
+                        text += "Fighter *" + username + "* has been added. "
+                        if fighter_announce:
                             self.bot.add_announce_queue(username)
-                            text += "Will be announced.\n"
+                            text += "Will be announced (by default, to deactivate use /stopannouncefighters).\n"
                         else:
-                            text += "\n"
-                else:
-                    text += "Fighter *"+username+"* is already on the fighters list.\n"
+                            if announce:
+                                self.bot.add_announce_queue(username)
+                                text += "Will be announced.\n"
+                            else:
+                                text += "\n"
+                    else:
+                        text += "Fighter *"+username+"* is already on the fighters list.\n"
             
             self.ask_status = "NONE"
         else:
@@ -769,12 +911,13 @@ class WarBotAdmin(TelegramInterface):
         text = ""
 
         if len(attr) > 0:
-            for username in attr:
-                result = self.bot.delete_fighter(username)
-                if result:
-                    text += "Fighter *" + username + "* has been deleted.\n"
-                else:
-                    text += "Fighter *" + username + "* not found, therefore cannot be deleted.\n"
+            with self.bot.transaction():
+                for username in attr:
+                    result = self.bot.delete_fighter(username)
+                    if result:
+                        text += "Fighter *" + username + "* has been deleted.\n"
+                    else:
+                        text += "Fighter *" + username + "* not found, therefore cannot be deleted.\n"
 
             self.ask_status = "NONE"
         else:
@@ -808,12 +951,13 @@ class WarBotAdmin(TelegramInterface):
         text = ""
 
         if len(attr) > 0:
-            for username in attr:
-                result = self.bot.add_candidate(username)
-                if result:
-                    text += "Candidate *" + username + "* has been added.\n"
-                else:
-                    text += "Candidate *" + username + "* is already on the candidates list.\n"
+            with self.bot.transaction():
+                for username in attr:
+                    result = self.bot.add_candidate(username)
+                    if result:
+                        text += "Candidate *" + username + "* has been added.\n"
+                    else:
+                        text += "Candidate *" + username + "* is already on the candidates list.\n"
         else:
             text = "You did not insert the candidate to add."
         
@@ -848,12 +992,13 @@ class WarBotAdmin(TelegramInterface):
         text = ""
 
         if len(attr) > 0:
-            for username in attr:
-                result = self.bot.delete_candidate(username)
-                if result:
-                    text += "Candidate *" + username + "* has been deleted.\n"
-                else:
-                    text += "Candidate *" + username + "* not found, therefore cannot be deleted.\n"
+            with self.bot.transaction():
+                for username in attr:
+                    result = self.bot.delete_candidate(username)
+                    if result:
+                        text += "Candidate *" + username + "* has been deleted.\n"
+                    else:
+                        text += "Candidate *" + username + "* not found, therefore cannot be deleted.\n"
 
             self.ask_status = "NONE"
         else:
@@ -889,12 +1034,13 @@ class WarBotAdmin(TelegramInterface):
         text = ""
 
         if len(attr) > 0:
-            for username in attr:
-                result = self.bot.revive_fighter(username)
-                if result:
-                    text = "Fighter *" + username + "* has been revived. 🧟\n"
-                else:
-                    text = "We could not revive *" + username + "*: not found or already alive.\n"
+            with self.bot.transaction():
+                for username in attr:
+                    result = self.bot.revive_fighter(username)
+                    if result:
+                        text += "Fighter *" + username + "* has been revived. 🧟\n"
+                    else:
+                        text += "We could not revive *" + username + "*: not found or already alive.\n"
 
             self.ask_status = "NONE"
         else:
@@ -971,32 +1117,40 @@ class WarBotAdmin(TelegramInterface):
         Where * is any string
         """
 
+        settings = self.bot.get_settings()
+        roster = self.bot.get_roster()
+
         text = "- Number of fighters: "
-        text += str(len(self.bot.get_fighters()))
-        text += " ({} 💀)\n".format(str(len(self.bot.get_dead_fighters())))
+        text += str(roster.count())
+        text += " ({} 💀)\n".format(str(roster.count_dead()))
         text += "- Number of candidates: "
         text += str(len(self.bot.get_candidates()))
         text += "\n- Opt-in: "
-        if self.bot.get_optin_running():
-            text += "activated\n"
+        if settings['optin_running']:
+            # 0 until the Twitter bot runs, which starts polling every
+            # 4 * SLEEP_TIME seconds
+            text += "activated, polling every {} s\n".format( \
+                settings['optin_interval'] or 4 * TWITTER_VARS['SLEEP_TIME'])
         else:
             text += "deactivated\n"
         text += "- Next battle: "
-        if self.bot.get_stop_next_battle():
+        if settings['stop_next_battle']:
             text += "won't be\n"
         else:
-            date = self.bot.get_next_battle()
+            date = settings['next_battle']
             text += "{}/{}/{} {:02d}:{:02d}\n".format(date.day, date.month, date.year, date.hour, date.minute)
         text += "- Battle frequency: "
-        f_h, f_m = self.bot.get_battle_frequency()
-        text += "{} hours {} minutes\n".format(f_h, f_m)
+        text += "{} hours {} minutes\n".format(settings['battle_frequency_hours'], \
+            settings['battle_frequency_minutes'])
         text += "- Frequency active: "
-        if self.bot.get_stop_frequency():
+        if settings['stop_frequency']:
             text += "no\n"
         else:
             text += "yes\n"
+        text += "- Schedules: "
+        text += str(len(settings['schedules'])) + "\n"
         text += "- Fighter announce: "
-        if self.bot.get_fighter_announce():
+        if settings['fighter_announce']:
             text += "automatic\n"
         else:
             text += "manual\n"
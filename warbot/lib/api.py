@@ -20,10 +20,13 @@ __status__      = "Production"
 
 
 
+from avatars import WarBotAvatars
 from database import WarBotDB
-from vars import route, log
+from ratelimit import WarBotRateLimiter
+from vars import log
 
-import tweepy, urllib
+from concurrent.futures import ThreadPoolExecutor
+import mimetypes, os, requests, threading, time, tweepy
 
 
 class WarBotAPI:
@@ -32,8 +35,31 @@ class WarBotAPI:
 
     ...
 
+    Media is uploaded by a pool of `UPLOAD_WORKERS` threads, so a tweet with
+    several images waits for the slowest upload instead of all of them one
+    after another. Files bigger than `CHUNKED_SIZE` are uploaded in chunks of
+    `CHUNK_SIZE` bytes (INIT, APPEND, FINALIZE), which tweepy does not
+    support, through the same OAuth credentials.
+
+    Calls go through a `WarBotRateLimiter`, which keeps them within the rate
+    limits of every endpoint and retries them when they fail for a while.
+    Tweets that still cannot be posted are retried later by `WarBotTwitter`,
+    see its outbox.
+
     Attributes
     ----------
+    UPLOAD_URL : str
+        Endpoint of the chunked uploads
+    UPLOAD_WORKERS : int
+        Uploads run at once
+    MENTIONS_PAGE : int
+        Mentions requested per page, the most Twitter allows
+    MENTIONS_PAGES : int
+        Maximum pages requested by `get_mentions()` at once
+    CHUNKED_SIZE : int
+        Size, in bytes, from which files are uploaded in chunks
+    CHUNK_SIZE : int
+        Size, in bytes, of each chunk
     db : WarBotDB
         WarBot database
     api_auth : tweepy.OAuthHandler
@@ -42,17 +68,34 @@ class WarBotAPI:
         Tweepy interface
     images_route : str
         Folder route to store images
+    limiter : WarBotRateLimiter
+        Keeps the calls within the rate limits
+    avatars : WarBotAvatars
+        Cache of profile pictures
 
     Methods
     -------
-    get_mentions()
-        Gets mentions from Twitter bot's account
-    post_tweet(text, media=None)
+    get_mentions() : list<Status>, int
+        Gets the new mentions of the bot's account, and the last one's id
+    post_tweet(text, media=None, media_ids=None) : int
         Post tweet in bot's timeline
-    download_profilepic(username, filename)
-        Download username's profile picture
+    is_transient(e) : bool
+        Whether the error e may not happen if retried later
+    upload_media(media)
+        Upload media to be tweeted later
+    get_profilepic(username)
+        Get username's profile picture, from cache if possible
+    prefetch_profilepics(usernames)
+        Refresh the cached profile pictures of usernames, in the background
     """
 
+    MENTIONS_PAGE = 200
+    MENTIONS_PAGES = 20
+    UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+    UPLOAD_WORKERS = 4
+    CHUNKED_SIZE = 4 * 1024 * 1024
+    CHUNK_SIZE = 1024 * 1024
+
     def __init__(self, consumer_key, consumer_secret, \
         access_token, access_token_secret, \
         database_route, database_filename, images_route):
@@ -81,30 +124,158 @@ class WarBotAPI:
         self.api_auth.set_access_token(access_token, access_token_secret)
         self.api = tweepy.API(self.api_auth)
         self.images_route = images_route
+        self.limiter = WarBotRateLimiter()
+        # the rate limits are read from the last response of each interface,
+        # so the avatar cache has its own (and one per thread, see
+        # WarBotAvatars)
+        self.avatars = WarBotAvatars(tweepy.API(self.api_auth), self.db, \
+            images_route, self.limiter)
+        self._prefetcher = None
+        self._local = threading.local()
+        self._uploader = ThreadPoolExecutor(max_workers=self.UPLOAD_WORKERS, \
+            thread_name_prefix="warbot-upload")
 
 
     def get_mentions(self):
-        """Gets mentions from Twitter bot's account
+        """Gets the new mentions of the bot's account
+
+        Mentions are requested in pages, from the newest back to the last
+        seen one (with max_id as cursor), until there are no more, so bursts
+        of mentions are not cut to the first page. The last seen id is not
+        updated here: the caller stores it along with the mentions processed,
+        see `WarBot.add_candidates()`.
 
         Returns
         -------
-        list<Status># WIP check if this is the class, or it is not Status
-            List of mentions
+        mentions : list<Status>
+            New mentions, oldest first
+        last_id : int
+            Id of the newest mention, None if there are none or some pages
+            could not be read (they will be requested again)
         """
 
         last_seen_id = self.db.get_last_seen_id()
+        mentions = []
+        max_id = None
         try:
-            mentions = self.api.mentions_timeline(last_seen_id, tweet_mode='extended')
-            if len(mentions) > 0:
-                self.db.update_last_seen(mentions[0].id)
-            
-            return reversed(mentions)
+            for _ in range(self.MENTIONS_PAGES):
+                page = self.limiter.call(self.api, \
+                    'statuses/mentions_timeline', 'mentions_timeline', \
+                    since_id=last_seen_id, max_id=max_id, \
+                    count=self.MENTIONS_PAGE, tweet_mode='extended')
+                if len(page) == 0:
+                    break
+                mentions.extend(page)
+                max_id = page[-1].id - 1
         except Exception as e:
             log.send_message("[TWITTER API] ERROR - at api.mentions_timeline() -> " + str(e))
-            return []
+            return list(reversed(mentions)), None
+
+        if len(mentions) > 0:
+            log.send_message("[TWITTER API] {} mentions read".format( \
+                len(mentions)))
+        return list(reversed(mentions)), \
+            mentions[0].id if len(mentions) > 0 else None
+
+
+    def upload_media(self, media):
+        """Upload media to be tweeted later
+
+        Parameters
+        ----------
+        media : list<str>
+            List of filenames of media
+
+        Return
+        ------
+        list<int>
+            Media ids, valid for a day
+        """
+
+        start = time.time()
+        mids = list(self._uploader.map(self._upload, media))
+        if len(media) > 1:
+            log.send_message("[TWITTER API] {} media uploaded in {:.2f} s" \
+                .format(len(media), time.time() - start))
+        return mids
+
+
+    def _upload(self, filename):
+        start = time.time()
+        size = os.path.getsize(filename)
+        if size > self.CHUNKED_SIZE:
+            media_id = self._upload_chunked(filename, size)
+        else:
+            media_id = self.limiter.call(self._thread_api(), 'media/upload', \
+                'media_upload', filename).media_id
+
+        log.send_message("[TWITTER API] uploaded {} ({} KB) in {:.2f} s" \
+            .format(os.path.basename(filename), size // 1024, \
+            time.time() - start))
+        return media_id
+
+
+    def _thread_api(self):
+        # uploads run in several threads, each one with its own tweepy
+        # interface so the limits are read from the right response
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = tweepy.API(self.api_auth)
+        return api
+
+
+    def _upload_request(self, data, files=None, method='POST'):
+        """Calls media/upload within its rate limit, see `_send_upload()`"""
+
+        return self.limiter.call(self, 'media/upload', '_send_upload', data, \
+            files, method)
+
+
+    def _send_upload(self, data, files=None, method='POST'):
+        if method == 'GET':
+            response = requests.get(self.UPLOAD_URL, params=data, \
+                auth=self.api_auth.apply_auth(), timeout=60)
+        else:
+            response = requests.post(self.UPLOAD_URL, data=data, files=files, \
+                auth=self.api_auth.apply_auth(), timeout=60)
+        if response.status_code >= 400:
+            raise tweepy.TweepError("media/upload " + data['command'] \
+                + " failed: " + response.text, response)
+        self.limiter.update('media/upload', response.headers)
+        return response.json() if response.content else {}
+
 
+    def _upload_chunked(self, filename, size):
+        """Uploads filename in chunks, returns its media id"""
 
-    def post_tweet(self, text, media=None):
+        media_id = self._upload_request({'command': 'INIT', \
+            'total_bytes': size, 'media_type': mimetypes.guess_type(filename)[0], \
+            'media_category': 'tweet_image'})['media_id_string']
+
+        with open(filename, 'rb') as f:
+            segment = 0
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._upload_request({'command': 'APPEND', 'media_id': media_id, \
+                    'segment_index': segment}, files={'media': chunk})
+                segment += 1
+
+        info = self._upload_request({'command': 'FINALIZE', \
+            'media_id': media_id}).get('processing_info')
+        # Twitter may process the media before it can be tweeted
+        while info is not None and info['state'] in ('pending', 'in_progress'):
+            time.sleep(info.get('check_after_secs', 1))
+            info = self._upload_request({'command': 'STATUS', \
+                'media_id': media_id}, method='GET').get('processing_info')
+        if info is not None and info['state'] == 'failed':
+            raise tweepy.TweepError("media/upload failed: " + str(info))
+
+        return int(media_id)
+
+
+    def post_tweet(self, text, media=None, media_ids=None):
         """Post tweet in bot's timeline
 
         Parameters
@@ -113,45 +284,83 @@ class WarBotAPI:
             Text of tweet
         media : list<str>
             List of filenames of media to be tweeted
+        media_ids : list<int>
+            Media already uploaded (see `upload_media()`), media is ignored
+            if given
+
+        Return
+        ------
+        int
+            Id of the tweet
+
+        Raises the error if the tweet could not be posted, see
+        `is_transient()`.
         """
 
-        mids = None
-        if media != None:
-            mids = []
-            for filename in media:
-                res = self.api.media_upload(filename)
-                mids.append(res.media_id)
-        
+        mids = media_ids
+        if mids == None and media != None:
+            mids = self.upload_media(media)
+
         try:
-            self.api.update_status(status=text, media_ids=mids)
+            status = self.limiter.call(self.api, 'statuses/update', \
+                'update_status', status=text, media_ids=mids)
             log.send_message("[TWITTER API] tweet posted")
+            return status.id
         except Exception as e:
             log.send_message("[TWITTER API] ERROR - at api.update_status() -> " + str(e))
+            raise
+
 
+    def is_transient(self, e):
+        """Whether the error e may not happen if retried later, as connection
+        errors, errors 5xx and rate limits, see
+        `WarBotRateLimiter.is_transient()`"""
 
-    def download_profilepic(self, username, filename):
-        """Download username's profile picture
+        return self.limiter.is_transient(e)
+
+
+    def get_profilepic(self, username):
+        """Get username's profile picture, from cache if possible
 
         Parameters
         ----------
         username : str
-            Twitter username whose picture wants to be downloaded
-        filename : str
-            Filename where picture will be saved
+            Twitter username whose picture is wanted
 
         Return
         ------
         Option 1: str
-            File route to the downloaded pic
+            Filename of the picture, relative to images_route. It belongs to
+            the cache and must not be removed
         Option 2: None
-            In case download could not be done
+            In case the picture is not cached and could not be downloaded
         """
 
-        file_download_route = route.paste(self.images_route, filename)
-        try:
-            url = self.api.get_user(screen_name=username).profile_image_url_https.replace('_normal', '')
-            urllib.request.urlretrieve(url, file_download_route)
-            return file_download_route
-        except Exception as e:
-            log.send_message("[TWITTER API] ERROR - at api.get_user -> " + str(e))
-            return None
\ No newline at end of file
+        return self.avatars.get(username)
+
+
+    def prefetch_profilepics(self, usernames):
+        """Refresh the cached profile pictures of usernames, in the background
+
+        Users are looked up in batches (see `WarBotAvatars.prefetch()`), so
+        the pictures are already cached when the tweets are posted. Does
+        nothing if the previous prefetch has not finished yet.
+
+        Parameters
+        ----------
+        usernames : list<str>
+            Twitter usernames whose pictures are wanted
+
+        Return
+        ------
+        bool
+            Whether the prefetch was started
+        """
+
+        if self._prefetcher is not None and self._prefetcher.is_alive():
+            return False
+
+        self._prefetcher = threading.Thread(target=self.avatars.prefetch, \
+            args=(list(usernames),), name="warbot-prefetch", daemon=True)
+        self._prefetcher.start()
+        return True
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotAvatars
+=============
+
+Cache of Twitter profile pictures, kept on disk.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+from vars import route, log
+
+import hashlib, os, tempfile, threading, time, tweepy, urllib.parse, \
+    urllib.request
+
+
+class WarBotAvatars:
+    """
+    Class used to cache profile pictures on disk
+
+    ...
+
+    Pictures are stored in the avatars folder (inside the images folder),
+    named after the Twitter user id and a hash of the picture's URL, and
+    indexed in the avatars table of the database, so the cache survives
+    restarts. A picture changes URL when the user changes it, so a picture
+    file never has to be updated, only replaced.
+
+    A cached picture is used without any network call for `TTL` seconds.
+    After that, the URL is checked against Twitter (one user lookup); the
+    picture is only downloaded again if the URL changed. If Twitter cannot
+    be reached, the cached picture is used anyway.
+
+    When the pictures take more than `MAX_SIZE` bytes, the least recently
+    used are deleted. Only `get()` (a picture rendered) makes a picture
+    recently used; checking its URL does not.
+
+    `prefetch()` checks many users at once, `LOOKUP_SIZE` per user lookup
+    (the most Twitter allows), so the pictures of all the alive fighters can
+    be kept fresh beforehand with a fraction of the requests. Only pictures
+    not checked for `TTL` seconds are checked, and pictures are only
+    downloaded while the cache is under `MAX_SIZE`. Prefetching never
+    evicts pictures: the ones prefetched and not used yet are the first
+    evicted by `get()`.
+
+    Hits, misses, revalidations and evictions are counted since the bot
+    started, and logged after every prefetch and eviction.
+
+    The cache can be used from several threads (e.g. `prefetch()` runs in
+    the background). Every thread calls Twitter with its own tweepy
+    interface, as the rate limits are read from its last response.
+
+    Attributes
+    ----------
+    FOLDER : str
+        Folder of the pictures, inside the images folder
+    TTL : int
+        Seconds a cached picture is used before checking its URL
+    MAX_SIZE : int
+        Maximum size of the pictures on disk, in bytes
+    LOOKUP_SIZE : int
+        Users checked by every request of `prefetch()`
+    api : tweepy.API
+        Tweepy interface, every other thread uses a copy
+    db : WarBotDB
+        WarBot database
+    limiter : WarBotRateLimiter
+        Keeps the calls within the rate limits, None if not limited
+    folder : str
+        Route to the pictures
+    hits : int
+        Pictures found in cache and up to date
+    misses : int
+        Pictures downloaded
+    revalidations : int
+        Pictures whose URL was checked against Twitter
+    evictions : int
+        Pictures deleted to keep the cache under `MAX_SIZE`
+
+    Methods
+    -------
+    get(username) : str
+        Profile picture of username, downloaded if needed
+    store(username, user_id, url, used=None, evict=True) : str
+        Stores the picture at url as username's, unless it is cached already
+    prefetch(usernames) : int
+        Checks and downloads the pictures of usernames that are not fresh
+    evict()
+        Deletes the least recently used pictures while over `MAX_SIZE`
+    stats() : dict
+        Hit, miss, revalidation and eviction counters
+    """
+
+    FOLDER = 'avatars'
+    TTL = 24 * 60 * 60
+    MAX_SIZE = 200 * 1024 * 1024
+    LOOKUP_SIZE = 100
+
+    def __init__(self, api, db, images_route, limiter=None):
+        """
+        Parameters
+        ----------
+        api : tweepy.API
+            Tweepy interface
+        db : WarBotDB
+            WarBot database
+        images_route : str
+            Folder route to store images
+        limiter : WarBotRateLimiter
+            Keeps the calls within the rate limits
+        """
+
+        self.api = api
+        self.db = db
+        self.limiter = limiter
+        self.images_route = images_route
+        self.folder = route.paste(images_route, self.FOLDER)
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._local.api = api
+
+
+    def _cached(self, avatar):
+        return avatar is not None and avatar['filename'] is not None \
+            and os.path.exists(os.path.join(self.folder, avatar['filename']))
+
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+
+    def _call(self, endpoint, method, **kwargs):
+        # a tweepy interface per thread, so calls from different threads do
+        # not overwrite each other's last response
+        api = getattr(self._local, 'api', None)
+        if api is None:
+            api = self._local.api = tweepy.API(self.api.auth)
+
+        if self.limiter is None:
+            return getattr(api, method)(**kwargs)
+        return self.limiter.call(api, endpoint, method, **kwargs)
+
+
+    def _relative(self, filename):
+        # filenames are relative to the images folder, as the image handler
+        # expects them
+        return self.FOLDER + "/" + filename
+
+
+    def get(self, username):
+        """Profile picture of username, downloaded if needed
+
+        Parameters
+        ----------
+        username : str
+            Twitter username
+
+        Return
+        ------
+        Option 1: str
+            Filename of the picture, relative to the images folder
+        Option 2: None
+            If the picture is not cached and could not be downloaded
+        """
+
+        avatar = self.db.get_avatar(username)
+        now = time.time()
+
+        if self._cached(avatar) and now - avatar['checked'] < self.TTL:
+            self._count('hits')
+            self.db.update_avatar(username, used=now)
+            return self._relative(avatar['filename'])
+
+        try:
+            user = self._call('users/show', 'get_user', screen_name=username)
+        except Exception as e:
+            log.send_message("[AVATARS] ERROR - at api.get_user -> " + str(e))
+            if self._cached(avatar):
+                # better an old picture than none
+                self._count('hits')
+                self.db.update_avatar(username, used=now)
+                return self._relative(avatar['filename'])
+            return None
+
+        return self.store(username, user.id_str, \
+            user.profile_image_url_https.replace('_normal', ''), used=now)
+
+
+    def store(self, username, user_id, url, used=None, evict=True):
+        """Stores the picture at url as username's, unless it is cached
+
+        Parameters
+        ----------
+        username : str
+            Twitter username
+        user_id : str
+            Twitter user id
+        url : str
+            URL of the full size picture
+        used : float
+            Time the picture is used at, None if it is not used now (e.g.
+            when prefetched)
+        evict : bool
+            Whether to evict pictures if the cache is over `MAX_SIZE`
+
+        Return
+        ------
+        Option 1: str
+            Filename of the picture, relative to the images folder
+        Option 2: None
+            If the picture could not be downloaded
+        """
+
+        avatar = self.db.get_avatar(username)
+        now = time.time()
+
+        # a picture checked is not a picture used, so the least recently
+        # used order is kept
+        fields = {'used': used} if used is not None else {}
+        if self._cached(avatar) and avatar['url'] == url:
+            self._count('revalidations')
+            self.db.update_avatar(username, user_id=user_id, checked=now, \
+                **fields)
+            return self._relative(avatar['filename'])
+
+        extension = os.path.splitext(urllib.parse.urlparse(url).path)[1]
+        filename = "{}-{}{}".format(user_id, \
+            hashlib.sha1(url.encode('utf-8')).hexdigest()[:16], extension)
+        file_route = os.path.join(self.folder, filename)
+
+        # download to a temporary file of its own, so a failed download never
+        # leaves a broken picture in the cache, and two downloads of the same
+        # picture do not write the same file
+        fd, part_route = tempfile.mkstemp(suffix=".part", dir=self.folder)
+        os.close(fd)
+        try:
+            urllib.request.urlretrieve(url, part_route)
+            os.replace(part_route, file_route)
+        except Exception as e:
+            log.send_message("[AVATARS] ERROR - downloading " + url + " -> " \
+                + str(e))
+            if os.path.exists(part_route):
+                os.remove(part_route)
+            return None
+
+        self._count('misses')
+        if self._cached(avatar) and avatar['filename'] != filename:
+            try:
+                os.remove(os.path.join(self.folder, avatar['filename']))
+            except FileNotFoundError:
+                # removed meanwhile by another thread
+                pass
+        self.db.update_avatar(username, user_id=user_id, url=url, \
+            filename=filename, size=os.path.getsize(file_route), \
+            checked=now, **fields)
+        log.send_message("[AVATARS] Downloaded picture of " + username)
+
+        if evict:
+            self.evict()
+        return self._relative(filename)
+
+
+    def prefetch(self, usernames):
+        """Checks and downloads the pictures of usernames that are not fresh
+
+        Parameters
+        ----------
+        usernames : list<str>
+            Twitter usernames
+
+        Return
+        ------
+        int
+            Number of users checked
+        """
+
+        avatars = self.db.get_avatars()
+        full = False
+        now = time.time()
+        stale = [username for username in usernames \
+            if not (self._cached(avatars.get(username)) \
+                and now - avatars[username]['checked'] < self.TTL)]
+
+        checked = 0
+        for start in range(0, len(stale), self.LOOKUP_SIZE):
+            batch = stale[start:start + self.LOOKUP_SIZE]
+            try:
+                users = self._call('users/lookup', 'lookup_users', \
+                    screen_names=batch)
+            except Exception as e:
+                log.send_message("[AVATARS] ERROR - at api.lookup_users -> " \
+                    + str(e))
+                continue
+
+            # Twitter answers with the usernames as the users write them
+            # suspended or renamed users are missing
+            usernames = {username.lower(): username for username in batch}
+            for user in users:
+                username = usernames.get(user.screen_name.lower())
+                if username is None:
+                    continue
+
+                url = user.profile_image_url_https.replace('_normal', '')
+                avatar = avatars.get(username)
+                if not (self._cached(avatar) and avatar['url'] == url):
+                    # pictures are not evicted to make room for pictures
+                    # that may not be used
+                    full = full or self.db.get_avatars_size() >= self.MAX_SIZE
+                    if full:
+                        continue
+                self.store(username, user.id_str, url, evict=False)
+                checked += 1
+
+        if len(stale) > 0:
+            log.send_message("[AVATARS] Prefetched pictures: " + str(checked) \
+                + " of " + str(len(stale)) + " users checked" \
+                + (", cache is full" if full else ""))
+        self._log_stats()
+        return checked
+
+
+    def evict(self):
+        size = self.db.get_avatars_size()
+        if size <= self.MAX_SIZE:
+            return
+
+        with self.db.batch():
+            for avatar in self.db.get_avatars_by_use():
+                if size <= self.MAX_SIZE:
+                    break
+
+                try:
+                    os.remove(os.path.join(self.folder, avatar['filename']))
+                except FileNotFoundError:
+                    pass
+                self.db.update_avatar(avatar['username'], filename=None, size=0)
+                size -= avatar['size']
+                self._count('evictions')
+
+        log.send_message("[AVATARS] Evicted pictures, cache size is now " \
+            + str(size) + " bytes")
+        self._log_stats()
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, \
+                'revalidations': self.revalidations, \
+                'evictions': self.evictions}
+
+
+    def _log_stats(self):
+        log.send_message("[AVATARS] Cache: " + ", ".join(str(count) + " " \
+            + name for name, count in self.stats().items()))
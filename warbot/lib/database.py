@@ -5,7 +5,7 @@
 WarBotDB
 ========
 
-This module controls the database, in TinyDB.
+This module controls the database, in SQLite.
 
 """
 
@@ -20,11 +20,288 @@ __status__      = "Production"
 
 
 
-from tinydb import TinyDB, Query, where
+from contextlib import contextmanager
 from datetime import datetime
 from vars import log, route
+from roster import WarBotRoster
 
-import os
+import os, json, sqlite3, threading, time
+
+
+class WarBotStorage:
+    """
+    SQLite connection shared by every WarBotDB in the process
+
+    ...
+
+    The Telegram and Twitter bots run in different processes but share the
+    same database file. Each process opens a single connection per file, in
+    WAL mode, so readers never block on the other process' writes.
+
+    In WAL mode every commit is appended to the write-ahead log (the journal)
+    instead of rewriting the database, so its cost depends on the pages that
+    changed, not on the size of the war. With `synchronous=NORMAL` commits
+    are not fsync'ed one by one; the log is synced when it is folded back
+    into the database (a checkpoint). The compactor (see `start_compactor()`)
+    runs checkpoints on a background thread, so they are not run inline by
+    the commits. On startup, SQLite replays the log over the database.
+
+    Results of frequent reads (settings, full lists) can be cached with
+    `cached()`. The cache is dropped after every write done through `write()`
+    and whenever `PRAGMA data_version` reports that another process has
+    committed, so the processes still see each other's writes.
+
+    Structures that are expensive to rebuild (the roster) are kept with
+    `live()` instead: they survive the writes of this process, as the writers
+    update them in place (see `peek()`), and are only dropped when another
+    process commits or a transaction is rolled back.
+
+    Important note
+    --------------
+    Values returned by `cached()` are shared by every reader in the process,
+    so they must not be modified.
+
+    Attributes
+    ----------
+    path : str
+        Route to the SQLite database file
+    connection : sqlite3.Connection
+        Connection to the database, in autocommit mode
+    lock : threading.RLock
+        Serializes the use of the connection
+    generation : int
+        Incremented every time the database changes, by this process or
+        another one
+
+    Methods
+    -------
+    open(path) : WarBotStorage
+        Returns the storage of path for the current process
+    read(sql, parameters=()) : list<sqlite3.Row>
+        Runs a query and returns all rows
+    write()
+        Context manager for a write transaction
+    cached(key, load)
+        Returns load(), cached until the database changes
+    live(key, load)
+        Returns load(), kept until another process changes the database
+    peek(key)
+        Returns the live value of key, None if not loaded
+    invalidate()
+        Drops every cached and live value
+    checkpoint() : tuple
+        Folds the write-ahead log into the database
+    start_compactor(interval=CHECKPOINT_INTERVAL)
+        Runs checkpoints periodically, on a background thread
+    """
+
+    # seconds between checkpoints run by the compactor
+    CHECKPOINT_INTERVAL = 60
+    # size, in bytes, the write-ahead log is truncated to after a checkpoint
+    JOURNAL_SIZE_LIMIT = 4 * 1024 * 1024
+
+    # (route, pid) -> WarBotStorage
+    _storages = {}
+
+    @classmethod
+    def open(cls, path):
+        """Returns the storage of path for the current process
+
+        Parameters
+        ----------
+        path : str
+            Route to the SQLite database file
+        """
+
+        key = (path, os.getpid())
+        if key not in cls._storages:
+            cls._storages[key] = cls(path)
+        return cls._storages[key]
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Route to the SQLite database file
+        """
+
+        self.path = path
+        self.connection = self._connect()
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA foreign_keys=ON')
+        self.lock = threading.RLock()
+        self.generation = 0
+        self._cache = {}
+        self._live = {}
+        self._data_version = None
+        self._compactor = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, \
+            isolation_level=None, check_same_thread=False, \
+            cached_statements=256)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('PRAGMA journal_size_limit={}'.format( \
+            self.JOURNAL_SIZE_LIMIT))
+        return connection
+
+    def _changed(self):
+        self._cache.clear()
+        self.generation += 1
+
+    def _check_version(self):
+        version = self.connection.execute('PRAGMA data_version').fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._live.clear()
+            self._changed()
+
+    def read(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    @contextmanager
+    def write(self):
+        """Context manager for a write transaction
+
+        Yields the connection. Statements run inside the context are committed
+        together when it exits, or rolled back if an exception is raised.
+        Nested contexts join the outermost transaction.
+        """
+
+        with self.lock:
+            if self.connection.in_transaction:
+                yield self.connection
+                return
+
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                # live values must not miss commits from another process
+                self._check_version()
+                yield self.connection
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                self._live.clear()
+                raise
+            else:
+                self.connection.execute('COMMIT')
+            finally:
+                self._changed()
+
+    def checkpoint(self, connection=None):
+        """Folds the write-ahead log into the database
+
+        The checkpoint is passive: it does not wait for readers or writers,
+        whatever cannot be folded now will be in the next checkpoint.
+
+        Parameters
+        ----------
+        connection : sqlite3.Connection
+            Connection to run the checkpoint on, by default the shared one
+
+        Return
+        ------
+        busy : int, log : int, checkpointed : int
+            As returned by `PRAGMA wal_checkpoint`: whether the checkpoint
+            was blocked, frames in the log and frames folded
+        """
+
+        if connection is None:
+            with self.lock:
+                return tuple(self.connection.execute( \
+                    'PRAGMA wal_checkpoint(PASSIVE)').fetchone())
+        return tuple(connection.execute('PRAGMA wal_checkpoint(PASSIVE)') \
+            .fetchone())
+
+    def start_compactor(self, interval=CHECKPOINT_INTERVAL):
+        """Runs checkpoints periodically, on a background thread
+
+        Commits from this process stop triggering checkpoints inline. Only one
+        process (the long-running Twitter bot) should run the compactor; the
+        others keep SQLite's automatic checkpoints as a fallback.
+
+        Parameters
+        ----------
+        interval : int
+            Seconds between checkpoints
+        """
+
+        if self._compactor is not None:
+            return
+
+        with self.lock:
+            self.connection.execute('PRAGMA wal_autocheckpoint=0')
+        self._compactor = threading.Thread(target=self._compact, \
+            args=(interval,), daemon=True)
+        self._compactor.start()
+        log.send_message("[DATABASE] Compactor started")
+
+    def _compact(self, interval):
+        # own connection, so the shared one is not locked while syncing
+        connection = self._connect()
+        while True:
+            time.sleep(interval)
+            try:
+                self.checkpoint(connection)
+            except sqlite3.Error as e:
+                log.send_message("[DATABASE] Checkpoint error -> " + str(e))
+
+    def cached(self, key, load):
+        """Returns load(), cached until the database changes
+
+        Parameters
+        ----------
+        key : str
+            Cache key
+        load : function
+            Function that reads the value from the database
+        """
+
+        with self.lock:
+            # uncommitted changes must not be cached
+            if self.connection.in_transaction:
+                return load()
+
+            self._check_version()
+            if key not in self._cache:
+                self._cache[key] = load()
+            return self._cache[key]
+
+    def live(self, key, load):
+        """Returns load(), kept until another process changes the database
+
+        Unlike `cached()`, the value survives the writes of this process:
+        whoever changes the data it depends on must update it in place, in the
+        same transaction. It is dropped if the transaction is rolled back.
+
+        Parameters
+        ----------
+        key : str
+            Key of the value
+        load : function
+            Function that reads the value from the database
+        """
+
+        with self.lock:
+            if not self.connection.in_transaction:
+                self._check_version()
+            if key not in self._live:
+                self._live[key] = load()
+            return self._live[key]
+
+    def peek(self, key):
+        """Returns the live value of key, None if it is not loaded"""
+
+        return self._live.get(key)
+
+    def invalidate(self):
+        """Drops every cached and live value"""
+
+        with self.lock:
+            self._live.clear()
+            self._changed()
 
 
 class WarBotDB:
@@ -39,70 +316,113 @@ class WarBotDB:
 
 
     - candidates: Table to store candidates
-        {'username': str}
-        - username: username of candidate
+        (id, username)
+        - username: username of candidate, indexed
     - fighters: Table to store fighters
-        {'username': str, 'alive': bool, 'killed': list<str>, 'show': bool}
-        - username: username of user
+        (id, username, alive, show)
+        - username: username of user, indexed
         - alive: is username alive
-        - killed: list of fighters that fighter has killed
         - show: show in battle update list or not
-    - vars: Table to store variables
-        {'varname': str, 'value': _}
-        - varname: name of the variable
-        - value: value of the variable
-        This stores the following variables:
-            - last_seen_id : int
-                Last seen ID for Telegram message reception
-            - optin_running : bool
-                Whether opt-in is active or not
-            - next_battle_year : int
-                Year of next battle
-            - next_battle_month : int
-                Month of next battle
-            - next_battle_day : int
-                Day of next battle
-            - next_battle_hour : int
-                Hour of next battle
-            - next_battle_minute : int
-                Minute of next battle
-            - battle_frequency_hours : int
-                Hours of battle frequency
-            - battle_frequency_minutes : int
-                Minutes of battle frequency
-            - stop_frequency : bool
-                If true, battle frequency is ignored
-            - stop_next_battle : bool
-                If true, no next battle will be programmed
-            - fighter_announce : bool
-                If true, fighters will be announced automatically
-            - announce_queue : list<>
+    - kills: Table to store kills
+        (fighter_id, killed)
+        - fighter_id: id of the fighter who killed
+        - killed: username of the killed fighter
+    - settings: Table with a single row, storing the settings as a JSON
+      document
+        - last_seen_id : int
+            Last seen ID for Telegram message reception
+        - optin_running : bool
+            Whether opt-in is active or not
+        - next_battle : str
+            Date of next battle, in ISO format
+        - battle_frequency_hours : int
+            Hours of battle frequency
+        - battle_frequency_minutes : int
+            Minutes of battle frequency
+        - stop_frequency : bool
+            If true, battle frequency is ignored
+        - stop_next_battle : bool
+            If true, no next battle will be programmed
+        - fighter_announce : bool
+            If true, fighters will be announced automatically
+        - schedules : list<dict>
+            Recurring battle schedules, see `WarBotRule.to_dict()`
+        - optin_interval : int
+            Seconds between mention polls while opt-in is active, set by the
+            Twitter bot (0 until it runs)
+    - avatars: Table to store the profile pictures cached on disk
+        (username, user_id, url, filename, size, checked, used)
+        - username: Twitter username, indexed
+        - user_id: Twitter user id
+        - url: URL of the profile picture
+        - filename: file of the picture, in the avatars folder (NULL if it
+          is not on disk)
+        - size: size of the file, in bytes
+        - checked: when url was last checked against Twitter (timestamp)
+        - used: when the picture was last used (timestamp), indexed
+    - queue_items: Table to store FIFO queues, one row per item
+        (id, queue, item)
+        - id: sequence id, monotonic (never reused)
+        - queue: name of the queue, indexed with id
+        - item: JSON value of the item
+        This stores the following queues:
+            - announce_queue : str
                 Queue for fighter announce
-            - battle_queue : list<> #WIP
-                Queue for battle announce
-            - message_queue : list<>
+            - battle_queue : {'winner': str, 'defeated': str, 'left': int}
+                Queue for battle announce, left is the number of alive
+                fighters after the battle
+            - message_queue : str
                 Queue for Telegram bot feedback
+    - outbox: Table to store the tweets being posted, see `WarBotTwitter`
+        (id, key, kind, data, step, progress, attempts, retry_at, created)
+        - id: sequence id, tweets are posted in this order
+        - key: idempotency key, a tweet is only queued once per key
+        - kind: 'battle', 'newfighter' or 'tweet'
+        - data: JSON document describing the tweet
+        - step: last step completed, 'queued', 'avatars', 'rendered' or
+          'uploaded'
+        - progress: JSON document with the results of the steps completed
+        - attempts: attempts made since the last step completed
+        - retry_at: when to try again (timestamp)
+        - created: when the tweet was queued (timestamp)
+
+    Fighters are returned in the format
+        {'username': str, 'alive': bool, 'killed': list<str>, 'show': bool}
 
     Attributes
     ----------
-    db : TinyDB
-        TinyDB main database
-    db_candidates : TinyDB.table
-        TinyDB database table for candidates
-    db_fighters : TinyDB.table
-        TinyDB database table for fighters
-    db_vars : TinyDB.table
-        TinyDB database table for variables
-    
+    SETTINGS_DEFAULTS : dict
+        Default value of every setting
+    QUEUES : list<str>
+        Name of every queue
+    SCHEMA_VERSION : int
+        Current version of the database schema
+    MIGRATIONS : list<tuple>
+        Migrations to upgrade the database, see `bootstrap()`
+    db_route : str
+        Route to the SQLite database file
+    storage : WarBotStorage
+        Connection to the database, shared within the process
+
     Methods
     -------
     From fighters and candidates tables
+        has_fighter(username) : bool
+            Whether username is a fighter
+        has_candidate(username) : bool
+            Whether username is a candidate
+        get_fighter(username) : dict
+            Gets fighter, None if not present
         insert_fighter(username, alive=True)
             Inserts fighter in database
         insert_candidate(username)
             Inserts candidate in database
+        insert_candidates(usernames) : int
+            Inserts candidates in database at once, returns how many were new
         insert_fighter_kill(username, killed)
             Insert kill in database: username killed killed
+        insert_battle(winner, defeated, show=True)
+            Insert battle in database: winner killed defeated
         change_fighter_alive(username, alive)
             Change username's life status to alive
         change_fighter_show(username, show)
@@ -115,15 +435,55 @@ class WarBotDB:
             Gets all fighters
         get_candidates() : list<str>
             Gets all candidates
-    
-    From vars table
-        setup_vars()
-            Sets up variables from vars table (generates them if not present)
+        get_roster() : WarBotRoster
+            Gets all fighters, in columns
+
+    From avatars table
+        get_avatar(username) : dict
+            Gets the cached picture of username, None if not present
+        update_avatar(username, **fields)
+            Inserts or updates the cached picture of username
+        get_avatars() : dict
+            Gets all cached pictures, by username
+        get_avatars_size() : int
+            Size of the cached pictures on disk, in bytes
+        get_avatars_by_use() : list<dict>
+            Cached pictures on disk, least recently used first
+
+    From outbox table
+        push_outbox(key, kind, data, step='queued', progress=None) : bool
+            Queues a tweet, returns if it was not queued already
+        get_outbox() : list<dict>
+            Gets the tweets being posted, in order
+        get_outbox_retry() : float
+            When the first tweet is retried, None if the outbox is empty
+        update_outbox(id, **fields)
+            Records the progress of a tweet
+        delete_outbox(id)
+            Removes a tweet, once posted or dropped
+
+    From settings and queues tables
+        bootstrap()
+            Creates or upgrades the database, fills in missing settings
+        get_settings() : dict
+            Gets all settings at once
+        update_settings(**fields)
+            Updates one or more settings at once
         For variables:
             get_[name_of_variable]()
                 Returns [name_of_variable]'s value
             update_[name_of_variable]([new_value])
                 Updates [name_of_variable] to [new_value]
+        add_schedule(schedule) : int
+            Adds a battle schedule, returns its id
+        delete_schedule(id) : bool
+            Deletes a battle schedule, returns if it existed
+        push_queue(queue, item) : int
+            Appends item to queue, returns its id
+        read_queue(queue, after_id=0) : list<tuple>
+            Returns (id, item) of the items of queue after after_id
+        consume_queue(queue, up_to_id)
+            Removes the items of queue up to up_to_id, included
         For queues:
             get_[name_of_queue]()
                 Returns queue's list
@@ -133,11 +493,71 @@ class WarBotDB:
                 Appends [item] to queue
             delete_[name_of_queue]()
                 Resets queue to empty list
-    
+
+    batch()
+        Context manager to commit several mutations at once
+    start_compactor()
+        Folds the write-ahead log into the database periodically
+    import_json(json_route)
+        Imports a TinyDB JSON database from previous versions
     restart
         Wipes out all data from database, creates a new one
     """
 
+    SETTINGS_DEFAULTS = {
+        'last_seen_id':             1,
+        'optin_running':            False,
+        'next_battle':              datetime(2000, 12, 19, 0, 0).isoformat(),
+        'battle_frequency_hours':   6,
+        'battle_frequency_minutes': 0,
+        'stop_frequency':           True,
+        'stop_next_battle':         True,
+        'fighter_announce':         False,
+        'schedules':                [],
+        'optin_interval':           0
+    }
+
+    QUEUES = ['announce_queue', 'battle_queue', 'message_queue']
+
+    SCHEMA_VERSION = 3
+
+    # (schema version, method upgrading the database to it), in order
+    MIGRATIONS = [
+        (1, '_migration_1'),
+        (2, '_migration_2'),
+        (3, '_migration_3')
+    ]
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS candidates (
+            id          INTEGER PRIMARY KEY,
+            username    TEXT NOT NULL UNIQUE
+        )""",
+        """CREATE TABLE IF NOT EXISTS fighters (
+            id          INTEGER PRIMARY KEY,
+            username    TEXT NOT NULL UNIQUE,
+            alive       INTEGER NOT NULL DEFAULT 1,
+            show        INTEGER NOT NULL DEFAULT 1
+        )""",
+        """CREATE TABLE IF NOT EXISTS kills (
+            fighter_id  INTEGER NOT NULL
+                REFERENCES fighters (id) ON DELETE CASCADE,
+            killed      TEXT NOT NULL,
+            UNIQUE (fighter_id, killed)
+        )""",
+        """CREATE TABLE IF NOT EXISTS settings (
+            id          INTEGER PRIMARY KEY CHECK (id = 1),
+            document    TEXT NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS queue_items (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            queue       TEXT NOT NULL,
+            item        TEXT NOT NULL
+        )""",
+        """CREATE INDEX IF NOT EXISTS queue_items_queue
+            ON queue_items (queue, id)"""
+    ]
+
     def __init__(self, database_route, database_filename):
         """
         Parameters
@@ -145,59 +565,162 @@ class WarBotDB:
         database_route : str
             Folder route to database file
         database_filename : str
-            Filename of JSON database for TinyDB
+            Filename of SQLite database. If it does not exist and there is a
+            TinyDB database with the same name and .json extension, it will
+            be imported
         """
 
         self.db_route = route.paste(database_route, database_filename)
-        self.db = TinyDB(self.db_route)
-        self.db_candidates = self.db.table('candidates', cache_size=0)
-        self.db_fighters = self.db.table('fighters', cache_size=0)
-        self.db_vars = self.db.table('vars', cache_size=0)
-        self.setup_vars()
+        json_route = os.path.splitext(self.db_route)[0] + '.json'
+
+        self.storage = WarBotStorage.open(self.db_route)
+        self.bootstrap(json_route)
+
+
+    @contextmanager
+    def batch(self):
+        """Context manager to commit several mutations at once
+
+        Every mutation done inside the context, by any WarBotDB of the
+        process, is committed in a single transaction when it exits (or
+        rolled back if an exception is raised).
+
+        Example
+        -------
+            with db.batch():
+                for username in usernames:
+                    db.insert_fighter(username)
+        """
+
+        with self.storage.write():
+            yield self
+
+
+    def start_compactor(self):
+        """Folds the write-ahead log into the database periodically
+
+        See `WarBotStorage.start_compactor()` for more info.
+        """
+
+        self.storage.start_compactor()
+
+
+    def _fighter(self, row, killed):
+        return {'username': row['username'], 'alive': bool(row['alive']), \
+            'killed': killed, 'show': bool(row['show'])}
+
+
+    def has_fighter(self, username):
+        return len(self.storage.read("SELECT 1 FROM fighters " \
+            + "WHERE username = ?", (username,))) > 0
+
+
+    def has_candidate(self, username):
+        return len(self.storage.read("SELECT 1 FROM candidates " \
+            + "WHERE username = ?", (username,))) > 0
+
+
+    def get_fighter(self, username):
+        rows = self.storage.read("SELECT id, username, alive, show " \
+            + "FROM fighters WHERE username = ?", (username,))
+        if len(rows) == 0:
+            return None
+
+        killed = self.storage.read("SELECT killed FROM kills " \
+            + "WHERE fighter_id = ? ORDER BY rowid", (rows[0]['id'],))
+        return self._fighter(rows[0], [row['killed'] for row in killed])
 
 
     def insert_fighter(self, username, alive=True):
-        # Check if fighter is already in the database
-        User = Query()
-        if len(self.db_fighters.search(User.username == username)) > 0:
+        with self.storage.write() as db:
+            inserted = db.execute("INSERT OR IGNORE INTO fighters " \
+                + "(username, alive) VALUES (?, ?)", (username, alive)).rowcount
+            if inserted > 0:
+                self._update_roster('add', username, alive)
+
+            # Delete from candidates
+            self.delete_candidate(username)
+
+        # Check if fighter was already in the database
+        if inserted == 0:
             log.send_message("[DATABASE] Insertion error: fighter " + username + " is already on the database")
         else:
-            new_fighter = {'username': username, 'alive': alive, 'killed': [], 'show': True}
-            self.db_fighters.insert(new_fighter)
             log.send_message("[DATABASE] Insertion: fighter " + username + " added to the database")
 
-        # Delete from candidates
-        self.delete_candidate(username)
-
 
     def insert_candidate(self, username):
-        # Check if candidate is already in the database
-        Candidate = Query()
-        if len(self.db_candidates.search(Candidate.username == username)) > 0:
+        with self.storage.write() as db:
+            inserted = db.execute("INSERT OR IGNORE INTO candidates " \
+                + "(username) VALUES (?)", (username,)).rowcount
+
+        # Check if candidate was already in the database
+        if inserted == 0:
             log.send_message("[DATABASE] Insertion error: Candidate " + username + " is already on the database")
         else:
-            new_candidate = {'username': username}
-            self.db_candidates.insert(new_candidate)
             log.send_message("[DATABASE] Insertion: Candidate " + username + " added to the database")
 
 
+    def insert_candidates(self, usernames):
+        with self.storage.write() as db:
+            inserted = db.executemany("INSERT OR IGNORE INTO candidates " \
+                + "(username) VALUES (?)", [(username,) for username \
+                in usernames]).rowcount
+
+        log.send_message("[DATABASE] Insertion: " + str(inserted) \
+            + " candidates added to the database")
+        return inserted
+
+
     def insert_fighter_kill(self, username, killed):
-        User = Query()
-        new_killed = self.db_fighters.search(User.username == username)
-        if len(new_killed) > 0:
-            new_killed = new_killed[0]['killed']
-        else:
+        with self.storage.write() as db:
+            found = db.execute("SELECT id FROM fighters WHERE username = ?", \
+                (username,)).fetchall()
+            if len(found) > 0:
+                if db.execute("INSERT OR IGNORE INTO kills (fighter_id, " \
+                    + "killed) VALUES (?, ?)", (found[0]['id'], killed)).rowcount > 0:
+                    self._update_roster('add_kill', username, killed)
+
+        if len(found) == 0:
             log.send_message("[DATABASE] Update error: No ocurrences of " + username + " found trying to kill " + killed)
-        if not killed in new_killed:
-            new_killed.append(killed)
-        
-        self.db_fighters.update({'killed': new_killed}, User.username == username)
-        log.send_message("[DATABASE] Update: " + username + " killed " + killed)
+        else:
+            log.send_message("[DATABASE] Update: " + username + " killed " + killed)
+
+
+    def insert_battle(self, winner, defeated, show=True):
+        """Inserts the outcome of a battle: winner killed defeated
+
+        The kill is inserted and defeated dies (and is hidden, if show is
+        False) with two statements, without reading the fighters first.
+
+        Parameters
+        ----------
+        winner : str
+            Username of the winner
+        defeated : str
+            Username of the defeated fighter
+        show : bool
+            Whether defeated stays in battle update lists
+        """
+
+        with self.storage.write() as db:
+            if db.execute("INSERT OR IGNORE INTO kills (fighter_id, killed) " \
+                + "SELECT id, ? FROM fighters WHERE username = ?", \
+                (defeated, winner)).rowcount > 0:
+                self._update_roster('add_kill', winner, defeated)
+            db.execute("UPDATE fighters SET alive = 0, show = show AND ? " \
+                + "WHERE username = ?", (show, defeated))
+            self._update_roster('set_alive', defeated, False)
+            if not show:
+                self._update_roster('set_show', defeated, False)
+
+        log.send_message("[DATABASE] Update: " + winner + " killed " + defeated)
 
 
     def change_fighter_alive(self, username, alive):
-        User = Query()
-        self.db_fighters.update({'alive': alive}, User.username == username)
+        with self.storage.write() as db:
+            db.execute("UPDATE fighters SET alive = ? WHERE username = ?", \
+                (alive, username))
+            self._update_roster('set_alive', username, alive)
         if alive:
             log.send_message("[DATABASE] Update: " + username + " is now alive")
         else:
@@ -205,8 +728,10 @@ class WarBotDB:
 
 
     def change_fighter_show(self, username, show):
-        User = Query()
-        self.db_fighters.update({'show': show}, User.username == username)
+        with self.storage.write() as db:
+            db.execute("UPDATE fighters SET show = ? WHERE username = ?", \
+                (show, username))
+            self._update_roster('set_show', username, show)
         if show:
             log.send_message("[DATABASE] Update: " + username + " is now showed")
         else:
@@ -214,192 +739,624 @@ class WarBotDB:
 
 
     def delete_fighter(self, username):
-        self.db_fighters.remove(where('username') == username)
+        with self.storage.write() as db:
+            db.execute("DELETE FROM fighters WHERE username = ?", (username,))
+            self._update_roster('remove', username)
         log.send_message("[DATABASE] Removed: fighter " + username)
 
 
     def delete_candidate(self, username):
-        self.db_candidates.remove(where('username') == username)
+        with self.storage.write() as db:
+            db.execute("DELETE FROM candidates WHERE username = ?", (username,))
         log.send_message("[DATABASE] Removed: candidate " + username)
 
 
+    def _load_fighters(self):
+        killed = {}
+        for row in self.storage.read("SELECT fighter_id, killed FROM kills " \
+            + "ORDER BY rowid"):
+            killed.setdefault(row['fighter_id'], []).append(row['killed'])
+
+        return [self._fighter(row, killed.get(row['id'], [])) for row in \
+            self.storage.read("SELECT id, username, alive, show FROM fighters " \
+            + "ORDER BY id")]
+
+
+    def _load_candidates(self):
+        return [{'username': row['username']} for row in \
+            self.storage.read("SELECT username FROM candidates ORDER BY id")]
+
+
     def get_fighters(self):
-        return self.db_fighters.all()
+        fighters = self.storage.cached('fighters', self._load_fighters)
+        return [dict(fighter) for fighter in fighters]
 
 
     def get_candidates(self):
-        return self.db_candidates.all()
-
-
-    def setup_vars(self):
-        Vars = Query()
-        if len(self.db_vars.search(Vars.varname == 'last_seen_id')) == 0:
-            self.db_vars.insert({'varname': 'last_seen_id', 'value': 1})
-        if len(self.db_vars.search(Vars.varname == 'optin_running')) == 0:
-            self.db_vars.insert({'varname': 'optin_running', 'value': False})
-        if len(self.db_vars.search(Vars.varname == 'next_battle_year')) == 0:
-            self.db_vars.insert({'varname': 'next_battle_year', 'value': 2000})
-        if len(self.db_vars.search(Vars.varname == 'next_battle_month')) == 0:
-            self.db_vars.insert({'varname': 'next_battle_month', 'value': 12})
-        if len(self.db_vars.search(Vars.varname == 'next_battle_day')) == 0:
-            self.db_vars.insert({'varname': 'next_battle_day', 'value': 19})
-        if len(self.db_vars.search(Vars.varname == 'next_battle_hour')) == 0:
-            self.db_vars.insert({'varname': 'next_battle_hour', 'value': 0})
-        if len(self.db_vars.search(Vars.varname == 'next_battle_minute')) == 0:
-            self.db_vars.insert({'varname': 'next_battle_minute', 'value': 0})
-        if len(self.db_vars.search(Vars.varname == 'battle_frequency_hours')) == 0:
-            self.db_vars.insert({'varname': 'battle_frequency_hours', 'value': 6})
-        if len(self.db_vars.search(Vars.varname == 'battle_frequency_minutes')) == 0:
-            self.db_vars.insert({'varname': 'battle_frequency_minutes', 'value': 0})
-        if len(self.db_vars.search(Vars.varname == 'stop_frequency')) == 0:
-            self.db_vars.insert({'varname': 'stop_frequency', 'value': True})
-        if len(self.db_vars.search(Vars.varname == 'stop_next_battle')) == 0:
-            self.db_vars.insert({'varname': 'stop_next_battle', 'value': True})
-        if len(self.db_vars.search(Vars.varname == 'fighter_announce')) == 0:
-            self.db_vars.insert({'varname': 'fighter_announce', 'value': False})
-        if len(self.db_vars.search(Vars.varname == 'announce_queue')) == 0:
-            self.db_vars.insert({'varname': 'announce_queue', 'value': []})
-        if len(self.db_vars.search(Vars.varname == 'battle_queue')) == 0:
-            self.db_vars.insert({'varname': 'battle_queue', 'value': []})
-        if len(self.db_vars.search(Vars.varname == 'message_queue')) == 0:
-            self.db_vars.insert({'varname': 'message_queue', 'value': []})
-        log.send_message("[DATABASE] Update: done setup_vars")
+        candidates = self.storage.cached('candidates', self._load_candidates)
+        return [dict(candidate) for candidate in candidates]
+
+
+    def _load_roster(self):
+        return WarBotRoster.from_rows( \
+            self.storage.read("SELECT id, username, alive, show FROM fighters " \
+            + "ORDER BY id"), \
+            self.storage.read("SELECT fighter_id, killed FROM kills ORDER BY rowid"))
+
+
+    def _update_roster(self, method, *args):
+        # keep the roster in step with this process' writes, see get_roster()
+        roster = self.storage.peek('roster')
+        if roster is not None:
+            getattr(roster, method)(*args)
+
+
+    def get_roster(self):
+        """Returns all fighters, in columns (see `WarBotRoster`)
+
+        The roster is built once and then updated in place by the mutations of
+        this process, so it is only rebuilt when another process changes the
+        database. It is shared within the process and must not be modified.
+        """
+
+        return self.storage.live('roster', self._load_roster)
+
+
+    def get_avatar(self, username):
+        rows = self.storage.read("SELECT * FROM avatars WHERE username = ?", \
+            (username,))
+        return dict(rows[0]) if len(rows) > 0 else None
+
+
+    def update_avatar(self, username, **fields):
+        """Inserts or updates the cached picture of username
+
+        Parameters
+        ----------
+        username : str
+            Twitter username
+        **fields
+            New values of the columns, see the avatars table
+        """
+
+        with self.storage.write() as db:
+            db.execute("INSERT OR IGNORE INTO avatars (username) VALUES (?)", \
+                (username,))
+            if len(fields) > 0:
+                db.execute("UPDATE avatars SET " + ", ".join(field + " = ?" \
+                    for field in fields) + " WHERE username = ?", \
+                    tuple(fields.values()) + (username,))
+
+
+    def get_avatars(self):
+        """Cached pictures, as a dictionary username -> avatars row"""
+
+        return {row['username']: dict(row) for row in \
+            self.storage.read("SELECT * FROM avatars")}
+
+
+    def get_avatars_size(self):
+        return self.storage.read("SELECT COALESCE(SUM(size), 0) AS size " \
+            + "FROM avatars WHERE filename IS NOT NULL")[0]['size']
+
+
+    def get_avatars_by_use(self):
+        return [dict(row) for row in self.storage.read("SELECT username, " \
+            + "filename, size FROM avatars WHERE filename IS NOT NULL " \
+            + "ORDER BY used")]
+
+
+    def _outbox(self, row):
+        item = dict(row)
+        item['data'] = json.loads(item['data'])
+        item['progress'] = json.loads(item['progress'])
+        return item
+
+
+    def push_outbox(self, key, kind, data, step='queued', progress=None):
+        """Queues a tweet to be posted
+
+        Parameters
+        ----------
+        key : str
+            Idempotency key, the tweet is not queued if there is one with
+            the same key
+        kind : str
+            Kind of tweet, see the outbox table
+        data : dict
+            Description of the tweet
+        step : str
+            Last step completed, if some work was done beforehand
+        progress : dict
+            Results of the steps completed
+
+        Return
+        ------
+        bool
+            Whether the tweet was queued
+        """
+
+        with self.storage.write() as db:
+            return db.execute("INSERT OR IGNORE INTO outbox (key, kind, " \
+                + "data, step, progress, created) VALUES (?, ?, ?, ?, ?, ?)", \
+                (key, kind, json.dumps(data), step, json.dumps(progress or {}), \
+                time.time())).rowcount > 0
+
+
+    def get_outbox(self):
+        return [self._outbox(row) for row in \
+            self.storage.read("SELECT * FROM outbox ORDER BY id")]
+
+
+    def get_outbox_retry(self):
+        rows = self.storage.read("SELECT retry_at FROM outbox ORDER BY id " \
+            + "LIMIT 1")
+        return rows[0]['retry_at'] if len(rows) > 0 else None
+
+
+    def update_outbox(self, id, **fields):
+        """Records the progress of a tweet
+
+        Parameters
+        ----------
+        id : int
+            Sequence id of the tweet
+        **fields
+            New values of the columns, see the outbox table. progress is
+            stored as JSON
+        """
+
+        if 'progress' in fields:
+            fields['progress'] = json.dumps(fields['progress'])
+        with self.storage.write() as db:
+            db.execute("UPDATE outbox SET " + ", ".join(field + " = ?" \
+                for field in fields) + " WHERE id = ?", \
+                tuple(fields.values()) + (id,))
+
+
+    def delete_outbox(self, id):
+        with self.storage.write() as db:
+            db.execute("DELETE FROM outbox WHERE id = ?", (id,))
+
+
+    def bootstrap(self, json_route=None):
+        """Creates or upgrades the database, and fills in missing settings
+
+        The schema version is stored in `PRAGMA user_version`. On a warm
+        start, the version and the settings are fetched in a single read, and
+        nothing is written. Otherwise, the pending migrations (see
+        `MIGRATIONS`) are run and the settings missing in the settings
+        document are set to their defaults, all in a single transaction.
+
+        If the database is created in that transaction and json_route
+        exists, it is imported in the same transaction (see
+        `import_json()`). So when both bots start at once only one of them
+        imports it, and if the import fails nothing is committed and it is
+        tried again on the next start.
+
+        To add a field to the settings, add its default to
+        `SETTINGS_DEFAULTS`. To change the tables, add a migration.
+
+        Parameters
+        ----------
+        json_route : str
+            Route to a TinyDB database to import into a new database
+        """
+
+        version, settings = self._read_bootstrap()
+        if version == self.SCHEMA_VERSION and \
+            all(key in settings for key in self.SETTINGS_DEFAULTS):
+            return
+
+        with self.storage.write() as db:
+            # read again, the other process may have bootstrapped meanwhile
+            version, settings = self._read_bootstrap()
+            # databases from before schema versioning have tables already
+            is_new = version == 0 and len(db.execute("SELECT 1 FROM " \
+                + "sqlite_master WHERE type = 'table'").fetchall()) == 0
+
+            for migration_version, migration in self.MIGRATIONS:
+                if migration_version > version:
+                    getattr(self, migration)(db)
+                    log.send_message("[DATABASE] Update: migrated schema " \
+                        + "to version " + str(migration_version))
+            db.execute("PRAGMA user_version = {:d}".format(self.SCHEMA_VERSION))
+
+            missing = [key for key in self.SETTINGS_DEFAULTS if key not in settings]
+            if len(missing) > 0:
+                settings = dict(self.SETTINGS_DEFAULTS, **settings)
+                db.execute("INSERT OR REPLACE INTO settings (id, document) " \
+                    + "VALUES (1, ?)", (json.dumps(settings),))
+                log.send_message("[DATABASE] Update: settings " \
+                    + ", ".join(missing) + " set to defaults")
+
+            if is_new and json_route is not None and os.path.exists(json_route):
+                self.import_json(json_route)
+
+
+    def _read_bootstrap(self):
+        """Returns the schema version and the settings document, in one read"""
+
+        try:
+            rows = self.storage.read("SELECT user_version, document FROM " \
+                + "pragma_user_version LEFT JOIN settings ON settings.id = 1")
+        except sqlite3.OperationalError:
+            # no settings table, database is empty or too old
+            rows = self.storage.read("SELECT user_version, NULL AS document " \
+                + "FROM pragma_user_version")
+
+        document = rows[0]['document']
+        return rows[0]['user_version'], \
+            json.loads(document) if document is not None else {}
+
+
+    def _migration_1(self, db):
+        """Creates the tables
+
+        Databases created before schema versioning are also upgraded: queues
+        used to be stored as JSON lists, one row per queue.
+        """
+
+        for statement in self.SCHEMA:
+            db.execute(statement)
+
+        if len(db.execute("SELECT 1 FROM sqlite_master WHERE " \
+            + "type = 'table' AND name = 'queues'").fetchall()) > 0:
+            for row in db.execute("SELECT name, items FROM queues").fetchall():
+                self.push_queue_many(row['name'], json.loads(row['items']))
+            db.execute("DROP TABLE queues")
+
+
+    def _migration_2(self, db):
+        """Creates the avatars table"""
+
+        db.execute("""CREATE TABLE IF NOT EXISTS avatars (
+            username    TEXT PRIMARY KEY,
+            user_id     TEXT,
+            url         TEXT,
+            filename    TEXT,
+            size        INTEGER NOT NULL DEFAULT 0,
+            checked     REAL NOT NULL DEFAULT 0,
+            used        REAL NOT NULL DEFAULT 0
+        )""")
+        db.execute("CREATE INDEX IF NOT EXISTS avatars_used ON avatars (used)")
+
+
+    def _migration_3(self, db):
+        """Creates the outbox table
+
+        Tweets queued to be retried by previous versions (in the
+        retry_queue queue) are moved to the outbox.
+        """
+
+        db.execute("""CREATE TABLE IF NOT EXISTS outbox (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            key         TEXT NOT NULL UNIQUE,
+            kind        TEXT NOT NULL,
+            data        TEXT NOT NULL,
+            step        TEXT NOT NULL DEFAULT 'queued',
+            progress    TEXT NOT NULL DEFAULT '{}',
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            retry_at    REAL NOT NULL DEFAULT 0,
+            created     REAL NOT NULL
+        )""")
+
+        for item_id, item in self.read_queue('retry_queue'):
+            self.push_outbox('tweet-' + str(item_id), 'tweet', \
+                {'text': item['text'], 'summary': "deferred tweet"}, \
+                'rendered', {'images': item['media'] or []})
+        db.execute("DELETE FROM queue_items WHERE queue = 'retry_queue'")
+
+
+    def _settings_from_vars(self, rows):
+        """Builds the settings document out of `varname/value` rows
+
+        Before the settings document, settings were stored as rows of the
+        vars table of the TinyDB database.
+
+        Parameters
+        ----------
+        rows : dict
+            {varname: value}
+        """
+
+        settings = dict(self.SETTINGS_DEFAULTS)
+        for key in settings:
+            if key in rows:
+                settings[key] = rows[key]
+        next_battle = ['next_battle_' + field for field in \
+            ('year', 'month', 'day', 'hour', 'minute')]
+        if all(key in rows for key in next_battle):
+            settings['next_battle'] = datetime(*(rows[key] \
+                for key in next_battle)).isoformat()
+        return settings
+
+
+    def import_json(self, json_route):
+        """Imports a TinyDB JSON database from previous versions
+
+        Fighters, candidates, settings and queues are imported in a single
+        transaction, joining the current one if any. Fighters and candidates
+        already present are kept, queue items are always added.
+
+        Parameters
+        ----------
+        json_route : str
+            Route to the JSON database
+        """
+
+        with open(json_route) as f:
+            content = f.read()
+        data = json.loads(content) if content else {}
+
+        rows = {}
+        for row in data.get('vars', {}).values():
+            rows[row['varname']] = row['value']
+        if '1' in data.get('settings', {}):
+            settings = dict(self.SETTINGS_DEFAULTS, **data['settings']['1'])
+        else:
+            settings = self._settings_from_vars(rows)
+
+        with self.storage.write() as db:
+            for candidate in data.get('candidates', {}).values():
+                db.execute("INSERT OR IGNORE INTO candidates (username) " \
+                    + "VALUES (?)", (candidate['username'],))
+            for fighter in data.get('fighters', {}).values():
+                db.execute("INSERT OR IGNORE INTO fighters (username, alive, " \
+                    + "show) VALUES (?, ?, ?)", (fighter['username'], \
+                    fighter['alive'], fighter.get('show', True)))
+                db.executemany("INSERT OR IGNORE INTO kills (fighter_id, " \
+                    + "killed) SELECT id, ? FROM fighters WHERE username = ?", \
+                    [(killed, fighter['username']) for killed in fighter['killed']])
+            db.execute("UPDATE settings SET document = ? WHERE id = 1", \
+                (json.dumps(settings),))
+            for queue in self.QUEUES:
+                if queue in rows:
+                    self.push_queue_many(queue, rows[queue])
+        self.storage.invalidate()
+
+        log.send_message("[DATABASE] Update: imported " + json_route)
+
+
+    def get_settings(self):
+        """Returns all settings, read at once
+
+        Return
+        ------
+        dict
+            Settings, see `SETTINGS_DEFAULTS`. next_battle is a datetime
+        """
+
+        settings = dict(self.storage.cached('settings', lambda: json.loads( \
+            self.storage.read("SELECT document FROM settings WHERE id = 1") \
+            [0]['document'])))
+        settings['next_battle'] = datetime.fromisoformat(settings['next_battle'])
+        return settings
+
+
+    def update_settings(self, **fields):
+        """Updates one or more settings at once
+
+        Parameters
+        ----------
+        **fields
+            New values of the settings, see `SETTINGS_DEFAULTS`. next_battle
+            must be a datetime
+        """
+
+        if 'next_battle' in fields:
+            fields['next_battle'] = fields['next_battle'].replace(second=0, \
+                microsecond=0).isoformat()
+
+        with self.storage.write() as db:
+            document = db.execute("SELECT document FROM settings " \
+                + "WHERE id = 1").fetchone()['document']
+            document = dict(json.loads(document), **fields)
+            db.execute("UPDATE settings SET document = ? WHERE id = 1", \
+                (json.dumps(document),))
 
 
     def update_last_seen(self, last_seen_id):
-        Vars = Query()
-        self.db_vars.update({'value': last_seen_id}, Vars.varname == 'last_seen_id')
+        self.update_settings(last_seen_id=last_seen_id)
         log.send_message("[DATABASE] Update: last_seen_id set to " + str(last_seen_id))
 
     def get_last_seen_id(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'last_seen_id')[0]['value']
+        return self.get_settings()['last_seen_id']
 
     def get_optin_running(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'optin_running')[0]['value']
+        return self.get_settings()['optin_running']
 
     def update_optin_running(self, run):
-        Vars = Query()
-        self.db_vars.update({'value': run}, Vars.varname == 'optin_running')
+        self.update_settings(optin_running=run)
         log.send_message("[DATABASE] Update: optin_running set to " + str(run))
 
     def get_next_battle(self):
-        Vars = Query()
-        year = self.db_vars.search(Vars.varname == 'next_battle_year')[0]['value']
-        month = self.db_vars.search(Vars.varname == 'next_battle_month')[0]['value']
-        day = self.db_vars.search(Vars.varname == 'next_battle_day')[0]['value']
-        hour = self.db_vars.search(Vars.varname == 'next_battle_hour')[0]['value']
-        minute = self.db_vars.search(Vars.varname == 'next_battle_minute')[0]['value']
-        return datetime(year, month, day, hour, minute)
+        return self.get_settings()['next_battle']
 
     def update_next_battle(self, date):
-        Vars = Query()
-        self.db_vars.update({'value': date.year}, Vars.varname == 'next_battle_year')
-        self.db_vars.update({'value': date.month}, Vars.varname == 'next_battle_month')
-        self.db_vars.update({'value': date.day}, Vars.varname == 'next_battle_day')
-        self.db_vars.update({'value': date.hour}, Vars.varname == 'next_battle_hour')
-        self.db_vars.update({'value': date.minute}, Vars.varname == 'next_battle_minute')
+        self.update_settings(next_battle=date)
         log.send_message("[DATABASE] Update: next_battle set to {}/{}/{} {}:{}".format(date.year, date.month, date.day, date.hour, date.minute))
 
     def get_battle_frequency(self):
-        Vars = Query()
-        h = self.db_vars.search(Vars.varname == 'battle_frequency_hours')[0]['value']
-        m = self.db_vars.search(Vars.varname == 'battle_frequency_minutes')[0]['value']
-        return h, m
+        settings = self.get_settings()
+        return settings['battle_frequency_hours'], settings['battle_frequency_minutes']
 
     def update_battle_frequency(self, hours, minutes):
-        Vars = Query()
-        self.db_vars.update({'value': hours}, Vars.varname == 'battle_frequency_hours')
-        self.db_vars.update({'value': minutes}, Vars.varname == 'battle_frequency_minutes')
+        self.update_settings(battle_frequency_hours=int(hours), \
+            battle_frequency_minutes=int(minutes))
 
     def update_stop_frequency(self, set):
-        Vars = Query()
-        self.db_vars.update({'value': set}, Vars.varname == 'stop_frequency')
+        self.update_settings(stop_frequency=set)
 
     def get_stop_frequency(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'stop_frequency')[0]['value']
+        return self.get_settings()['stop_frequency']
 
     def update_stop_next_battle(self, set):
-        Vars = Query()
-        self.db_vars.update({'value': set}, Vars.varname == 'stop_next_battle')
+        self.update_settings(stop_next_battle=set)
 
     def get_stop_next_battle(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'stop_next_battle')[0]['value']
+        return self.get_settings()['stop_next_battle']
 
     def update_fighter_announce(self, set):
-        Vars = Query()
-        self.db_vars.update({'value': set}, Vars.varname == 'fighter_announce')
+        self.update_settings(fighter_announce=set)
 
     def get_fighter_announce(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'fighter_announce')[0]['value']
+        return self.get_settings()['fighter_announce']
+
+    def get_schedules(self):
+        return self.get_settings()['schedules']
+
+    def add_schedule(self, schedule):
+        """Adds a battle schedule
+
+        Parameters
+        ----------
+        schedule : dict
+            Schedule, as in `WarBotRule.to_dict()`. Its id is assigned here
+
+        Return
+        ------
+        int
+            Id of the schedule
+        """
+
+        with self.storage.write():
+            schedules = list(self.get_schedules())
+            schedule = dict(schedule, id=max([s['id'] for s in schedules], \
+                default=0) + 1)
+            schedules.append(schedule)
+            self.update_settings(schedules=schedules)
+        log.send_message("[DATABASE] Update: schedule " + str(schedule['id']) \
+            + " added")
+        return schedule['id']
+
+    def delete_schedule(self, id):
+        with self.storage.write():
+            schedules = self.get_schedules()
+            kept = [s for s in schedules if s['id'] != id]
+            self.update_settings(schedules=kept)
+        log.send_message("[DATABASE] Removed: schedule " + str(id))
+        return len(kept) < len(schedules)
+
+    def push_queue(self, queue, item):
+        """Appends item to queue
+
+        Parameters
+        ----------
+        queue : str
+            Name of the queue
+        item : any JSON serializable value
+            Item to append
+
+        Return
+        ------
+        int
+            Sequence id of the item
+        """
+
+        with self.storage.write() as db:
+            return db.execute("INSERT INTO queue_items (queue, item) " \
+                + "VALUES (?, ?)", (queue, json.dumps(item))).lastrowid
+
+    def push_queue_many(self, queue, items):
+        """Appends all items to queue, in order, at once"""
+
+        with self.storage.write() as db:
+            db.executemany("INSERT INTO queue_items (queue, item) " \
+                + "VALUES (?, ?)", [(queue, json.dumps(item)) for item in items])
+
+    def read_queue(self, queue, after_id=0):
+        """Returns the items of queue, oldest first
+
+        Items are not removed, see `consume_queue()`.
+
+        Parameters
+        ----------
+        queue : str
+            Name of the queue
+        after_id : int
+            Only items with a greater sequence id are returned
+
+        Return
+        ------
+        list<tuple>
+            List of (id, item)
+        """
+
+        return [(row['id'], json.loads(row['item'])) for row in \
+            self.storage.read("SELECT id, item FROM queue_items " \
+            + "WHERE queue = ? AND id > ? ORDER BY id", (queue, after_id))]
+
+    def consume_queue(self, queue, up_to_id):
+        """Removes the items of queue up to up_to_id, included
+
+        Items pushed meanwhile by another process are kept.
+        """
+
+        with self.storage.write() as db:
+            db.execute("DELETE FROM queue_items WHERE queue = ? AND id <= ?", \
+                (queue, up_to_id))
+
+    def _update_queue(self, queue, list):
+        with self.storage.write() as db:
+            db.execute("DELETE FROM queue_items WHERE queue = ?", (queue,))
+            self.push_queue_many(queue, list)
+
+    def _get_queue(self, queue):
+        return [item for _, item in self.read_queue(queue)]
 
     def add_announce_queue(self, username):
-        list = self.get_announce_queue()
-        list.append(username)
-        list.sort
-        self.update_announce_queue(list)
+        self.push_queue('announce_queue', username)
 
     def delete_announce_queue(self):
         self.update_announce_queue([])
 
     def update_announce_queue(self, list):
-        Vars = Query()
-        self.db_vars.update({'value': list}, Vars.varname == 'announce_queue')
+        self._update_queue('announce_queue', list)
 
     def get_announce_queue(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'announce_queue')[0]['value']
+        return self._get_queue('announce_queue')
 
-    def add_battle_queue(self, winner, defeated):
-        list = self.get_battle_queue()
-        list.append({'winner': winner, 'defeated': defeated})
-        #list.sort
-        self.update_battle_queue(list)
+    def add_battle_queue(self, winner, defeated, left):
+        self.push_queue('battle_queue', {'winner': winner, \
+            'defeated': defeated, 'left': left})
 
     def delete_battle_queue(self):
         self.update_battle_queue([])
 
     def update_battle_queue(self, list):
-        Vars = Query()
-        self.db_vars.update({'value': list}, Vars.varname == 'battle_queue')
+        self._update_queue('battle_queue', list)
 
     def get_battle_queue(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'battle_queue')[0]['value']
+        return self._get_queue('battle_queue')
 
     def add_message_queue(self, message):
-        list = self.get_message_queue()
-        list.append(message)
-        self.update_message_queue(list)
+        self.push_queue('message_queue', message)
 
     def delete_message_queue(self):
         self.update_message_queue([])
 
     def update_message_queue(self, list):
-        Vars = Query()
-        self.db_vars.update({'value': list}, Vars.varname == 'message_queue')
+        self._update_queue('message_queue', list)
 
     def get_message_queue(self):
-        Vars = Query()
-        return self.db_vars.search(Vars.varname == 'message_queue')[0]['value']
+        return self._get_queue('message_queue')
 
     def restart(self):
         could_wipe = True
 
         try:
-            os.remove(self.db_route)
-        except:
+            with self.storage.write() as db:
+                db.execute("DELETE FROM kills")
+                db.execute("DELETE FROM fighters")
+                db.execute("DELETE FROM candidates")
+                db.execute("DELETE FROM settings")
+                db.execute("DELETE FROM queue_items")
+                db.execute("DELETE FROM outbox")
+                self.bootstrap()
+            self.storage.invalidate()
+        except sqlite3.Error as e:
+            log.send_message("[DATABASE] Restart error -> " + str(e))
             could_wipe = False
-        
-        if could_wipe:
-            self.db = TinyDB(self.db_route)
-            self.db_candidates = self.db.table('candidates', cache_size=0)
-            self.db_fighters = self.db.table('fighters', cache_size=0)
-            self.db_vars = self.db.table('vars', cache_size=0)
-            self.setup_vars()
-
-        return could_wipe
\ No newline at end of file
+
+        return could_wipe
@@ -24,7 +24,7 @@ __status__      = "Production"
 from PIL import Image, ImageOps, ImageDraw, ImageFont
 import random
 
-from vars import route
+from vars import route, log
 
 
 class WarBotImageHandler:
@@ -35,6 +35,9 @@ class WarBotImageHandler:
 
     Attributes
     ----------
+    SUPERSAMPLING : int
+        Scale the masks are drawn at before being reduced, to smooth their
+        edges
     battlepics : list<dict>
         List of battlepics, dictionaries with the following keys:
             filename :      filename of battlepic's template
@@ -48,6 +51,10 @@ class WarBotImageHandler:
         Filename of alivefighterspic's template
     font_sansserif : str
         Filename of font
+    templates : dict<str,PIL.Image>
+        Templates, decoded once, by filename
+    font : PIL.ImageFont
+        Font of `generate_alive`, loaded once
 
     Methods
     -------
@@ -57,8 +64,20 @@ class WarBotImageHandler:
         Generates new user image
     generate_alive(image, output)
         Generates image with list of users
+
+    Templates and the font are read from disk once, when the handler is
+    created, and every render works on a copy of its template. The masks
+    of the profile pics are also built once for every size.
+
+    Profile pics are resampled only once, straight to the size of their
+    slot. JPEG pictures (most of them) are decoded at a reduced scale when
+    the slot is much smaller than the picture, which saves time and memory.
+    Masks are drawn `SUPERSAMPLING` times larger and then reduced, so the
+    edges of the circles are smooth.
     """
 
+    SUPERSAMPLING = 4
+
     def __init__(self, images_route, resources_route, store_route):
         """
         Parameters
@@ -201,6 +220,86 @@ class WarBotImageHandler:
             'img_offset':   (750,230)
         }
         self.font_sansserif = 'font_sansserif.ttf'
+        self.font_size = 30
+
+        # decode every template once, so renders do not read them from disk
+        self.templates = {}
+        for filename in [self.profile_pic_error, self.alivefighterspic, \
+            self.winneruserpic['filename']] \
+            + [battlepic['filename'] for battlepic in self.battlepics] \
+            + [newfighterpic['filename'] for newfighterpic in self.newfighterpics]:
+            self.templates[filename] = self._load(filename)
+
+        try:
+            self.font = ImageFont.truetype(route.paste(self.resources_route, \
+                self.font_sansserif), self.font_size)
+        except OSError as e:
+            log.send_message("[IMAGEHANDLER] ERROR - loading font " \
+                + self.font_sansserif + ", using default font -> " + str(e))
+            self.font = ImageFont.load_default()
+
+        self._masks = {}
+
+
+    def _load(self, filename):
+        image = Image.open(route.paste(self.resources_route, filename), 'r')
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        image.load()
+        return image
+
+
+    def _template(self, filename):
+        # renders paste on the template, so they get a copy
+        return self.templates[filename].copy()
+
+
+    def _mask(self, size):
+        if size not in self._masks:
+            # draw the circle larger and reduce it, so its edge is smooth
+            large = (size[0]*self.SUPERSAMPLING, size[1]*self.SUPERSAMPLING)
+            mask = Image.new('L', large, 0)
+            draw = ImageDraw.Draw(mask)
+            draw.ellipse((0, 0, large[0]-1, large[1]-1), fill=255)
+            self._masks[size] = mask.resize(size, Image.LANCZOS)
+        return self._masks[size]
+
+
+    def _profilepic(self, image, size):
+        """Profile pic cropped to a circle of the given size
+
+        Parameters
+        ----------
+        image : str or PIL.Image
+            Filename of the profile pic, or the picture itself
+        size : tuple<int>
+            Size of the slot
+
+        Return
+        ------
+        PIL.Image
+            RGBA picture of the given size
+        """
+
+        if isinstance(image, str):
+            with Image.open(route.paste(self.images_route, image), 'r') as source:
+                # JPEG can be decoded at 1/2, 1/4 or 1/8 scale, still
+                # larger than size
+                if source.format == 'JPEG':
+                    source.draft('RGB', size)
+                img = self._fit(source, size)
+        else:
+            img = self._fit(image, size)
+
+        img.putalpha(self._mask(size))
+        return img
+
+
+    def _fit(self, image, size):
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        # crop and resample to size in one step
+        return ImageOps.fit(image, size, Image.LANCZOS, centering=(0.5, 0.5))
 
 
     def generate_battle(self, image1, image2, output):
@@ -230,35 +329,20 @@ class WarBotImageHandler:
         # retrieve a random battlepic from the list of battlepics
         battlepic = random.choice(self.battlepics)
 
-        # create masks for profile pics
-        mask1 = Image.new('L', battlepic['img1_size'], 0)
-        draw1 = ImageDraw.Draw(mask1) 
-        draw1.ellipse((0, 0) + battlepic['img1_size'], fill=255)
-        mask2 = Image.new('L', battlepic['img2_size'], 0)
-        draw2 = ImageDraw.Draw(mask2) 
-        draw2.ellipse((0, 0) + battlepic['img2_size'], fill=255)
-
-        # open profile pics
+        # crop profile pics to mask
         try:
-            img1 = Image.open(route.paste(self.images_route, image1), 'r')
+            img1 = self._profilepic(image1, battlepic['img1_size'])
         except Exception:
-            img1 = Image.open(route.paste(self.resources_route, self.profile_pic_error), 'r')
+            img1 = self._profilepic(self.templates[self.profile_pic_error], \
+                battlepic['img1_size'])
         try:
-            img2 = Image.open(route.paste(self.images_route, image2), 'r')
+            img2 = self._profilepic(image2, battlepic['img2_size'])
         except Exception:
-            img2 = Image.open(route.paste(self.resources_route, self.profile_pic_error), 'r')
-        img1 = img1.resize(battlepic['img1_size'])
-        img2 = img2.resize(battlepic['img2_size'])
-
-        # crop profile pics to mask
-        img1 = ImageOps.fit(img1, mask1.size, centering=(0.5, 0.5))
-        img1.putalpha(mask1)
-        img2 = ImageOps.fit(img2, mask2.size, centering=(0.5, 0.5))
-        img2.putalpha(mask2)
+            img2 = self._profilepic(self.templates[self.profile_pic_error], \
+                battlepic['img2_size'])
 
-        # open battlepic template background
-        background = Image.open(route.paste(self.resources_route, \
-            battlepic['filename']), 'r')
+        # copy battlepic template background
+        background = self._template(battlepic['filename'])
 
         # paste cropped profile pics
         background.paste(img1, battlepic['img1_offset'], img1)
@@ -293,20 +377,11 @@ class WarBotImageHandler:
         # retrieve a random newfighterpic from the list of newfighterpics
         newfighterpic = random.choice(self.newfighterpics)
 
-        # open profile pic
-        mask = Image.new('L', newfighterpic['img_size'], 0)
-        draw = ImageDraw.Draw(mask) 
-        draw.ellipse((0, 0) + newfighterpic['img_size'], fill=255)
-
         # crop profile pic to mask
-        img = Image.open(route.paste(self.images_route, image), 'r')
-        img = img.resize(newfighterpic['img_size'])
-        img = ImageOps.fit(img, mask.size, centering=(0.5, 0.5))
-        img.putalpha(mask)
+        img = self._profilepic(image, newfighterpic['img_size'])
 
-        # open newfighterpic template background
-        background = Image.open(route.paste(self.resources_route, \
-            newfighterpic['filename']), 'r')
+        # copy newfighterpic template background
+        background = self._template(newfighterpic['filename'])
 
         # paste cropped profile pic
         background.paste(img, newfighterpic['img_offset'], img)
@@ -339,11 +414,8 @@ class WarBotImageHandler:
             Absolute route to generated image
         """
 
-        img = Image.open(route.paste(self.resources_route, \
-            self.alivefighterspic), 'r')
+        img = self._template(self.alivefighterspic)
         draw = ImageDraw.Draw(img)
-        font = ImageFont.truetype(route.paste(self.resources_route, \
-            self.font_sansserif), 30)
         text = ""
         for i in range (0,6):
             c = 0
@@ -355,7 +427,7 @@ class WarBotImageHandler:
                             color = (0,0,0)
                         else:
                             color = (170,0,0)
-                        draw.text((70+300*i,240+40*c), text, color, font=font)
+                        draw.text((70+300*i,240+40*c), text, color, font=self.font)
                         c += 1
                     users.pop(0)
         
@@ -384,20 +456,11 @@ class WarBotImageHandler:
             Absolute route to generated image
         """
 
-        # open profile pic
-        mask = Image.new('L', self.winneruserpic['img_size'], 0)
-        draw = ImageDraw.Draw(mask) 
-        draw.ellipse((0, 0) + self.winneruserpic['img_size'], fill=255)
-
         # crop profile pic to mask
-        img = Image.open(route.paste(self.images_route, image), 'r')
-        img = img.resize(self.winneruserpic['img_size'])
-        img = ImageOps.fit(img, mask.size, centering=(0.5, 0.5))
-        img.putalpha(mask)
-
-        # open winneruserpic template background
-        background = Image.open(route.paste(self.resources_route, \
-            self.winneruserpic['filename']), 'r')
+        img = self._profilepic(image, self.winneruserpic['img_size'])
+
+        # copy winneruserpic template background
+        background = self._template(self.winneruserpic['filename'])
 
         # paste cropped profile pic
         background.paste(img, self.winneruserpic['img_offset'], img)
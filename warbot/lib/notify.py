@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotNotifier
+==============
+
+Wakes up a bot process from another one, through a Unix domain socket.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+from vars import log
+
+import os, select, socket, time
+
+
+class WarBotNotifier:
+    """
+    Class used to wake up a process when there is work for it
+
+    ...
+
+    The process that has to be woken up (the Twitter bot) listens on a Unix
+    datagram socket and blocks in `wait()` until a datagram arrives or the
+    timeout expires. The other process (the Telegram bot) calls `notify()`
+    after changing the database, so changes are handled right away instead
+    of on the next poll.
+
+    Notifications carry no data, the database is still the only source of
+    truth: a lost notification only delays the work until the timeout. If
+    Unix sockets are not available, or the socket cannot be bound, `wait()`
+    just sleeps.
+
+    Attributes
+    ----------
+    path : str
+        Route to the socket file
+    listening : bool
+        Whether this process receives the notifications
+
+    Methods
+    -------
+    listen() : bool
+        Starts receiving notifications, returns if it could
+    wait(timeout) : bool
+        Blocks until notified or timeout seconds pass, returns if notified
+    notify()
+        Wakes up the listening process, if any
+    close()
+        Stops receiving notifications
+    """
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path : str
+            Route to the socket file, shared by both processes
+        """
+
+        self.path = path
+        self.listening = False
+        self._socket = None
+        self._sender = None
+
+
+    def listen(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            return False
+
+        try:
+            # left behind by a previous run
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.bind(self.path)
+            self._socket.setblocking(False)
+        except OSError as e:
+            log.send_message("[NOTIFY] Could not listen on " + self.path \
+                + ", polling instead -> " + str(e))
+            self._socket = None
+            return False
+
+        self.listening = True
+        log.send_message("[NOTIFY] Listening on " + self.path)
+        return True
+
+
+    def wait(self, timeout):
+        if not self.listening:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select([self._socket], [], [], timeout)
+        if len(readable) == 0:
+            return False
+
+        # several notifications mean the same: there is work
+        try:
+            while True:
+                self._socket.recv(16)
+        except (BlockingIOError, InterruptedError):
+            pass
+        return True
+
+
+    def notify(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            return
+
+        try:
+            if self._sender is None:
+                self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._sender.setblocking(False)
+            self._sender.sendto(b'!', self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # nobody is listening, the work will be done when it starts
+            pass
+        except BlockingIOError:
+            # the listener has notifications pending already
+            pass
+        except OSError as e:
+            log.send_message("[NOTIFY] Could not notify " + self.path \
+                + " -> " + str(e))
+
+
+    def close(self):
+        if self.listening:
+            self._socket.close()
+            self.listening = False
+            if os.path.exists(self.path):
+                os.remove(self.path)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotRateLimiter
+=================
+
+Keeps the calls to the Twitter API within its rate limits, and retries the
+ones that fail for a while.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+from vars import log
+
+import random, requests, threading, time, tweepy
+
+
+class WarBotRateLimited(Exception):
+    """Raised when an endpoint will not be available for a while
+
+    Attributes
+    ----------
+    endpoint : str
+        Endpoint rate limited
+    retry_at : float
+        Time, as in `time.time()`, the endpoint will be available again
+    """
+
+    def __init__(self, endpoint, retry_at):
+        self.endpoint = endpoint
+        self.retry_at = retry_at
+        Exception.__init__(self, "{} rate limited for {:.0f} s".format( \
+            endpoint, retry_at - time.time()))
+
+
+class WarBotTokenBucket:
+    """
+    Class used to keep the calls to an endpoint within its rate limit
+
+    ...
+
+    Twitter allows `limit` calls to every endpoint in each window of 15
+    minutes, and tells how many are left (`remaining`) and when the window
+    resets in the headers of every response. The bucket holds the calls left:
+    a call takes a token, and the bucket is filled again when the window
+    resets. Until the first response of the endpoint, the limit is unknown
+    and calls are not held back.
+
+    Attributes
+    ----------
+    WINDOW : int
+        Length of a rate limit window, in seconds
+    limit : int
+        Calls allowed in a window, None if unknown
+    remaining : int
+        Calls left in the current window, None if unknown
+    reset : float
+        Time, as in `time.time()`, the window resets at
+    """
+
+    WINDOW = 15 * 60
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset = 0
+
+
+    def update(self, headers):
+        """Updates the bucket out of the x-rate-limit-* headers of a response"""
+
+        if headers is None or 'x-rate-limit-remaining' not in headers:
+            return
+
+        self.limit = int(headers.get('x-rate-limit-limit', self.limit or 0))
+        self.remaining = int(headers['x-rate-limit-remaining'])
+        self.reset = float(headers.get('x-rate-limit-reset', \
+            time.time() + self.WINDOW))
+
+
+    def exhaust(self, headers=None):
+        """Empties the bucket, after Twitter answered that it was empty"""
+
+        self.update(headers)
+        self.remaining = 0
+        if self.reset <= time.time():
+            self.reset = time.time() + self.WINDOW
+
+
+    def delay(self, now=None):
+        """Seconds to wait until a token is available"""
+
+        now = now if now is not None else time.time()
+        if self.reset <= now and self.limit is not None:
+            self.remaining = self.limit
+        if self.remaining is None or self.remaining > 0:
+            return 0
+        return self.reset - now
+
+
+    def take(self):
+        if self.remaining is not None and self.remaining > 0:
+            self.remaining -= 1
+
+
+class WarBotRateLimiter:
+    """
+    Class used to call the Twitter API within its rate limits
+
+    ...
+
+    Every endpoint (e.g. 'statuses/update') has its own `WarBotTokenBucket`.
+    A call to an endpoint whose bucket is empty never waits for it:
+    `WarBotRateLimited` is raised, so the caller can defer the call (e.g.
+    the outbox retries the tweet when the window resets) instead of blocking
+    the bot.
+
+    Calls that fail for a while (connection errors and timeouts, errors 5xx,
+    or a rate limit hit anyway) are retried up to `MAX_RETRIES` times,
+    waiting a random time between 0 and `BACKOFF * 2^attempt` seconds
+    (exponential backoff with full jitter), so retries do not hammer Twitter
+    all at once. Other errors (e.g. a duplicate tweet, or a bad argument or
+    missing file that failed before reaching Twitter) are raised right
+    away.
+
+    Attributes
+    ----------
+    MAX_RETRIES : int
+        Retries of a failed call
+    BACKOFF : float
+        Seconds of the first backoff
+    MAX_BACKOFF : float
+        Maximum seconds of a backoff
+
+    Methods
+    -------
+    call(api, endpoint, method, *args, **kwargs)
+        Calls api.method(*args, **kwargs) within the limits of endpoint
+    delay(endpoint) : float
+        Seconds until endpoint can be called
+    is_transient(e) : bool
+        Whether the error e of a call may not happen if retried later
+    budget(endpoint) : tuple
+        Calls left to endpoint and seconds until they are refilled
+    update(endpoint, headers)
+        Updates the limits of endpoint out of the headers of a response
+    """
+
+    # retries block the caller, longer failures are left to it
+    MAX_RETRIES = 2
+    BACKOFF = 2.0
+    MAX_BACKOFF = 10
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+
+    def _bucket(self, endpoint):
+        if endpoint not in self._buckets:
+            self._buckets[endpoint] = WarBotTokenBucket()
+        return self._buckets[endpoint]
+
+
+    def delay(self, endpoint):
+        with self._lock:
+            return self._bucket(endpoint).delay()
+
+
+    def budget(self, endpoint):
+        """Calls left to endpoint and seconds until they are refilled
+
+        Return
+        ------
+        Option 1: remaining : int, seconds : float
+        Option 2: None
+            If the limits of endpoint are not known yet
+        """
+
+        with self._lock:
+            bucket = self._bucket(endpoint)
+            bucket.delay()
+            if bucket.remaining is None:
+                return None
+            return bucket.remaining, max(0, bucket.reset - time.time())
+
+
+    def update(self, endpoint, headers):
+        """Updates the limits of endpoint out of the headers of a response,
+        for calls that do not go through a tweepy interface"""
+
+        with self._lock:
+            self._bucket(endpoint).update(headers)
+
+
+    def _acquire(self, endpoint):
+        with self._lock:
+            bucket = self._bucket(endpoint)
+            if bucket.delay() > 0:
+                raise WarBotRateLimited(endpoint, bucket.reset)
+            bucket.take()
+
+
+    def is_transient(self, e):
+        """Whether the error e of a call may not happen if retried later
+
+        Rate limits, connection errors and timeouts, and errors 429 and 5xx
+        are transient. e may be raised by tweepy, or by requests.
+        """
+
+        if isinstance(e, (WarBotRateLimited, tweepy.RateLimitError, \
+            requests.ConnectionError, requests.Timeout)):
+            return True
+
+        response = getattr(e, 'response', None)
+        if response is not None:
+            return response.status_code == 429 or response.status_code >= 500
+
+        # tweepy wraps the error of requests when the request could not be
+        # sent, any other error without a response happened before sending it
+        return isinstance(e, tweepy.TweepError) and isinstance(e.__context__, \
+            (requests.ConnectionError, requests.Timeout))
+
+
+    def call(self, api, endpoint, method, *args, **kwargs):
+        """Calls api.method(*args, **kwargs) within the limits of endpoint
+
+        Parameters
+        ----------
+        api : tweepy.API
+            Tweepy interface, its last response tells the limits. Any other
+            object can be used, as long as it raises tweepy or requests
+            errors and calls `update()` with its responses
+        endpoint : str
+            Endpoint called, e.g. 'statuses/update'
+        method : str
+            Name of the method of api
+
+        Return
+        ------
+        The result of the call
+
+        Raises WarBotRateLimited if the endpoint is not available now, or the
+        error of the last attempt.
+        """
+
+        attempt = 0
+        while True:
+            self._acquire(endpoint)
+            try:
+                result = getattr(api, method)(*args, **kwargs)
+            except (tweepy.TweepError, requests.RequestException) as e:
+                response = getattr(e, 'response', None)
+                with self._lock:
+                    if isinstance(e, tweepy.RateLimitError) \
+                        or (response is not None and response.status_code == 429):
+                        self._bucket(endpoint).exhaust(response.headers \
+                            if response is not None else None)
+                    elif response is not None:
+                        self._bucket(endpoint).update(response.headers)
+
+                if not self.is_transient(e) or attempt >= self.MAX_RETRIES:
+                    raise
+                attempt += 1
+                if self.delay(endpoint) == 0:
+                    backoff = random.uniform(0, min(self.MAX_BACKOFF, \
+                        self.BACKOFF * 2**attempt))
+                    log.send_message("[RATE LIMIT] {} failed, retry {} in " \
+                        "{:.1f} s -> {}".format(endpoint, attempt, backoff, e))
+                    time.sleep(backoff)
+                continue
+
+            response = getattr(api, 'last_response', None)
+            if response is not None:
+                with self._lock:
+                    self._bucket(endpoint).update(response.headers)
+            return result
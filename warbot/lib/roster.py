@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotRoster
+============
+
+Compact, columnar representation of the fighters.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+# numeric processing library
+import numpy as np
+from array import array
+import sys
+
+from sampler import WarBotSampler
+
+
+class WarBotRoster:
+    """
+    Class used to store the fighters in columns, by integer id
+
+    ...
+
+    Every fighter gets an integer id, its position in the columns. Usernames
+    are interned, and the state of the fighters is stored in NumPy arrays, so
+    a war with tens of thousands of fighters takes a few bytes per fighter
+    and questions like "which fighters are alive" are answered with
+    vectorized operations instead of iterating over dictionaries.
+
+    Deleted fighters leave a hole in the columns (see `present`), so ids
+    never change while the roster is alive. Killed users that are not
+    fighters (e.g. deleted before the roster was built) also get an id,
+    not present, so every kill edge points to a username.
+
+    Attributes
+    ----------
+    usernames : list<str>
+        Username of each id, kept if deleted
+    ids : dict
+        {username: id}
+    present : numpy.ndarray<bool>
+        Whether the id is a fighter (False if deleted)
+    alive : numpy.ndarray<bool>
+        Whether the fighter is alive
+    show : numpy.ndarray<bool>
+        Whether the fighter is shown in battle update lists (see
+        `fighters()`)
+    kills : numpy.ndarray<int32>
+        Number of fighters killed by the fighter
+    killers : array<int>
+        Kill edge list, id of the fighter who killed
+    victims : array<int>
+        Kill edge list, id of the killed user
+    size : int
+        Number of ids used, including deleted fighters and users killed
+        that are not fighters
+    version : int
+        Number of changes made to the roster, to tell whether something
+        computed out of it is still valid
+
+    The roster also keeps a `WarBotSampler` to draw fighters (see
+    `sampler()`), updated along with the columns.
+
+    Methods
+    -------
+    from_rows(fighters, kills) : WarBotRoster
+        Builds the roster out of database rows
+    add(username, alive=True, show=True) : int
+        Adds a fighter, returns its id
+    remove(username)
+        Removes a fighter
+    set_alive(username, alive)
+        Sets whether the fighter is alive
+    set_show(username, show)
+        Sets whether the fighter is shown
+    add_kill(username, killed)
+        Adds a kill
+    alive_ids() : numpy.ndarray<int>
+        Ids of the alive fighters
+    dead_ids() : numpy.ndarray<int>
+        Ids of the dead fighters
+    to_usernames(ids) : list<str>
+        Usernames of ids
+    killed(username) : list<str>
+        Usernames killed by the fighter, in order
+    fighter(username) : dict
+        The fighter, as `WarBotDB.get_fighter()` returns it
+    fighters() : list<dict>
+        All fighters, as `WarBotDB.get_fighters()` returns them
+    count() : int
+        Number of fighters
+    count_alive() : int
+        Number of alive fighters
+    count_dead() : int
+        Number of dead fighters
+    sampler(killfactor) : WarBotSampler
+        Sampler of alive fighters, weighted by kills
+    """
+
+    def __init__(self, capacity=16):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Initial capacity of the columns, they grow as needed
+        """
+
+        self.usernames = []
+        self.ids = {}
+        self.present = np.zeros(capacity, dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.show = np.zeros(capacity, dtype=bool)
+        self.kills = np.zeros(capacity, dtype=np.int32)
+        self.killers = array('i')
+        self.victims = array('i')
+        self.size = 0
+        self.version = 0
+        self._alive = 0
+        self._sampler = None
+        self._killfactor = None
+
+
+    @classmethod
+    def from_rows(cls, fighters, kills):
+        """Builds the roster out of database rows
+
+        Parameters
+        ----------
+        fighters : list<sqlite3.Row>
+            Rows (id, username, alive, show) of the fighters table
+        kills : list<sqlite3.Row>
+            Rows (fighter_id, killed) of the kills table
+        """
+
+        roster = cls(max(len(fighters), 16))
+        roster.size = len(fighters)
+        roster.present[:roster.size] = True
+
+        by_row_id = {}
+        for i, row in enumerate(fighters):
+            username = sys.intern(row['username'])
+            roster.usernames.append(username)
+            roster.ids[username] = i
+            roster.alive[i] = row['alive']
+            roster.show[i] = row['show']
+            by_row_id[row['id']] = i
+
+        for row in kills:
+            killer = by_row_id[row['fighter_id']]
+            roster.killers.append(killer)
+            roster.victims.append(roster._victim(row['killed']))
+        roster.kills[:roster.size] = np.bincount( \
+            np.array(roster.killers, dtype=np.int32), \
+            minlength=roster.size)[:roster.size]
+        roster._alive = int(np.count_nonzero(roster.alive))
+
+        return roster
+
+
+    def _grow(self):
+        capacity = 2 * len(self.present)
+        for column in ('present', 'alive', 'show', 'kills'):
+            old = getattr(self, column)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, column, new)
+        # rebuilt on demand, with the new capacity
+        self._sampler = None
+
+
+    def add(self, username, alive=True, show=True):
+        if self.size == len(self.present):
+            self._grow()
+
+        i = self.size
+        username = sys.intern(username)
+        self.usernames.append(username)
+        self.ids[username] = i
+        self.present[i] = True
+        self.alive[i] = alive
+        self.show[i] = show
+        self.kills[i] = 0
+        self.size += 1
+        self.version += 1
+        self._alive += bool(alive)
+        self._update_sampler(i)
+        return i
+
+
+    def _victim(self, username):
+        """Id of the killed user username, added if it is not a fighter"""
+
+        i = self.ids.get(username)
+        if i is not None:
+            return i
+
+        if self.size == len(self.present):
+            self._grow()
+        i = self.size
+        self.usernames.append(sys.intern(username))
+        self.size += 1
+        return i
+
+
+    def remove(self, username):
+        i = self.ids.pop(username, None)
+        if i is not None:
+            self.present[i] = False
+            self.version += 1
+            self._set_alive(i, False)
+
+            # the database deletes the kills of a deleted fighter, the kills
+            # of others keep its username
+            killers = np.asarray(self.killers)
+            if self.kills[i] > 0:
+                keep = killers != i
+                self.killers = array('i', killers[keep])
+                self.victims = array('i', np.asarray(self.victims)[keep])
+                self.kills[i] = 0
+
+
+    def _set_alive(self, i, alive):
+        if self.alive[i] != alive:
+            self.alive[i] = alive
+            self.version += 1
+            self._alive += 1 if alive else -1
+            self._update_sampler(i)
+
+
+    def set_alive(self, username, alive):
+        i = self.ids.get(username)
+        if i is not None:
+            self._set_alive(i, bool(alive))
+
+
+    def set_show(self, username, show):
+        i = self.ids.get(username)
+        if i is not None and self.show[i] != show:
+            self.show[i] = show
+            self.version += 1
+
+
+    def add_kill(self, username, killed):
+        """Adds a kill: username killed killed
+
+        Must only be called for new kills, as the database stores each kill
+        once.
+        """
+
+        i = self.ids.get(username)
+        if i is not None:
+            self.killers.append(i)
+            self.victims.append(self._victim(killed))
+            self.kills[i] += 1
+            self.version += 1
+            self._update_sampler(i)
+
+
+    def alive_ids(self):
+        return np.flatnonzero(self.alive[:self.size])
+
+
+    def dead_ids(self):
+        return np.flatnonzero(self.present[:self.size] & \
+            ~self.alive[:self.size])
+
+
+    def to_usernames(self, ids):
+        return [self.usernames[i] for i in ids]
+
+
+    def killed(self, username):
+        i = self.ids.get(username)
+        if i is None:
+            return []
+        victims = np.asarray(self.victims)[np.asarray(self.killers) == i]
+        return self.to_usernames(victims)
+
+
+    def _fighter(self, i, killed):
+        return {'username': self.usernames[i], 'alive': bool(self.alive[i]), \
+            'killed': killed, 'show': bool(self.show[i])}
+
+
+    def fighter(self, username):
+        i = self.ids.get(username)
+        if i is None:
+            return None
+        return self._fighter(i, self.killed(username))
+
+
+    def fighters(self):
+        killed = {}
+        for killer, victim in zip(self.killers, self.victims):
+            killed.setdefault(killer, []).append(self.usernames[victim])
+
+        return [self._fighter(i, killed.get(i, [])) \
+            for i in np.flatnonzero(self.present[:self.size])]
+
+
+    def count(self):
+        return len(self.ids)
+
+
+    def count_alive(self):
+        return self._alive
+
+
+    def count_dead(self):
+        return self.count() - self.count_alive()
+
+
+    def _weight(self, i):
+        if not self.alive[i]:
+            return 0.0
+        return 1 + self._killfactor * float(self.kills[i])
+
+
+    def _update_sampler(self, i):
+        if self._sampler is not None:
+            self._sampler.update(i, self._weight(i))
+
+
+    def sampler(self, killfactor):
+        """Returns the sampler of alive fighters, weighted by kills
+
+        The weight of an alive fighter is `1 + killfactor * kills`, and 0 if
+        it is dead or deleted. The sampler is built once, in O(n), and then
+        updated in O(log n) every time a fighter kills, dies or is revived.
+        Indexes drawn are ids of the roster.
+
+        Parameters
+        ----------
+        killfactor : float
+            See `WarBot.KILLFACTOR`
+        """
+
+        if self._sampler is None or self._killfactor != killfactor:
+            self._killfactor = killfactor
+            self._sampler = WarBotSampler(np.where(self.alive, \
+                1 + killfactor * self.kills, 0.0))
+        return self._sampler
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotSampler
+=============
+
+Weighted random sampling, with weights that change over time.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+import random
+
+
+class WarBotSampler:
+    """
+    Class used to draw weighted random indexes
+
+    ...
+
+    The weights are stored in a Fenwick (binary indexed) tree, so changing a
+    weight and drawing an index both cost O(log n), instead of rebuilding and
+    normalizing the whole weight vector on every draw.
+
+    Indexes with weight 0 are never drawn.
+
+    Attributes
+    ----------
+    weights : list<float>
+        Weight of every index
+    size : int
+        Number of indexes
+
+    Methods
+    -------
+    update(i, weight)
+        Sets the weight of i
+    total() : float
+        Sum of all weights
+    find(x) : int
+        First index whose cumulative weight is greater than x
+    sample() : int
+        Draws an index, None if all weights are 0
+    sample_pair() : int, int
+        Draws two different indexes, without replacement
+    """
+
+    def __init__(self, weights):
+        """
+        Parameters
+        ----------
+        weights : iterable<float>
+            Initial weight of every index
+        """
+
+        self.weights = [float(w) for w in weights]
+        self.size = len(self.weights)
+        self._build()
+
+
+    def _build(self):
+        # tree[i] holds the sum of weights (i - lowbit(i), i], 1-indexed
+        self._tree = [0.0] + self.weights
+        for i in range(1, self.size + 1):
+            j = i + (i & -i)
+            if j <= self.size:
+                self._tree[j] += self._tree[i]
+
+        self._top = 1
+        while 2 * self._top <= self.size:
+            self._top *= 2
+
+
+    def update(self, i, weight):
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+
+        i += 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & -i
+
+
+    def total(self):
+        total = 0.0
+        i = self.size
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+    def find(self, x):
+        position = 0
+        step = self._top
+        while step > 0:
+            following = position + step
+            if following <= self.size and self._tree[following] <= x:
+                position = following
+                x -= self._tree[following]
+            step //= 2
+        return position
+
+
+    def sample(self):
+        while True:
+            total = self.total()
+            if total <= 0:
+                return None
+
+            i = self.find(random.random() * total)
+            if i < self.size and self.weights[i] > 0:
+                return i
+
+            # rounding errors have piled up in the tree, start over
+            self._build()
+
+
+    def sample_pair(self):
+        """Draws two different indexes, without replacement
+
+        The first index is drawn, its weight is set to 0 while the second one
+        is drawn, and then restored. This is the same distribution as
+        `numpy.random.choice(size=2, replace=False, p=...)`.
+
+        Return
+        ------
+        Option 1:
+            first : int, second : int
+        Option 2:
+            None, None
+                If there are less than 2 indexes with weight
+        """
+
+        first = self.sample()
+        if first is None:
+            return None, None
+
+        weight = self.weights[first]
+        self.update(first, 0.0)
+        second = self.sample()
+        self.update(first, weight)
+
+        if second is None:
+            return None, None
+        return first, second
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotScheduler
+===============
+
+Runs events at given dates, kept in a priority queue, and computes the
+dates of recurring battle schedules.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+from vars import log
+
+from datetime import datetime, timedelta
+import heapq, itertools
+
+
+class WarBotScheduler:
+    """
+    Class used to run events at given dates
+
+    ...
+
+    Events are kept in a heap ordered by date, so the next event is found in
+    O(1) and scheduling or running one costs O(log n). The caller sleeps
+    until the next event is due (see `timeout()`) and then runs the due
+    events with `run_pending()`.
+
+    Events that are run late are not lost: an event is run as soon as it is
+    due, even if it is found overdue. Recurring events (with `every`, a fixed
+    interval or a `WarBotRule`) are rescheduled after running, and the
+    catch-up policy decides what happens with the occurrences missed
+    meanwhile (e.g. if the bot was stopped):
+
+        - 'all': every missed occurrence is run, one after another
+        - 'once': missed occurrences are run once, and the event continues
+          at its next date in the future
+        - 'skip': occurrences overdue by more than the grace period are not
+          run, the event continues at its next date in the future
+
+    Attributes
+    ----------
+    CATCH_UP_POLICIES : list<str>
+        Valid catch-up policies
+    catch_up : str
+        Catch-up policy
+    grace : timedelta
+        Maximum delay of an event to be run under the 'skip' policy
+
+    Methods
+    -------
+    schedule(name, when, callback, every=None)
+        Schedules callback at when, replacing the event with the same name
+    cancel(name)
+        Cancels the event
+    get(name) : datetime
+        Date of the event, None if not scheduled
+    next_time() : datetime
+        Date of the next event, None if there are none
+    timeout(limit, now=None) : float
+        Seconds until the next event, at most limit
+    run_pending(now=None) : list<str>
+        Runs the due events, returns their names
+    """
+
+    CATCH_UP_POLICIES = ['all', 'once', 'skip']
+
+    def __init__(self, catch_up='once', grace=timedelta(minutes=5)):
+        """
+        Parameters
+        ----------
+        catch_up : str
+            Catch-up policy, see above
+        grace : timedelta
+            Maximum delay of an event to be run under the 'skip' policy
+        """
+
+        if catch_up not in self.CATCH_UP_POLICIES:
+            raise ValueError("Unknown catch-up policy: " + str(catch_up))
+
+        self.catch_up = catch_up
+        self.grace = grace
+        # (when, sequence, name), entries replaced or cancelled are skipped
+        self._heap = []
+        # name -> (when, sequence, callback, every)
+        self._events = {}
+        self._sequence = itertools.count()
+
+
+    def schedule(self, name, when, callback, every=None):
+        """Schedules callback at when, replacing the event with the same name
+
+        Parameters
+        ----------
+        name : str
+            Name of the event
+        when : datetime
+            Date of the event
+        callback : function
+            Function called as callback(when) when the event is due. If it
+            returns False, a recurring event is not rescheduled
+        every : timedelta or WarBotRule
+            If given, the event is rescheduled every time it runs, after a
+            fixed interval or at the next date of the rule
+        """
+
+        sequence = next(self._sequence)
+        self._events[name] = (when, sequence, callback, every)
+        heapq.heappush(self._heap, (when, sequence, name))
+
+
+    def cancel(self, name):
+        self._events.pop(name, None)
+
+
+    def get(self, name):
+        event = self._events.get(name)
+        return event[0] if event is not None else None
+
+
+    def _is_current(self, entry):
+        event = self._events.get(entry[2])
+        return event is not None and event[1] == entry[1]
+
+
+    def next_time(self):
+        while len(self._heap) > 0 and not self._is_current(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if len(self._heap) > 0 else None
+
+
+    def timeout(self, limit, now=None):
+        """Seconds until the next event, at most limit
+
+        Parameters
+        ----------
+        limit : float
+            Maximum seconds to wait
+        now : datetime
+            Current date, by default `datetime.now()`
+        """
+
+        when = self.next_time()
+        if when is None:
+            return limit
+
+        now = now if now is not None else datetime.now()
+        return max(0, min(limit, (when - now).total_seconds()))
+
+
+    def run_pending(self, now=None):
+        """Runs the due events, in order
+
+        Parameters
+        ----------
+        now : datetime
+            Current date, by default `datetime.now()`
+
+        Return
+        ------
+        list<str>
+            Names of the events run
+        """
+
+        now = now if now is not None else datetime.now()
+        ran = []
+
+        while self.next_time() is not None and self.next_time() <= now:
+            entry = heapq.heappop(self._heap)
+            when, _, name = entry
+            _, _, callback, every = self._events[name]
+
+            if self.catch_up == 'skip' and now - when > self.grace:
+                log.send_message("[SCHEDULER] Skipped overdue event " + name \
+                    + " of " + str(when))
+                result = None
+            else:
+                result = callback(when)
+                ran.append(name)
+
+            # the callback may have rescheduled or cancelled the event
+            if not self._is_current(entry):
+                continue
+            del self._events[name]
+            if every is None or result is False:
+                continue
+
+            if isinstance(every, timedelta):
+                when += every
+                if self.catch_up != 'all' and when <= now:
+                    when += every * ((now - when) // every + 1)
+            else:
+                when = every.next_after(when if self.catch_up == 'all' else now)
+            if when is not None:
+                self.schedule(name, when, callback, every)
+
+        return ran
+
+
+class WarBotRule:
+    """
+    Class used to represent a recurring battle schedule
+
+    ...
+
+    A rule fires every `every` minutes between `start` and `end` (both
+    included), on the given days of the week. For instance, the rule
+
+        45 10:00-23:00 mon-fri
+
+    fires at 10:00, 10:45, 11:30... until 22:45, from Monday to Friday. A
+    schedule like "every 45 minutes between 10:00 and 23:00, faster on
+    weekends" is expressed with two rules:
+
+        45 10:00-23:00 mon-fri
+        30 10:00-23:00 sat-sun
+
+    Rules are stored in the settings as dictionaries (see `to_dict()`).
+
+    Attributes
+    ----------
+    DAYS : list<str>
+        Names of the days of the week, as in `datetime.weekday()`
+    id : int
+        Identifier of the rule
+    every : int
+        Minutes between battles
+    start : datetime.time
+        First battle of the day
+    end : datetime.time
+        No battles after this time
+    days : list<int>
+        Days of the week, Monday is 0
+
+    Methods
+    -------
+    parse(text, id=None) : WarBotRule
+        Parses a rule of the form "minutes hh:mm-hh:mm (days)"
+    from_dict(d) : WarBotRule
+        Builds the rule out of its stored form
+    to_dict() : dict
+        Stored form of the rule
+    next_after(date) : datetime
+        Next date the rule fires at, after date
+    """
+
+    DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+    def __init__(self, id, every, start, end, days):
+        """
+        Parameters
+        ----------
+        id : int
+            Identifier of the rule
+        every : int
+            Minutes between battles, must be positive
+        start : datetime.time
+            First battle of the day
+        end : datetime.time
+            No battles after this time, must not be before start
+        days : list<int>
+            Days of the week, Monday is 0
+        """
+
+        if every <= 0 or end < start or len(days) == 0:
+            raise ValueError("Invalid schedule rule")
+
+        self.id = id
+        self.every = every
+        self.start = start
+        self.end = end
+        self.days = sorted(set(days))
+
+
+    @classmethod
+    def _parse_days(cls, text):
+        days = []
+        for part in text.lower().split(','):
+            if part in ('all', 'everyday'):
+                days.extend(range(7))
+            elif '-' in part:
+                first, last = (cls.DAYS.index(day) for day in part.split('-'))
+                days.extend(range(first, last + 1) if first <= last else \
+                    list(range(first, 7)) + list(range(0, last + 1)))
+            else:
+                days.append(cls.DAYS.index(part))
+        return days
+
+
+    @classmethod
+    def parse(cls, text, id=None):
+        """Parses a rule of the form "minutes hh:mm-hh:mm (days)"
+
+        days is a comma-separated list of days (mon, tue...) or ranges
+        (mon-fri), every day if omitted.
+
+        Raises ValueError if text is not a valid rule.
+        """
+
+        fields = text.split()
+        if len(fields) not in (2, 3):
+            raise ValueError("Invalid schedule rule: " + text)
+
+        start, end = (datetime.strptime(t, '%H:%M').time() \
+            for t in fields[1].split('-'))
+        days = cls._parse_days(fields[2]) if len(fields) == 3 \
+            else list(range(7))
+        return cls(id, int(fields[0]), start, end, days)
+
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['id'], d['every'], \
+            datetime.strptime(d['start'], '%H:%M').time(), \
+            datetime.strptime(d['end'], '%H:%M').time(), d['days'])
+
+
+    def to_dict(self):
+        return {'id': self.id, 'every': self.every, \
+            'start': self.start.strftime('%H:%M'), \
+            'end': self.end.strftime('%H:%M'), 'days': self.days}
+
+
+    def __str__(self):
+        if len(self.days) == 7:
+            days = 'all'
+        else:
+            days = ','.join(self.DAYS[day] for day in self.days)
+        return "{} {}-{} {}".format(self.every, self.start.strftime('%H:%M'), \
+            self.end.strftime('%H:%M'), days)
+
+
+    def next_after(self, date):
+        """Next date the rule fires at, strictly after date"""
+
+        every = timedelta(minutes=self.every)
+        for offset in range(8):
+            day = date.date() + timedelta(days=offset)
+            if day.weekday() not in self.days:
+                continue
+
+            first = datetime.combine(day, self.start)
+            if date < first:
+                return first
+            when = first + every * ((date - first) // every + 1)
+            if when <= datetime.combine(day, self.end):
+                return when
+        return None
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+WarBotSimulator
+===============
+
+Monte Carlo simulation of complete wars, run offline.
+
+Usage
+-----
+From the current roster (the database configured in `vars.py`):
+
+    python warbot/lib/simulator.py --wars 5000
+
+From a synthetic roster of 2000 fighters, with another KILLFACTOR:
+
+    python warbot/lib/simulator.py --fighters 2000 --killfactor 0.3
+
+Run `python warbot/lib/simulator.py --help` for every option.
+
+"""
+
+__author__      = "Miguel Ángel Fernández Gutiérrez (@mianfg)"
+__copyright__   = "Copyright 2019, Bloomgogo"
+__credits__     = ["Miguel Ángel Fernández Gutiérrez"]
+__license__     = "GPL"
+__version__     = "1.0"
+__mantainer__   = "Miguel Ángel Fernández Gutiérrez"
+__email__       = "mianfg@bloomgogo.com"
+__status__      = "Production"
+
+
+
+# application imports
+from database import WarBotDB
+from sampler import WarBotSampler
+from warbot import WarBot
+
+from datetime import timedelta
+from multiprocessing import Pool
+# numeric processing library
+import numpy as np
+import argparse, os, random, time
+
+
+def _simulate_wars(task):
+    """Simulates wars, run by the workers of the pool
+
+    Parameters
+    ----------
+    task : tuple
+        (kills, killfactor, wars, seed), see `WarBotSimulator.simulate()`
+
+    Return
+    ------
+    winners : list<int>, winner_kills : list<int>
+        Index and kills during the war of the winner of every war
+    """
+
+    kills, killfactor, wars, seed = task
+    random.seed(seed)
+
+    winners = []
+    winner_kills = []
+    for _ in range(wars):
+        war_kills = [0] * len(kills)
+        sampler = WarBotSampler(1 + killfactor * kills)
+        winner = 0 if len(kills) == 1 else None
+
+        # every battle kills a fighter, the last winner is the survivor
+        for _ in range(len(kills) - 1):
+            winner, defeated = sampler.sample_pair()
+            sampler.update(defeated, 0.0)
+            war_kills[winner] += 1
+            sampler.update(winner, 1 + killfactor \
+                * (kills[winner] + war_kills[winner]))
+
+        winners.append(winner)
+        winner_kills.append(war_kills[winner])
+
+    return winners, winner_kills
+
+
+class WarBotSimulator:
+    """
+    Class used to simulate complete wars
+
+    ...
+
+    Battles are drawn as in `WarBot.get_random_fighters()`: each battle picks
+    the winner and the defeated among the alive fighters, with probability
+    `1 + KILLFACTOR * kills`, so the simulation answers how concentrated the
+    winner distribution is for a given KILLFACTOR. Every battle kills a
+    fighter, so a war of n fighters lasts n - 1 battles.
+
+    Wars are split in chunks, simulated in parallel by a pool of processes.
+
+    Attributes
+    ----------
+    usernames : list<str>
+        Usernames of the alive fighters
+    kills : numpy.ndarray<int>
+        Kills of the alive fighters before the simulated wars
+    killfactor : float
+        See `WarBot.KILLFACTOR`
+
+    Methods
+    -------
+    from_database(database_route, database_filename, killfactor) : WarBotSimulator
+        Simulator for the alive fighters in the database
+    synthetic(fighters, killfactor) : WarBotSimulator
+        Simulator for fighters that have not fought yet
+    simulate(wars, processes=None, seed=None) : dict
+        Simulates wars, returns the results
+    """
+
+    # wars simulated by a worker at once
+    CHUNK_SIZE = 50
+
+    def __init__(self, usernames, kills, killfactor=WarBot.KILLFACTOR):
+        """
+        Parameters
+        ----------
+        usernames : list<str>
+            Usernames of the alive fighters
+        kills : list<int>
+            Kills of the alive fighters
+        killfactor : float
+            See `WarBot.KILLFACTOR`
+        """
+
+        self.usernames = list(usernames)
+        self.kills = np.asarray(kills, dtype=np.int64)
+        self.killfactor = killfactor
+
+
+    @classmethod
+    def from_database(cls, database_route, database_filename, \
+        killfactor=WarBot.KILLFACTOR):
+        """Simulator for the alive fighters in the database"""
+
+        roster = WarBotDB(database_route, database_filename).get_roster()
+        alive = roster.alive_ids()
+        return cls(roster.to_usernames(alive), roster.kills[alive], killfactor)
+
+
+    @classmethod
+    def synthetic(cls, fighters, killfactor=WarBot.KILLFACTOR):
+        """Simulator for fighters that have not fought yet"""
+
+        return cls(["fighter" + str(i) for i in range(fighters)], \
+            [0] * fighters, killfactor)
+
+
+    def simulate(self, wars, processes=None, seed=None):
+        """Simulates wars
+
+        Parameters
+        ----------
+        wars : int
+            Number of wars to simulate
+        processes : int
+            Processes of the pool, by default the number of CPUs. If 1, wars
+            are simulated in this process
+        seed : int
+            Seed for the random draws, for reproducible results
+
+        Return
+        ------
+        dict
+            - wars : int
+                Number of wars simulated, 0 if there are no fighters
+            - battles : int
+                Battles every war lasts
+            - winner_kills : numpy.ndarray<int>
+                Kills of the winner during each war
+            - win_probability : numpy.ndarray<float>
+                Probability of winning the war of every fighter, in the
+                order of `usernames`
+            - seconds : float
+                Time spent simulating
+        """
+
+        if seed is None:
+            seed = random.randrange(2**32)
+        tasks = [(self.kills, self.killfactor, \
+            min(self.CHUNK_SIZE, wars - start), seed + start) \
+            for start in range(0, wars, self.CHUNK_SIZE)] \
+            if len(self.kills) > 0 else []
+
+        start = time.time()
+        if processes == 1:
+            results = list(map(_simulate_wars, tasks))
+        else:
+            with Pool(processes) as pool:
+                results = pool.map(_simulate_wars, tasks)
+        seconds = time.time() - start
+
+        winners = np.concatenate([np.asarray(r[0], dtype=np.int64) \
+            for r in results]) if results else np.zeros(0, dtype=np.int64)
+        winner_kills = np.concatenate([np.asarray(r[1], dtype=np.int64) \
+            for r in results]) if results else np.zeros(0, dtype=np.int64)
+
+        return {
+            'wars':             wars if len(tasks) > 0 else 0,
+            'battles':          max(len(self.kills) - 1, 0),
+            'winner_kills':     winner_kills,
+            'win_probability':  np.bincount(winners, \
+                minlength=len(self.kills)) / max(wars, 1),
+            'seconds':          seconds
+        }
+
+
+def report(simulator, results, frequency, top):
+    """Prints the results of `WarBotSimulator.simulate()`
+
+    Parameters
+    ----------
+    simulator : WarBotSimulator
+    results : dict
+    frequency : timedelta
+        Time between battles
+    top : int
+        Number of fighters listed by win probability
+    """
+
+    winner_kills = results['winner_kills']
+    probability = results['win_probability']
+
+    print("Wars simulated: {} ({} fighters, KILLFACTOR {}) in {:.2f} s".format( \
+        results['wars'], len(simulator.kills), simulator.killfactor, \
+        results['seconds']))
+    print("War duration: {} battles, {} at one battle every {}".format( \
+        results['battles'], results['battles'] * frequency, frequency))
+
+    if len(winner_kills) > 0:
+        print("Winner kills during the war: mean {:.2f}, max {}".format( \
+            winner_kills.mean(), winner_kills.max()))
+        print("    percentiles 5/25/50/75/95: " + " / ".join(str(p) for p in \
+            np.percentile(winner_kills, [5, 25, 50, 75, 95])))
+        histogram = np.bincount(winner_kills)
+        for kills in np.flatnonzero(histogram):
+            print("    {:>4} kills: {:6.2%}".format(kills, \
+                histogram[kills] / len(winner_kills)))
+
+    # effective number of fighters that can win, 1/sum(p^2)
+    concentration = (probability**2).sum()
+    if concentration > 0:
+        print("Effective number of contenders: {:.1f}".format(1 / concentration))
+    print("Most likely winners:")
+    for i in np.argsort(-probability, kind='stable')[:top]:
+        print("    @{}: {:.2%} ({} kills)".format(simulator.usernames[i], \
+            probability[i], simulator.kills[i]))
+
+
+def benchmark(simulator, wars, seed):
+    """Prints the time spent simulating with one and with all processes"""
+
+    for processes in (1, os.cpu_count()):
+        results = simulator.simulate(wars, processes, seed)
+        print("{} process(es): {} wars in {:.2f} s, {:.0f} battles/s".format( \
+            processes, wars, results['seconds'], wars * results['battles'] \
+            / max(results['seconds'], 1e-9)))
+
+
+if __name__ == '__main__':
+    from vars import ROUTES, FILENAMES
+
+    parser = argparse.ArgumentParser(description="Simulates complete wars")
+    parser.add_argument('--wars', type=int, default=1000, \
+        help="number of wars to simulate")
+    parser.add_argument('--fighters', type=int, \
+        help="simulate a synthetic roster instead of the database's one")
+    parser.add_argument('--killfactor', type=float, default=WarBot.KILLFACTOR, \
+        help="KILLFACTOR to simulate")
+    parser.add_argument('--frequency', type=int, \
+        help="minutes between battles, by default the configured frequency")
+    parser.add_argument('--processes', type=int, \
+        help="processes of the pool, by default the number of CPUs")
+    parser.add_argument('--seed', type=int, help="seed for the random draws")
+    parser.add_argument('--top', type=int, default=10, \
+        help="number of fighters listed by win probability")
+    parser.add_argument('--benchmark', action='store_true', \
+        help="compare the time spent with one and with all processes")
+    args = parser.parse_args()
+
+    frequency = None
+    if args.fighters is not None:
+        simulator = WarBotSimulator.synthetic(args.fighters, args.killfactor)
+    else:
+        simulator = WarBotSimulator.from_database(ROUTES['DATABASE'], \
+            FILENAMES['DATABASE'], args.killfactor)
+        hours, minutes = WarBotDB(ROUTES['DATABASE'], \
+            FILENAMES['DATABASE']).get_battle_frequency()
+        frequency = timedelta(hours=hours, minutes=minutes)
+
+    if args.frequency is not None:
+        frequency = timedelta(minutes=args.frequency)
+    elif frequency is None:
+        frequency = timedelta(hours=6)
+
+    if args.benchmark:
+        benchmark(simulator, args.wars, args.seed)
+    else:
+        report(simulator, simulator.simulate(args.wars, args.processes, \
+            args.seed), frequency, args.top)
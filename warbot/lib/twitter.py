@@ -24,7 +24,9 @@ from warbot import WarBot
 from api import WarBotAPI
 from database import WarBotDB
 from imagehandler import WarBotImageHandler
-from vars import log
+from notify import WarBotNotifier
+from scheduler import WarBotScheduler, WarBotRule
+from vars import log, route
 
 import time, random, os
 from datetime import datetime, timedelta
@@ -38,6 +40,22 @@ class WarBotTwitter:
 
     Attributes
     ----------
+    IDLE_TIME : int
+        Sleep time, in seconds, while the admin can wake up the bot
+    PREFETCH_TIME : int
+        Seconds between refreshes of the alive fighters' profile pictures
+    PREPARE_TIME : int
+        Seconds before a scheduled battle its tweet is prepared
+    RETRY_DELAY : int
+        Seconds before retrying a tweet that failed, doubled every attempt
+    MAX_ATTEMPTS : int
+        Attempts to complete a step of a tweet before dropping it
+    MEDIA_TTL : int
+        Seconds uploaded media can be tweeted, it is uploaded again after
+    OPTIN_MAX_TIME : int
+        Maximum seconds between mention polls
+    OPTIN_BACKOFF : float
+        Factor the time between mention polls grows by when there are none
     api : WarBotAPI
         Interact with Twitter API
     bot : WarBot
@@ -45,20 +63,59 @@ class WarBotTwitter:
     sleep_time : int
         Sleep time for Twitter API
     sleep_time_optin : int
-        Sleep time for Twitter API if opt-in activated
+        Sleep time for Twitter API if opt-in activated, when it starts
+    optin_interval : float
+        Current sleep time if opt-in activated, see `optin()`
     imgh : WarBotImageHandler
         Generates images
+    scheduler : WarBotScheduler
+        Runs the scheduled battles
+    notifier : WarBotNotifier
+        Wakes up the bot when the admin changes something, None if disabled
+    preupload : bool
+        Whether the media of prepared battles is uploaded beforehand
+    discarded_uploads : int
+        Media uploaded beforehand and never tweeted, as its battle was drawn
+        again
     
     Methods
     -------
+    battle(when)
+        Runs a scheduled battle
+    prepare_battle()
+        Draws and renders the next scheduled battle beforehand
+    sync_schedule()
+        Schedules the next battle and the recurring schedules as stored in
+        the settings
+    save_schedule()
+        Stores the next battle in the settings
+    sleep(seconds)
+        Waits for seconds, the next battle or a notification of the admin
+    queue_tweets()
+        Moves the battles and new fighters queued by the bot to the outbox
+    send_tweets() : int
+        Posts the tweets of the outbox, in order
+    render_battle(winner, defeated, left, fighters, alivelist=None,
+        avatars=None) : list<str>
+        Renders the images of a battle tweet
 
     """
 
+    IDLE_TIME = 60
+    PREFETCH_TIME = 60 * 60
+    PREPARE_TIME = 5 * 60
+    RETRY_DELAY = 60
+    MAX_ATTEMPTS = 10
+    MEDIA_TTL = 23 * 60 * 60
+    OPTIN_MAX_TIME = 10 * 60
+    OPTIN_BACKOFF = 2
+
     def __init__(self, consumer_key, consumer_secret, \
         access_token, access_token_secret, twitter_sleep_time, \
         database_route, database_filename, \
         phrases_route, phrases_filename, \
-        ih_images_route, ih_resources_route, ih_store_route):
+        ih_images_route, ih_resources_route, ih_store_route, \
+        catch_up='once', notify_filename=None, preupload=False):
         """
         Parameters
         ----------
@@ -90,6 +147,16 @@ class WarBotTwitter:
         ih_store_route : str
             Folder route to store images generated by WarBotImageHandler.
                 To avoid bugs, must be absolute path
+        catch_up : str
+            What to do with battles missed while the bot was not running, see
+            `WarBotScheduler`
+        notify_filename : str
+            Filename of the socket, in the database folder, the Telegram bot
+            wakes up this bot through. If None, this bot polls every
+            `twitter_sleep_time` seconds
+        preupload : bool
+            Whether the media of the next battle is uploaded when it is
+            prepared (see `prepare_battle()`), instead of when it is posted
         """
 
         self.api = WarBotAPI(consumer_key, consumer_secret, \
@@ -97,148 +164,535 @@ class WarBotTwitter:
             database_route, database_filename, ih_images_route)
         self.bot = WarBot(database_route, database_filename, \
             phrases_route, phrases_filename)
+        self.bot.start_compactor()
         self.sleep_time = twitter_sleep_time
         self.sleep_time_optin = twitter_sleep_time * 4
+        self.optin_interval = self.sleep_time_optin
+        self._next_optin = 0
         self.imgh = WarBotImageHandler(ih_images_route, ih_resources_route, \
             ih_store_route)
+        self.scheduler = WarBotScheduler(catch_up)
+        self._schedule = None
+        self._rules = []
+        self._prefetched = 0
+        self.preupload = preupload
+        # battle prepared for the next scheduled date, and the one to post
+        self._prepared = None
+        self._ready = None
+        self.discarded_uploads = 0
+
+        self.notifier = None
+        if notify_filename is not None:
+            self.notifier = WarBotNotifier(route.paste(database_route, \
+                notify_filename))
+            self.notifier.listen()
+
 
+    def battle(self, when):
+        """Runs a scheduled battle
 
-    def battle(self):
-        """Execute battle, as in /forcebattle
+        Called by the scheduler when the battle is due. Rescheduling it by the
+        battle frequency is done by the scheduler.
 
-        Executes battle, randomly
+        Parameters
+        ----------
+        when : datetime
+            Date the battle was scheduled at
+
+        Return
+        ------
+        bool
+            False if the battle could not be executed, which stops the
+            programmed battles
         """
 
-        winner, defeated = self.bot.battle()
+        log.send_message("[TWITTER] Ran scheduled battle of " + str(when))
+        prepared, self._prepared = self._prepared, None
+        if self._is_valid(prepared) and prepared['when'] == when:
+            pairs = prepared['pairs']
+            w, d = next(iter(pairs)) if len(pairs) == 1 else (None, None)
+            # with two fighters left, the winner is drawn now
+            if w is None or not self.bot.force_battle(w, d):
+                w, d = self.bot.battle()
+            self._ready = pairs.pop((w, d), None)
+            self._discard(pairs.values())
+        else:
+            self._discard(prepared['pairs'].values() if prepared else [])
+            w, d = self.bot.battle()
+        if w == None or d == None:
+            self.bot.add_message_queue("⚠️ Scheduled battle could " \
+            + "not be executed. Stopping programmed battles.")
+            self.bot.set_stop_frequency(True)
+            return False
 
-        self.bot.add_battle_queue(winner, defeated)
+        self.bot.add_message_queue("🛎️ A programmed battle " \
+            + "has been executed: *{}* ".format(w) \
+            + "has killed *{}*.".format(d))
+        return True
 
-        if self.bot.get_stop_frequency():
-            self.bot.set_stop_next_battle(True)
+
+    def _state(self, roster):
+        # what the draw depends on: the alive fighters and their kills
+        alive = roster.alive_ids()
+        return tuple(roster.to_usernames(alive)), roster.kills[alive].tobytes()
+
+
+    def _is_valid(self, prepared):
+        """Whether the draw of prepared is still valid
+
+        The draw is only valid if no alive fighter changed since it was made.
+        The roster is rebuilt whenever the other process commits anything
+        (e.g. a setting), so a rebuilt roster is compared by content.
+        """
+
+        if prepared is None:
+            return False
+
+        roster = self.bot.get_roster()
+        if roster is prepared['roster'] and roster.version == prepared['version']:
+            return True
+        if self._state(roster) != prepared['state']:
+            return False
+
+        # same fighters, the next check is quick again
+        prepared['roster'], prepared['version'] = roster, roster.version
+        return True
+
+
+    def _discard(self, rendered):
+        for battle in rendered:
+            for image in battle['images']:
+                if os.path.exists(image):
+                    os.remove(image)
+            if battle['media_ids'] is not None:
+                # Twitter drops media never tweeted by itself
+                self.discarded_uploads += len(battle['media_ids'])
+                log.send_message("[TWITTER] Discarded prepared battle " \
+                    + "{} vs {}, media {} not tweeted ({} discarded so far)" \
+                    .format(*battle['pair'], battle['media_ids'], \
+                    self.discarded_uploads))
+
+
+    def prepare_battle(self):
+        """Draws and renders the next scheduled battle beforehand
+
+        When the next battle is due in less than `PREPARE_TIME` seconds, its
+        fighters are drawn and its images rendered (and uploaded, if
+        `preupload`), so the tweet is posted right at the scheduled time.
+        With two fighters left, both outcomes are rendered and the winner is
+        drawn at the scheduled time.
+
+        The draw is dropped, and made again, if any fighter changes before
+        the battle, so it is drawn with the same probabilities as at the
+        scheduled time.
+        """
+
+        when = self.scheduler.next_time()
+        if when is None or when - datetime.now() \
+            > timedelta(seconds=self.PREPARE_TIME):
+            return
+        if self._is_valid(self._prepared) and self._prepared['when'] == when:
+            return
+
+        if self._prepared is not None:
+            self._discard(self._prepared['pairs'].values())
+            self._prepared = None
+
+        roster = self.bot.get_roster()
+        version = roster.version
+        alive = roster.count_alive()
+        if alive < 2:
+            return
+        if alive == 2:
+            w, d = roster.to_usernames(roster.alive_ids())
+            pairs = [(w, d), (d, w)]
         else:
-            self.bot.set_stop_next_battle(False)
+            pairs = [self.bot.get_random_fighters()]
+
+        rendered = {}
+        for w, d in pairs:
+            images = self.render_battle(w, d, alive - 1, \
+                self.bot.preview_battle(w, d))
+            media_ids, uploaded_at = None, None
+            if self.preupload:
+                try:
+                    media_ids = self.api.upload_media(images)
+                    uploaded_at = time.time()
+                except Exception as e:
+                    log.send_message("[TWITTER] Media could not be " \
+                        + "uploaded beforehand -> " + str(e))
+            rendered[(w, d)] = {'pair': (w, d), 'left': alive - 1, \
+                'images': images, 'media_ids': media_ids, 'uploaded_at': uploaded_at}
+
+        self._prepared = {'when': when, 'roster': roster, 'version': version, \
+            'state': self._state(roster), 'pairs': rendered}
+        log.send_message("[TWITTER] Prepared battle of " + str(when))
+
+
+    def sync_schedule(self):
+        """Schedules the next battle and the recurring schedules as stored
+        in the settings
+
+        The settings are changed by the admin; the events are only
+        rescheduled when the settings related to them change. Every schedule
+        (see `WarBotRule`) is an event of the scheduler, so finding the next
+        battle does not go through the rules.
+        """
+
+        settings = self.bot.get_settings()
+        every = None
+        if not settings['stop_frequency']:
+            every = timedelta(hours=int(settings['battle_frequency_hours']), \
+                minutes=int(settings['battle_frequency_minutes']))
+            if every <= timedelta(0):
+                every = None
+        schedule = (settings['stop_next_battle'], settings['next_battle'], every)
+
+        if schedule != self._schedule:
+            self._schedule = schedule
+            if settings['stop_next_battle']:
+                self.scheduler.cancel('battle')
+            else:
+                self.scheduler.schedule('battle', settings['next_battle'], \
+                    self.battle, every)
 
-            newnextbattle = self.bot.get_next_battle()
-            h, m = self.bot.get_battle_frequency()
-            newnextbattle += timedelta(hours=h, minutes=m)
+        if settings['schedules'] != self._rules:
+            for rule in self._rules:
+                self.scheduler.cancel('schedule-' + str(rule['id']))
+            self._rules = settings['schedules']
 
-            self.bot.set_next_battle(newnextbattle)
+            now = datetime.now()
+            for rule in map(WarBotRule.from_dict, self._rules):
+                when = rule.next_after(now)
+                if when is not None:
+                    self.scheduler.schedule('schedule-' + str(rule.id), when, \
+                        self.battle, rule)
+
+
+    def save_schedule(self):
+        """Stores the next battle in the settings, after the scheduler ran it"""
+
+        when = self.scheduler.get('battle')
+        if when is None:
+            self.bot.set_stop_next_battle(True)
+        else:
+            log.send_message("[TWITTER] New schedule set due " \
+                + "to schedule frequency")
+            self.bot.update_settings(next_battle=when, stop_next_battle=False)
+        self.sync_schedule()
 
      
+    def sleep(self, seconds):
+        """Waits for seconds, the next battle, the next retry of a tweet or
+        a notification of the admin, whatever comes first
+        """
+
+        # the tweets wait for the first one of the outbox, see send_tweets()
+        retry_at = self.bot.get_outbox_retry()
+        if retry_at is not None and retry_at > time.time():
+            seconds = min(seconds, retry_at - time.time())
+
+        # wake up to prepare the next battle too
+        when = self.scheduler.next_time()
+        if when is not None and (self._prepared is None \
+            or self._prepared['when'] != when):
+            prepare = (when - datetime.now()).total_seconds() \
+                - self.PREPARE_TIME
+            if prepare > 0:
+                seconds = min(seconds, prepare)
+
+        if self.notifier is not None:
+            self.notifier.wait(self.scheduler.timeout(seconds))
+        else:
+            time.sleep(self.scheduler.timeout(seconds))
+
+
     def optin(self):
         """Executes opt-in functionality
+
+        Adds the users who mentioned the bot as candidates, and adapts the
+        time until the next poll (`optin_interval`): it is halved, down to
+        `sleep_time`, when there were mentions, and grows by `OPTIN_BACKOFF`,
+        up to `OPTIN_MAX_TIME`, when there were none. It is never shorter than
+        what the calls left to the endpoint allow until they are refilled. The
+        interval is stored in the settings, to be shown by /status.
         """
 
+        mentions = []
         try:
-            mentions = self.api.get_mentions()
-            
-            for mention in mentions:
-                username = mention.user.screen_name
-                self.bot.add_candidate(username)
+            mentions, last_id = self.api.get_mentions()
+            added = self.bot.add_candidates([mention.user.screen_name \
+                for mention in mentions], last_id)
 
-            log.send_message("[TWITTER] Mentions caught")
+            log.send_message("[TWITTER] Mentions caught: {} new candidates" \
+                .format(len(added)))
         except Exception as e:
             log.send_message("[TWITTER] Mentions could not be caught -> " + str(e))
 
+        if len(mentions) > 0:
+            interval = max(self.sleep_time, self.optin_interval / 2)
+        else:
+            interval = min(self.OPTIN_MAX_TIME, \
+                self.optin_interval * self.OPTIN_BACKOFF)
 
-    def send_battle(self, winner, defeated, alivelist):
-        """Send battle message to Twitter
+        # spread the calls left over the rest of the window, a poll takes a
+        # call per page of mentions
+        budget = self.api.limiter.budget('statuses/mentions_timeline')
+        if budget is not None:
+            remaining, seconds = budget
+            calls = len(mentions) // self.api.MENTIONS_PAGE + 1
+            interval = max(interval, seconds * calls / max(remaining, 1))
 
-        Sends battle message, including images
+        self.optin_interval = interval
+        if int(interval) != self.bot.get_settings()['optin_interval']:
+            self.bot.update_settings(optin_interval=int(interval))
 
-        Parameters
-        ----------
-        winner : str
-            Winner fighter's username
-        defeated : str
-            Defeated fighter's username
-        alivelist : list<str>
-            Alive fighters' list
+
+    def queue_tweets(self):
+        """Moves the battles and new fighters queued by the bot to the outbox
+
+        Each item is moved in a single transaction, so it is neither lost nor
+        queued twice if the bot stops meanwhile. The text of the tweet is
+        decided here, so a tweet retried is the same tweet.
         """
 
-        # generate filenames
-        img1 = winner + "_profilepic.png"
-        img1_route = self.api.download_profilepic(winner, img1)
-        img2 = defeated + "_profilepic.png"
-        img2_route = self.api.download_profilepic(defeated, img2)
-        out = "battle-"+winner+"_"+defeated+".png"
-        out_route = self.imgh.generate_battle(img1, img2, out)
+        announced = set() # for security
+        announce = self.bot.get_fighter_announce()
+        for item_id, fighter in self.bot.read_queue('announce_queue'):
+            with self.bot.transaction():
+                # new fighters are only announced if enabled by the admin
+                if announce and fighter not in announced:
+                    self.bot.push_outbox('newfighter-' + str(item_id), \
+                        'newfighter', {'username': fighter, \
+                        'text': "We have a new fighter! " \
+                            + "@{}, welcome to the battle!".format(fighter), \
+                        'summary': "new fighter *{}*".format(fighter)})
+                    announced.add(fighter)
+                self.bot.consume_queue('announce_queue', item_id)
+
+        for item_id, battle in self.bot.read_queue('battle_queue'):
+            winner, defeated = battle['winner'], battle['defeated']
+
+            # generate text, with the fighters left after this battle (items
+            # queued before it was recorded use the current count)
+            left = battle.get('left', self.bot.count_alive_fighters())
+            if left == 1:
+                left_text = "¡@{} has won the war! 🏆".format(winner)
+            else:
+                left_text = "{} fighters left".format(left)
+            if left == 2:
+                left_text += ". Who will win the war? 🤔 Do your bets!"
+
+            data = {'winner': winner, 'defeated': defeated, 'left': left, \
+                'alivelist': left < self.bot.show_threshold, \
+                'text': self.bot.generate_battle_text(winner, defeated) \
+                    + " " + left_text, \
+                'summary': "*{}* has killed *{}*.".format(winner, defeated)}
+
+            # use the images prepared beforehand, if this is the battle prepared
+            step, progress = 'queued', {}
+            ready, self._ready = self._ready, None
+            if ready is not None and ready['pair'] == (winner, defeated) \
+                and ready['left'] == left:
+                step, progress = 'rendered', {'images': ready['images']}
+                if ready['media_ids'] is not None:
+                    step = 'uploaded'
+                    progress['media_ids'] = ready['media_ids']
+                    progress['uploaded_at'] = ready['uploaded_at']
+            elif ready is not None:
+                self._discard([ready])
+
+            with self.bot.transaction():
+                self.bot.push_outbox('battle-' + str(item_id), 'battle', data, \
+                    step, progress)
+                self.bot.consume_queue('battle_queue', item_id)
+
+
+    def send_tweets(self):
+        """Posts the tweets of the outbox, in order
+
+        Every tweet goes through these steps, and the outbox records the last
+        one completed along with its results, so a tweet interrupted (e.g. by
+        a restart) resumes where it stopped:
+
+            - 'queued': the tweet is in the outbox
+            - 'avatars': the profile pictures were fetched
+            - 'rendered': the images were generated
+            - 'uploaded': the images were uploaded, valid for `MEDIA_TTL`
+
+        and once posted, it is removed from the outbox. A tweet that fails
+        for a while (see `WarBotAPI.is_transient()`) is retried later, after
+        `RETRY_DELAY` seconds doubled on every attempt, and the tweets after
+        it wait for it. If it fails for good, or `MAX_ATTEMPTS` times, it is
+        dropped.
+
+        Return
+        ------
+        int
+            Number of tweets posted
+        """
 
-        # generate text
-        left = len(self.bot.get_alive_fighters())
-        if left == 1:
-            left_text = "¡@{} has won the war! 🏆".format(winner)
-        else:
-            left_text = "{} fighters left".format(left)
-        if left == 2:
-            left_text += ". Who will win the war? 🤔 Do your bets!"
-        images = [out_route]
+        posted = 0
+        for item in self.bot.get_outbox():
+            if item['retry_at'] > time.time():
+                break
+            result = self._send(item)
+            if result is None:
+                break
+            posted += result
+        return posted
+
+
+    def _fetch_avatars(self, item):
+        data = item['data']
+        if item['kind'] == 'battle':
+            return [self.api.get_profilepic(data['winner']), \
+                self.api.get_profilepic(data['defeated'])]
+        return [self.api.get_profilepic(data['username'])]
+
+
+    def _render(self, item, avatars):
+        data = item['data']
+        if item['kind'] == 'battle':
+            # the list shows the fighters now, so it is only rendered for the
+            # last battle made (e.g. not for the first ones of a /forcebattle)
+            alivelist = data['alivelist'] \
+                and data['left'] == self.bot.count_alive_fighters()
+            return self.render_battle(data['winner'], data['defeated'], \
+                data['left'], self.bot.get_fighters_extended(), \
+                alivelist, avatars)
+        return [self.imgh.generate_newfighter(avatars[0], \
+            "newfighter-" + data['username'] + ".png")]
+
+
+    def _send(self, item):
+        """Runs the remaining steps of item
+
+        Return
+        ------
+        Option 1: bool
+            Whether the tweet was posted, it is no longer in the outbox
+        Option 2: None
+            If it must be retried later
+        """
 
-        # if wants to display list
-        if alivelist and left > 1:
-            out2 = "alivefighters_" + str(random.randint(1000, 9999)) + ".png"
-            out2_route = self.imgh.generate_alive(self.bot.get_fighters_extended(), out2)
-            images.append(out2_route)
-        if left == 1:
-            out2 = "winnerfighter_" + str(random.randint(1000, 9999)) + ".png"
-            out2_route = self.imgh.generate_winner(img1, out2)
-            images.append(out2_route)
-        
-        # post tweet
+        progress = item['progress']
         try:
-            self.api.post_tweet(self.bot.generate_battle_text(winner, defeated) \
-                + " " + left_text, images)
-            log.send_message("[TWITTER] Tweet posted: " + winner + \
-                " killed " + defeated)
-            self.bot.add_message_queue("🛎️ Tweet posted: " \
-                + "*{}* has killed *{}*.".format(winner, defeated))
+            while True:
+                step = item['step']
+                if step == 'queued':
+                    progress['avatars'] = self._fetch_avatars(item)
+                    step = 'avatars'
+                elif step == 'avatars':
+                    progress['images'] = self._render(item, progress['avatars'])
+                    step = 'rendered'
+                elif step == 'rendered':
+                    progress['media_ids'] = self.api.upload_media( \
+                        progress['images'])
+                    progress['uploaded_at'] = time.time()
+                    step = 'uploaded'
+                elif time.time() - progress['uploaded_at'] > self.MEDIA_TTL:
+                    step = 'rendered'
+                else:
+                    self.api.post_tweet(item['data']['text'], \
+                        media_ids=progress['media_ids'] or None)
+                    break
+
+                item['step'] = step
+                self.bot.update_outbox(item['id'], step=step, \
+                    progress=progress, attempts=0)
         except Exception as e:
-            log.send_message("[TWITTER] Tweet COULD NOT be posted: " + \
-                winner + " killed " + defeated + " -> " + str(e))
-            self.bot.add_message_queue("⚠️ Tweet could not be posted: " \
-                + "*{}* has killed *{}*.".format(winner, defeated))
-
-        # remove images generated
-        os.remove(img1_route)
-        os.remove(img2_route)
-        os.remove(out_route)
+            # the tweet was posted, but the bot stopped before knowing it
+            if getattr(e, 'api_code', None) == 187:
+                log.send_message("[TWITTER] Tweet was already posted: " \
+                    + item['key'])
+            elif self.api.is_transient(e) \
+                and item['attempts'] + 1 < self.MAX_ATTEMPTS:
+                attempts = item['attempts'] + 1
+                retry_at = getattr(e, 'retry_at', None) or time.time() \
+                    + self.RETRY_DELAY * 2**(attempts - 1)
+                self.bot.update_outbox(item['id'], attempts=attempts, \
+                    retry_at=retry_at)
+                log.send_message("[TWITTER] Tweet " + item['key'] + " at " \
+                    + "step " + item['step'] + " will be retried at " \
+                    + str(datetime.fromtimestamp(retry_at)) + " -> " + str(e))
+                if attempts == 1:
+                    self.bot.add_message_queue("⏳ Tweet delayed, will be " \
+                        + "retried: " + item['data']['summary'])
+                return None
+            else:
+                log.send_message("[TWITTER] Tweet COULD NOT be posted: " \
+                    + item['key'] + " -> " + str(e))
+                self.bot.add_message_queue("⚠️ Tweet could not be posted: " \
+                    + item['data']['summary'])
+                self._finish(item)
+                return False
+
+        log.send_message("[TWITTER] Tweet posted: " + item['key'])
+        self.bot.add_message_queue("🛎️ Tweet posted: " \
+            + item['data']['summary'])
+        self._finish(item)
 
         # generate list of 100 left, and save it
-        if len(self.bot.get_alive_fighters()) == 100:
+        if item['kind'] == 'battle' and self.bot.count_alive_fighters() == 100:
             self.imgh.generate_alive(self.bot.get_alive_fighters(), "alive_last100.png")
+        return True
+
+
+    def _finish(self, item):
+        # remove images generated
+        for image in item['progress'].get('images', []):
+            if os.path.exists(image):
+                os.remove(image)
+        self.bot.delete_outbox(item['id'])
 
-        if alivelist:
-           os.remove(out2_route)
-            
 
-    def send_newfighter(self, username):
-        """Send new fighter message to Twitter
+    def render_battle(self, winner, defeated, left, fighters, alivelist=None, \
+        avatars=None):
+        """Renders the images of a battle tweet
 
-        Sends new fighter message, including image
+        Parameters
+        ----------
+        winner : str
+            Winner fighter's username
+        defeated : str
+            Defeated fighter's username
+        left : int
+            Alive fighters after the battle
+        fighters : list<dict>
+            Fighters after the battle, see `WarBot.get_fighters_extended()`
+        alivelist : bool
+            Whether to render the alive fighters' list, by default if there
+            are less than `show_threshold` fighters left
+        avatars : list<str>
+            Profile pictures of winner and defeated, fetched if not given
+
+        Return
+        ------
+        list<str>
+            Routes to the images rendered
         """
 
-        # generate filenames
-        img = username + "_profilepic.png"
-        img_route = self.api.download_profilepic(username, img)
-        out = "newfighter-"+username+".png"
-        out_route = self.imgh.generate_newfighter(img, out)
+        if alivelist is None:
+            alivelist = left < self.bot.show_threshold
 
-        # post tweet
-        try:
-            self.api.post_tweet("We have a new fighter! " + \
-                "@{}, welcome to the battle!".format(username), [out_route])
-            log.send_message("[TWITTER] Tweet posted: new fighter " + username)
-            self.bot.add_message_queue("🛎️ Tweet posted: new fighter " \
-                + "*{}*".format(username))
-        except Exception as e:
-            log.send_message("[TWITTER] Tweet COULD NOT be posted: new fighter " \
-                + username + " -> " + str(e))
-            self.bot.add_message_queue("⚠️ Tweet could not be posted: new " \
-                + "fighter *{}*".format(username))
+        # profile pictures are kept in cache
+        if avatars is None:
+            avatars = [self.api.get_profilepic(winner), \
+                self.api.get_profilepic(defeated)]
+        img1, img2 = avatars
+        out = "battle-"+winner+"_"+defeated+".png"
+        images = [self.imgh.generate_battle(img1, img2, out)]
 
-        # remove images generated
-        os.remove(img_route)
-        os.remove(out_route)
+        # if wants to display list
+        if alivelist and left > 1:
+            out2 = "alivefighters_" + str(random.randint(1000, 9999)) + ".png"
+            images.append(self.imgh.generate_alive(fighters, out2))
+        if left == 1:
+            out2 = "winnerfighter_" + str(random.randint(1000, 9999)) + ".png"
+            images.append(self.imgh.generate_winner(img1, out2))
+
+        return images
 
 
     def main(self):
@@ -248,56 +702,49 @@ class WarBotTwitter:
         """
 
         while True:
-            ann_queue = self.bot.get_announce_queue()
-            ann_queue = list(dict.fromkeys(ann_queue)) # for security
-            self.bot.wipe_announce_queue()
-
-            battle_queue = self.bot.get_battle_queue()
-            self.bot.wipe_battle_queue()
-
-            for fighter in ann_queue:
-                if self.bot.get_fighter_announce():
-                    self.send_newfighter(fighter)
-            
-            for battle in battle_queue:
-                show_list = len(self.bot.get_alive_fighters()) \
-                    < self.bot.show_threshold
-                self.send_battle(battle['winner'], battle['defeated'], \
-                    show_list)
-
-            # battle scheduling
-            if not self.bot.get_stop_next_battle():
-                # run battle at specified time
-                now = datetime.now().strftime("%d/%m/%Y %H:%M")
-                
-                sched = self.bot.get_next_battle().strftime("%d/%m/%Y %H:%M")
-                
-                if now == sched:
-                    log.send_message("[TWITTER] Ran scheduled battle")
-                    w, d = self.bot.battle()
-                    if w == None or d == None:
-                        self.bot.add_message_queue("⚠️ Scheduled battle could " \
-                        + "not be executed. Stopping programmed battles.")
-                        self.bot.set_stop_frequency(True)
-                    else:
-                        self.bot.add_message_queue("🛎️ A programmed battle " \
-                            + "has been executed: *{}* ".format(w) \
-                            + "has killed *{}*.".format(d))
-                    self.bot.set_stop_next_battle(True)
-
-                    # if the frequency is set, we set next schedule
-                    if not self.bot.get_stop_frequency():
-                        log.send_message("[TWITTER] New schedule set due " \
-                            + "to schedule frequency")
-                        # calculate next battle
-                        h, m = self.bot.get_battle_frequency()
-                        date = self.bot.get_next_battle() + \
-                            timedelta(hours=int(h), minutes=int(m))
-                        self.bot.set_next_battle(date.strftime("%d/%m/%Y %H:%M"))
-                        self.bot.set_stop_next_battle(False)
+            # battle scheduling, before the queues so a scheduled battle is
+            # posted right away
+            self.sync_schedule()
+            self.scheduler.run_pending()
+            # the battle was run (or skipped) and rescheduled
+            if not self._schedule[0] and \
+                self.scheduler.get('battle') != self._schedule[1]:
+                self.save_schedule()
+
+            # items are moved from the queues to the outbox, so the ones
+            # pushed meanwhile by the admin are not lost, and the tweets
+            # interrupted before are resumed first
+            self.queue_tweets()
+            self.send_tweets()
+
+            # keep the pictures of the next battles cached, so posting a
+            # battle does not wait for Twitter to resolve its fighters
+            if time.time() - self._prefetched >= self.PREFETCH_TIME:
+                self.api.prefetch_profilepics(self.bot.get_alive_fighters())
+                self._prefetched = time.time()
+            self.prepare_battle()
+
+            # sleep until the next battle, if it comes before the next update
+            # while the admin can wake up the bot, there is no need to poll
+            # the database every few seconds
+            if self.notifier is not None and self.notifier.listening:
+                seconds = self.IDLE_TIME
+            else:
+                seconds = self.sleep_time
 
+            # mentions are polled on their own interval, see optin()
             if self.bot.get_optin_running():
-                self.optin()
-                time.sleep(self.sleep_time_optin)
+                if time.time() >= self._next_optin:
+                    self.optin()
+                    self._next_optin = time.time() + self.optin_interval
+                seconds = min(seconds, self._next_optin - time.time())
             else:
-                time.sleep(self.sleep_time)
\ No newline at end of file
+                # opt-in starts polling often again when it is activated
+                self.optin_interval = self.sleep_time_optin
+                self._next_optin = 0
+                if self.bot.get_settings()['optin_interval'] \
+                    != int(self.optin_interval):
+                    self.bot.update_settings( \
+                        optin_interval=int(self.optin_interval))
+
+            self.sleep(seconds)
\ No newline at end of file
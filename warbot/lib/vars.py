@@ -13,9 +13,9 @@ More information about the variables can be found as comments.
 Very important information
 --------------------------
 
-`TWITTER_SLEEP_TIME` cannot be 60 seconds or more, otherwise the battle
-scheduling won't work. Furthermore, times closer to 60 seconds might result
-in failures.
+`TWITTER_SLEEP_TIME` is how often the Twitter bot checks the queues and the
+settings. Battles do not depend on it: the bot sleeps until the next battle
+if it comes first.
 
 """
 
@@ -46,7 +46,17 @@ TWITTER_VARS = {
 
     # Sleep time for WarBotTwitter
     # IMPORTANT: see header
-    'SLEEP_TIME'            : 7
+    'SLEEP_TIME'            : 7,
+
+    # What to do with battles missed while the Twitter bot was not running
+    #   'all': run them all, 'once': run one of them, 'skip': do not run them
+    #   See WarBotScheduler for more info
+    'CATCH_UP'              : 'once',
+
+    # Upload the media of the next battle when it is prepared, a few minutes
+    # before it is due, so the tweet is posted right at the scheduled time
+    #   See WarBotTwitter.prepare_battle for more info
+    'PREUPLOAD'             : False
 }
 
 
@@ -128,12 +138,18 @@ ROUTES = {
 #   They will be in one of folder route's folders
 FILENAMES = {
     # Database
-    'DATABASE':     'warbot_db.json',
+    #   If it does not exist, a TinyDB database with the same name and .json
+    #   extension will be imported, if present
+    'DATABASE':     'warbot_db.sqlite3',
 
     # Phrases
-    'PHRASES':      'phrases.txt'
+    'PHRASES':      'phrases.txt',
+
+    # Socket the Telegram bot uses to wake up the Twitter bot, in the
+    # database folder
+    'NOTIFY':       'warbot_twitter.sock'
 }
-DATABASE_FILENAME = 'warbot_db.json'
+DATABASE_FILENAME = 'warbot_db.sqlite3'
 
 
 
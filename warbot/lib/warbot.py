@@ -26,12 +26,11 @@ __status__      = "Production"
 
 # application imports
 from database import WarBotDB
+from scheduler import WarBotRule
 from vars import route
 
 # store dates
 from datetime import datetime, timedelta
-# numeric processing library
-import numpy as np
 import random
 
 
@@ -61,16 +60,26 @@ class WarBot:
             be done
         battle() : winner : str, defeated : str
             Makes a battle, returns winner and defeated fighters
+        battle_many(n : int) : list<tuple>
+            Makes up to n battles at once, returns (winner, defeated) of
+            each one
 
     Database methods:
         get_fighters_extended() : dict
             Returns dictionary with all fighter's information, in WarBotDB's format
+        get_fighter(username : str) : dict
+            Returns fighter's information, in WarBotDB's format, None if not
+            found
         get_fighters() : list<str>
             Returns list with all fighters
         get_alive_fighters() : list<str>
             Returns list with all alive fighters
         get_dead_fighters() : list<str>
             Returns list with all dead fighters
+        count_alive_fighters() : int
+            Returns number of alive fighters
+        get_roster() : WarBotRoster
+            Returns all fighters in columns, see `WarBotRoster`
         get_candidates() : list<str>
             Returns list with all candidates
         add_fighter(username : str) : bool
@@ -79,19 +88,43 @@ class WarBot:
             Deletes fighter, returns if it could be deleted
         add_candidate(username : str) : bool
             Adds candidate, returns if it could be added
+        add_candidates(usernames : list<str>, last_seen_id=None) : list<str>
+            Adds the usernames that are not candidates nor fighters yet,
+            returns them
         delete_candidate(username : str) : bool
             Deletes candidate, returns if it could be deleted
         revive_fighter(username : str) : bool
             Revives fighter, returns if it could be revived
+        transaction()
+            Context manager to commit several database changes at once
+        start_compactor()
+            Starts folding database changes in the background, see
+            `WarBotStorage.start_compactor()`
         restart : bool
             Restarts database
         
     Database variable methods:
+        get_settings() : dict
+            Returns all settings at once, see `WarBotDB.SETTINGS_DEFAULTS`
+        update_settings(**fields)
+            Updates several settings at once, see `WarBotDB.update_settings()`
+        get_schedules() : list<WarBotRule>
+            Returns the recurring battle schedules
+        add_schedule(input : str) : WarBotRule
+            Adds a battle schedule of the form "minutes hh:mm-hh:mm (days)",
+            returns None if it is not valid
+        delete_schedule(id : int) : bool
+            Deletes a battle schedule, returns if it could be deleted
         For variables:
             set_[name_of_variable]([value])
                 Sets [name_of_variable] to [value]
             get_[name_of_variable]()
                 Returns [name_of_variable]
+        read_queue(queue : str, after_id=0) : list<tuple>
+            Returns (id, item) of the items in queue, see
+            `WarBotDB.read_queue()`
+        consume_queue(queue : str, up_to_id : int)
+            Removes the items of queue up to up_to_id, included
         For queues:
             add_[name_of_queue]([item])
                 Adds [item] to [name_of_queue]
@@ -99,6 +132,12 @@ class WarBot:
                 Returns queue
             wipe_[name_of_queue]()
                 Deletes queue
+        push_outbox(key, kind, data, step='queued', progress=None) : bool
+        get_outbox() : list<dict>
+        get_outbox_retry() : float
+        update_outbox(id, **fields)
+        delete_outbox(id)
+            Tweets being posted, see `WarBotDB.push_outbox()`
     """
 
     KILLFACTOR = 0.5
@@ -143,44 +182,32 @@ class WarBot:
 
             PROB(fighter) = 1 + KILLFACTOR * number_of_fighters_killed_by(fighter)
 
-        Then, the vector of alive fighters' probability is normalized so that it
-        sums up to 1, setting the final probabilities.
+        Fighters are drawn without replacement: the winner is drawn first, and
+        then the defeated among the rest of alive fighters.
+
+        The weights are kept by the roster's sampler (see `WarBotSampler`),
+        so drawing costs O(log n) instead of normalizing the whole vector.
         """
-        
-        fighters = []
-        weight = []
-        for fighter in self.db.get_fighters():
-            if fighter["alive"]:
-                fighters.append(fighter["username"])
-                w = 1 + len(fighter["killed"]) * self.KILLFACTOR
-                weight.append(w)
-                
-        if len(weight) >= 2:
-            norm = [float(i)/sum(weight) for i in weight]
-
-            random_result = np.random.choice(fighters, size=2, replace=False, \
-                p=norm)
-
-            winner = random_result[0]
-            defeated = random_result[1]
-
-            return winner, defeated
-        else:
+
+        roster = self.db.get_roster()
+        winner, defeated = roster.sampler(self.KILLFACTOR).sample_pair()
+
+        if winner is None:
             return None, None
+        return roster.usernames[winner], roster.usernames[defeated]
 
 
     def force_battle(self, winner, defeated):
-        if winner in self.get_fighters() and defeated in self.get_fighters():
-            self.db.insert_fighter_kill(winner, defeated)
-            self.db.change_fighter_alive(defeated, False)
-            self.add_battle_queue(winner, defeated)
+        with self.transaction():
+            roster = self.db.get_roster()
+            if winner not in roster.ids or defeated not in roster.ids:
+                return False
 
-            if len(self.get_alive_fighters()) >= self.show_threshold:
-                self.db.change_fighter_show(defeated, False)
+            self.db.insert_battle(winner, defeated, \
+                roster.count_alive() - 1 < self.show_threshold)
+            self.add_battle_queue(winner, defeated, roster.count_alive())
 
-            return True
-        else:
-            return False
+        return True
 
 
     def battle(self):
@@ -188,6 +215,52 @@ class WarBot:
         self.force_battle(winner, defeated)
         return winner, defeated
 
+
+    def battle_many(self, n):
+        """Makes up to n battles at once
+
+        Battles are drawn one after another, as in `battle()`, so every draw
+        takes into account the kills of the previous ones. All of them are
+        committed in a single transaction, and queued at once.
+
+        Parameters
+        ----------
+        n : int
+            Number of battles
+
+        Returns
+        -------
+        list<tuple>
+            (winner, defeated) of every battle done, less than n if there
+            were not enough alive fighters
+        """
+
+        battles = []
+        with self.transaction():
+            roster = self.db.get_roster()
+            sampler = roster.sampler(self.KILLFACTOR)
+
+            while len(battles) < n:
+                winner, defeated = sampler.sample_pair()
+                if winner is None:
+                    break
+
+                winner = roster.usernames[winner]
+                defeated = roster.usernames[defeated]
+                # updates the sampler for the next draw
+                self.db.insert_battle(winner, defeated, \
+                    roster.count_alive() - 1 < self.show_threshold)
+                # every tweet tells the fighters left after its own battle
+                battles.append((winner, defeated, roster.count_alive()))
+
+            self.db.push_queue_many('battle_queue', [{'winner': winner, \
+                'defeated': defeated, 'left': left} \
+                for winner, defeated, left in battles])
+
+        battles = [(winner, defeated) for winner, defeated, _ in battles]
+
+        return battles
+
     
     def generate_battle_text(self, winner, defeated):
         phrases = []
@@ -203,24 +276,51 @@ class WarBot:
         return "☠️ " + phrase
 
 
+    def start_compactor(self):
+        self.db.start_compactor()
+
+    def transaction(self):
+        """Context manager to commit several database changes at once
+
+        See `WarBotDB.batch()` for more info.
+        """
+
+        return self.db.batch()
+
+
     def get_fighters_extended(self):
-        return self.db.get_fighters()
+        return self.db.get_roster().fighters()
+
+    def preview_battle(self, winner, defeated):
+        """Fighters as `get_fighters_extended()` will return them after the
+        battle, without making it"""
+
+        show = self.count_alive_fighters() - 1 < self.show_threshold
+        fighters = self.get_fighters_extended()
+        for fighter in fighters:
+            if fighter['username'] == defeated:
+                fighter['alive'] = False
+                fighter['show'] = fighter['show'] and show
+            elif fighter['username'] == winner:
+                fighter['killed'] = fighter['killed'] + [defeated]
+        return fighters
+
+    def get_roster(self):
+        return self.db.get_roster()
 
     def get_fighters(self):
-        fighters = []
-        for fighter in self.db.get_fighters():
-            fighters.append(fighter["username"])
-        return fighters
+        return list(self.db.get_roster().ids)
 
     def get_alive_fighters(self):
-        alive = list(item["username"] for item in self.get_fighters_extended() \
-            if item["alive"])
-        return alive
+        roster = self.db.get_roster()
+        return roster.to_usernames(roster.alive_ids())
     
     def get_dead_fighters(self):
-        dead = list(item["username"] for item in self.get_fighters_extended() \
-            if not item["alive"])
-        return dead
+        roster = self.db.get_roster()
+        return roster.to_usernames(roster.dead_ids())
+
+    def count_alive_fighters(self):
+        return self.db.get_roster().count_alive()
 
     def get_candidates(self):
         candidates = []
@@ -228,6 +328,12 @@ class WarBot:
             candidates.append(candidate["username"])
         return candidates
 
+    def read_queue(self, queue, after_id=0):
+        return self.db.read_queue(queue, after_id)
+
+    def consume_queue(self, queue, up_to_id):
+        self.db.consume_queue(queue, up_to_id)
+
     def add_announce_queue(self, username):
         self.db.add_announce_queue(username)
     
@@ -237,8 +343,8 @@ class WarBot:
     def get_announce_queue(self):
         return self.db.get_announce_queue()
 
-    def add_battle_queue(self, winner, defeated):
-        self.db.add_battle_queue(winner, defeated)
+    def add_battle_queue(self, winner, defeated, left):
+        self.db.add_battle_queue(winner, defeated, left)
     
     def wipe_battle_queue(self):
         self.db.delete_battle_queue()
@@ -246,43 +352,93 @@ class WarBot:
     def get_battle_queue(self):
         return self.db.get_battle_queue()
 
+    def push_outbox(self, key, kind, data, step='queued', progress=None):
+        return self.db.push_outbox(key, kind, data, step, progress)
+
+    def get_outbox(self):
+        return self.db.get_outbox()
+
+    def get_outbox_retry(self):
+        return self.db.get_outbox_retry()
+
+    def update_outbox(self, id, **fields):
+        self.db.update_outbox(id, **fields)
+
+    def delete_outbox(self, id):
+        self.db.delete_outbox(id)
+
+    def get_fighter(self, username):
+        return self.db.get_roster().fighter(username)
+
     def add_fighter(self, username):
-        if username in self.get_fighters():
+        if self.db.has_fighter(username):
             return False
         else:
             self.db.insert_fighter(username)
             return True
     
     def delete_fighter(self, username):
-        if username in self.get_fighters():
+        if self.db.has_fighter(username):
             self.db.delete_fighter(username)
             return True
         else:
             return False
 
     def add_candidate(self, username):
-        if username in self.get_candidates():
+        if self.db.has_candidate(username):
             return False
         else:
             self.db.insert_candidate(username)
             return True
     
+    def add_candidates(self, usernames, last_seen_id=None):
+        """Adds the usernames that are not candidates nor fighters yet
+
+        Usernames are checked in memory, and added in a single transaction
+        along with last_seen_id, so mentions are not processed twice.
+
+        Parameters
+        ----------
+        usernames : list<str>
+            Usernames, possibly repeated
+        last_seen_id : int
+            If given, last mention processed
+
+        Returns
+        -------
+        list<str>
+            Usernames added, in order
+        """
+
+        known = set(self.get_candidates())
+        known.update(self.db.get_roster().ids)
+
+        added = []
+        for username in usernames:
+            if username not in known:
+                known.add(username)
+                added.append(username)
+
+        with self.transaction():
+            if len(added) > 0:
+                self.db.insert_candidates(added)
+            if last_seen_id is not None:
+                self.db.update_last_seen(last_seen_id)
+
+        return added
+    
     def delete_candidate(self, username):
-        if username in self.get_candidates():
+        if self.db.has_candidate(username):
             self.db.delete_candidate(username)
             return True
         else:
             return False
     
     def revive_fighter(self, username):
-        if username in self.get_fighters():
-            fighter = next(item for item in self.get_fighters_extended() \
-                if item["username"] == username)
-            if not fighter["alive"]:
-                self.db.change_fighter_alive(username, True)
-                return True
-            else:
-                return False
+        fighter = self.db.get_fighter(username)
+        if fighter is not None and not fighter["alive"]:
+            self.db.change_fighter_alive(username, True)
+            return True
         else:
             return False
 
@@ -325,6 +481,27 @@ class WarBot:
         
         return could_assign
 
+    def get_settings(self):
+        return self.db.get_settings()
+
+    def update_settings(self, **fields):
+        self.db.update_settings(**fields)
+
+    def get_schedules(self):
+        return [WarBotRule.from_dict(s) for s in self.db.get_schedules()]
+
+    def add_schedule(self, input):
+        try:
+            rule = WarBotRule.parse(input)
+        except ValueError:
+            return None
+
+        rule.id = self.db.add_schedule(rule.to_dict())
+        return rule
+
+    def delete_schedule(self, id):
+        return self.db.delete_schedule(id)
+
     def get_optin_running(self):
         return self.db.get_optin_running()
     